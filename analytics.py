@@ -1,52 +1,264 @@
+import argparse
+import numpy as np
 import pandas as pd
 import sqlite3
 import json
 
-def load_and_process_data():
-    """Load and process crime data from crimes.db"""
-    conn = sqlite3.connect('filtered_crimes.db')
-    query = """
-        SELECT *
-        FROM filtered_crimes
-        WHERE year >= 2020 AND year <= 2024
+from crime_loader import DB_PATH, load_crime_partitions
+from page_writer import PageWriter
+from rollup import ensure_rollup_table, rollup_counts
+
+DAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+MONTH_NAMES = ['January', 'February', 'March', 'April', 'May', 'June',
+               'July', 'August', 'September', 'October', 'November', 'December']
+# Right-closed bins like pd.cut(hour, [0, 6, 12, 18, 24]), so hour 0 falls in no block
+TIME_BLOCKS = {'Night': range(1, 7), 'Morning': range(7, 13), 'Afternoon': range(13, 19), 'Evening': range(19, 24)}
+
+# The only incident columns the charts group on, plus the two the page filters by
+CHART_COLUMNS = ['Primary Type', 'Community Area', 'hour', 'dow', 'month', 'Year', 'Arrest']
+CHART_YEARS = range(2020, 2025)
+
+def load_and_process_data(db_path=DB_PATH, chunksize=None):
+    """Load 2020-2024 crimes with just the chart columns, in compact dtypes.
+
+    Day and month names are categoricals over DAY_NAMES and MONTH_NAMES
+    built from the integer fields parsed at ingest, so no per-row name
+    strings are created. Rows come from the columnar snapshot when there is
+    one; otherwise chunksize streams them from SQLite that many at a time.
     """
-    df = pd.read_sql_query(query, conn)
-    conn.close()
+    df = load_crime_partitions(CHART_COLUMNS, years=CHART_YEARS, db_path=db_path,
+                               compact=True, chunksize=chunksize)
     
-    # Convert date fields if necessary
-    df['Date'] = pd.to_datetime(df['Date'])
-    df['hour'] = df['Date'].dt.hour
-    df['day_of_week'] = df['Date'].dt.day_name()
-    df['month'] = df['Date'].dt.month_name()
-    df['year'] = df['Date'].dt.year
-    df['is_weekend'] = df['day_of_week'].isin(['Saturday', 'Sunday'])
+    df['day_of_week'] = pd.Categorical.from_codes(df['dow'].fillna(-1).astype('int8'), DAY_NAMES)
+    df['month'] = pd.Categorical.from_codes((df['month'] - 1).fillna(-1).astype('int8'), MONTH_NAMES)
+    df['is_weekend'] = (df['dow'] >= 5).fillna(False).astype(bool)
     
     return df
 
+def load_rollup_frame(conn):
+    """2020-2024 crime counts from crime_rollup, one row per (type, hour, day, month, area, year, arrest)"""
+    ensure_rollup_table(conn)
+    rows = rollup_counts(conn, ('type', 'hour', 'dow', 'month', 'area', 'year', 'arrest'), year=CHART_YEARS)
+    df = pd.DataFrame(rows, columns=['Primary Type', 'hour', 'dow', 'month', 'Community Area', 'Year', 'Arrest',
+                                     'count'])
+    df['hour'] = df['hour'].astype('Int64')
+    df['Community Area'] = df['Community Area'].astype('Int64')
+    df['day_of_week'] = df['dow'].map(dict(enumerate(DAY_NAMES)))
+    df['month'] = df['month'].map(dict(enumerate(MONTH_NAMES, start=1)))
+    return df
+
+def category_codes(values, categories):
+    """Integer code of each value in categories, with missing values coded len(categories)"""
+    if isinstance(values.dtype, pd.CategoricalDtype) and list(values.cat.categories) == list(categories):
+        codes = values.cat.codes.to_numpy().astype(np.int64)
+        codes[codes < 0] = len(categories)
+        return codes
+
+    # Factorizing and then mapping the few distinct values is much cheaper
+    # than looking every row up in the categories
+    codes, uniques = pd.factorize(values)
+    positions = {category: i for i, category in enumerate(categories)}
+    lookup = np.array([positions.get(value, len(categories)) for value in uniques] + [len(categories)],
+                      dtype=np.int64)
+    return lookup[codes]
+
+def chart_codes(df):
+    """(types, areas, codes) with integer codes of each chart dimension of every row.
+
+    codes holds type, hour, day, month and area codes; the last code of
+    each non-type dimension (24, 7, 12, len(areas)) marks a missing value.
+    """
+    type_codes, types = pd.factorize(df['Primary Type'], sort=True)
+    area_codes, areas = pd.factorize(df['Community Area'], sort=True)
+    area_codes = np.where(area_codes < 0, len(areas), area_codes)
+    hour = df['hour']
+    hour_codes = np.where(hour.isna(), 24, hour.fillna(0)).astype(np.int64)
+    day_codes = category_codes(df['day_of_week'], DAY_NAMES)
+    month_codes = category_codes(df['month'], MONTH_NAMES)
+    return types, areas, (type_codes, hour_codes, day_codes, month_codes, area_codes)
+
+def count_cube(df):
+    """Count crimes by (type, hour, day of week, month, community area) in one pass.
+
+    Every dimension is turned into integer codes, the codes are combined
+    into one flat cell index and a single np.bincount tallies all rows.
+    The last slot of each non-type axis counts rows missing that value.
+    A 'count' column, as in load_rollup_frame() output, weights each row.
+    Returns (types, areas, cube) where cube has shape
+    (types, 25, 8, 13, areas + 1).
+    """
+    types, areas, (type_codes, hour_codes, day_codes, month_codes, area_codes) = chart_codes(df)
+
+    keep = type_codes >= 0
+    shape = (len(types), 25, len(DAY_NAMES) + 1, len(MONTH_NAMES) + 1, len(areas) + 1)
+    cells = np.ravel_multi_index(
+        (type_codes[keep], hour_codes[keep], day_codes[keep], month_codes[keep], area_codes[keep]), shape
+    )
+    # Rows read from the rollup stand for 'count' incidents each
+    weights = df['count'].to_numpy()[keep] if 'count' in df else None
+    cube = np.bincount(cells, weights=weights, minlength=int(np.prod(shape)))
+    return types.tolist(), areas.tolist(), cube.astype(np.int64).reshape(shape)
+
+def filter_cube(df, years=CHART_YEARS):
+    """Chart counts per (year, arrest, type) for the page's filter worker.
+
+    Each cell holds a type's 24 hourly, 7 daily and 12 monthly counts, one
+    count per community area and its total, which is all the page needs to
+    rebuild prepare_chart_data() output for any year range and arrest
+    filter. Years are the outer axis, so a year range is one contiguous
+    run of cells. Returns a JSON-ready dict.
+    """
+    types, areas, (type_codes, hour_codes, day_codes, month_codes, area_codes) = chart_codes(df)
+    year_codes = pd.Index(list(years)).get_indexer(df['Year'].astype('Float64').fillna(-1).to_numpy())
+    # Rollup rows have 0/1 (or missing) arrests, incident rows booleans
+    arrest_codes = df['Arrest'].astype('Float64').fillna(0).to_numpy().astype(np.int64)
+
+    keep = (type_codes >= 0) & (year_codes >= 0)
+    groups = len(years) * 2 * len(types)
+    group = ((year_codes * 2 + arrest_codes) * len(types) + type_codes)[keep]
+    weights = df['count'].to_numpy()[keep] if 'count' in df else None
+
+    def tally(codes, size):
+        # One bincount per chart, dropping the missing-value slot
+        counts = np.bincount(group * (size + 1) + codes[keep], weights=weights, minlength=groups * (size + 1))
+        return counts.reshape(groups, size + 1)[:, :size]
+
+    cells = np.column_stack([
+        tally(hour_codes, 24), tally(day_codes, len(DAY_NAMES)), tally(month_codes, len(MONTH_NAMES)),
+        tally(area_codes, len(areas)), np.bincount(group, weights=weights, minlength=groups)
+    ])
+    return {
+        'years': list(years),
+        'types': types.tolist(),
+        'areas': areas.tolist(),
+        'days': DAY_NAMES,
+        'months': MONTH_NAMES,
+        'time_blocks': {block: [hours.start, hours.stop] for block, hours in TIME_BLOCKS.items()},
+        'cells': cells.astype(np.int64).ravel().tolist()
+    }
+
+def unstack_counts(matrix, types, labels):
+    """{label: {type: count}} from a types x labels matrix, as groupby().size().unstack(fill_value=0).to_dict()"""
+    type_seen = matrix.sum(axis=1) > 0
+    label_seen = matrix.sum(axis=0) > 0
+    return {
+        label: {crime_type: int(matrix[i, j]) for i, crime_type in enumerate(types) if type_seen[i]}
+        for j, label in enumerate(labels) if label_seen[j]
+    }
+
 def prepare_chart_data(df):
     """Prepare chart data grouped by various time dimensions and crime types"""
+    types, areas, cube = count_cube(df)
+
+    # Each chart is a marginal of the cube; the trailing missing-value slot is dropped
+    hourly = cube.sum(axis=(2, 3, 4))
+    daily = cube.sum(axis=(1, 3, 4))
+    monthly = cube.sum(axis=(1, 2, 4))
+    area = cube.sum(axis=(1, 2, 3))
+    weekend = daily[:, 5:7].sum(axis=1)
+
     chart_data = {
-        'hourly': df.groupby(['Primary Type', 'hour']).size().unstack(fill_value=0).to_dict(),
-        'daily': df.groupby(['Primary Type', 'day_of_week']).size().unstack(fill_value=0).to_dict(),
-        'monthly': df.groupby(['Primary Type', 'month']).size().unstack(fill_value=0).to_dict(),
-        'area': df.groupby(['Primary Type', 'Community Area']).size().unstack(fill_value=0).to_dict(),
+        'hourly': unstack_counts(hourly[:, :24], types, range(24)),
+        'daily': unstack_counts(daily[:, :7], types, DAY_NAMES),
+        'monthly': unstack_counts(monthly[:, :12], types, MONTH_NAMES),
+        'area': unstack_counts(area[:, :len(areas)], types, areas),
         'time_blocks': {
-            crime: df[df['Primary Type'] == crime].groupby(pd.cut(df['hour'], [0, 6, 12, 18, 24], labels=['Night', 'Morning', 'Afternoon', 'Evening'])).size().to_dict()
-            for crime in df['Primary Type'].unique()
+            crime_type: {block: int(hourly[i, list(hours)].sum()) for block, hours in TIME_BLOCKS.items()}
+            for i, crime_type in enumerate(types)
         },
-        'weekend_comparison': df.groupby(['Primary Type', 'is_weekend']).size().unstack(fill_value=0).to_dict()
+        # Rows without a day of week count as weekdays, as is_weekend does
+        'weekend_comparison': unstack_counts(
+            np.column_stack([daily.sum(axis=1) - weekend, weekend]), types, [False, True]
+        )
     }
     
     return chart_data
 
-def generate_dashboard():
-    print("Loading and processing data...")
-    df = load_and_process_data()
-    
-    print("Preparing chart data...")
-    chart_data = prepare_chart_data(df)
+# Runs in a Web Worker built from the page (see startWorker below). It
+# holds the filter_cube() cells in a typed array and answers each chart
+# request off the main thread with prepare_chart_data()-shaped series.
+FILTER_WORKER = """
+let cube = null;
+
+function chartSeries(request) {
+    const types = cube.types.length, areas = cube.areas.length;
+    const width = 24 + cube.days.length + cube.months.length + areas + 1;
+    const [daily, monthly, area, total] = [24, 24 + cube.days.length, width - areas - 1, width - 1];
+    const from = cube.years.indexOf(request.yearFrom), to = cube.years.indexOf(request.yearTo);
+    const series = {hourly: {}, daily: {}, monthly: {}, area: {}, time_blocks: {},
+                    weekend_comparison: {false: {}, true: {}}};
+    const put = (chart, label, type, count) => {
+        if (count) (series[chart][label] = series[chart][label] || {})[type] = count;
+    };
+
+    request.types.forEach(type => {
+        const t = cube.types.indexOf(type);
+        if (t < 0) return;
+        // The cells of the year range are one contiguous run; sum this type's within it
+        const sums = new Float64Array(width);
+        for (let year = from; year <= to; year++) {
+            for (let arrest = request.arrestOnly ? 1 : 0; arrest < 2; arrest++) {
+                const offset = ((year * 2 + arrest) * types + t) * width;
+                for (let i = 0; i < width; i++) sums[i] += cube.cells[offset + i];
+            }
+        }
+        for (let hour = 0; hour < 24; hour++) put('hourly', hour, type, sums[hour]);
+        cube.days.forEach((day, i) => put('daily', day, type, sums[daily + i]));
+        cube.months.forEach((month, i) => put('monthly', month, type, sums[monthly + i]));
+        cube.areas.forEach((name, i) => put('area', name, type, sums[area + i]));
+        series.time_blocks[type] = {};
+        Object.entries(cube.time_blocks).forEach(([block, [first, stop]]) => {
+            series.time_blocks[type][block] = sums.subarray(first, stop).reduce((a, b) => a + b, 0);
+        });
+        // Rows without a day of week count as weekdays, as in prepare_chart_data()
+        const weekend = sums[daily + 5] + sums[daily + 6];
+        put('weekend_comparison', false, type, sums[total] - weekend);
+        put('weekend_comparison', true, type, weekend);
+    });
+    return series;
+}
+
+onmessage = ({data}) => {
+    if (data.op === 'load') {
+        cube = JSON.parse(data.text);
+        cube.cells = Float64Array.from(cube.cells);
+    } else {
+        postMessage({id: data.id, result: chartSeries(data)});
+    }
+};
+"""
+
+def generate_dashboard(from_rows=False, chunksize=None, api_url=None, compress=(), db_path=DB_PATH):
+    if from_rows:
+        print("Loading and processing data...")
+        df = load_and_process_data(db_path, chunksize=chunksize)
+        type_counts = df['Primary Type'].value_counts()
+    else:
+        # Every chart is a roll-up of crime_rollup, so no incident rows are read
+        print("Loading crime counts...")
+        conn = sqlite3.connect(db_path)
+        df = load_rollup_frame(conn)
+        conn.close()
+        type_counts = df.groupby('Primary Type')['count'].sum()
     
-    crime_types = sorted(df['Primary Type'].unique())
+    series = None
+    if api_url is None:
+        print("Preparing chart data...")
+        series = filter_cube(df)
+    type_counts = {crime_type: int(count) for crime_type, count in type_counts.items() if count}
+    write_dashboard(None, type_counts, api_url, series=series, compress=compress)
+
+def write_dashboard(chart_data, type_counts, api_url=None, series=None, compress=()):
+    """Write crime_analytics.html from prepare_chart_data() output and {type: count}
+
+    With api_url the page leaves chart_data out and fetches the series for
+    the selected types, years and arrest filter from server.py instead
+    ('' when server.py serves the page itself). With series, filter_cube()
+    output, a worker in the page computes them from that instead. The
+    page is streamed to disk, with a .gz/.br copy for each of 'gzip' and
+    'brotli' in compress.
+    """
+    crime_types = sorted(type_counts)
 
     html_content = """
 <!DOCTYPE html>
@@ -110,6 +322,12 @@ def generate_dashboard():
         #update-btn:hover {
             background: #2a4365;
         }
+        .filter-row {
+            display: flex;
+            align-items: center;
+            gap: 8px;
+            margin: 10px 0;
+        }
         .count {
             margin-left: auto;
             color: #666;
@@ -128,7 +346,7 @@ def generate_dashboard():
 
     # Add checkboxes for each crime type
     for crime_type in crime_types:
-        count = len(df[df['Primary Type'] == crime_type])
+        count = type_counts[crime_type]
         html_content += f"""
         <div class="crime-type">
             <label>
@@ -139,6 +357,21 @@ def generate_dashboard():
         </div>
 """
 
+    if api_url is not None or series is not None:
+        # The server or the filter worker can slice by year and arrest as well as by type
+        year_options = "".join(f'<option value="{year}">{year}</option>' for year in CHART_YEARS)
+        html_content += f"""
+        <h3>Filters</h3>
+        <div class="filter-row">
+            <select id="year-from">{year_options.replace('value="2020"', 'value="2020" selected')}</select>
+            to
+            <select id="year-to">{year_options.replace('value="2024"', 'value="2024" selected')}</select>
+        </div>
+        <div class="filter-row">
+            <label><input type="checkbox" id="arrest-only"> Arrests only</label>
+        </div>
+"""
+
     html_content += """
         <button id="update-btn">Update Charts</button>
     </div>
@@ -169,10 +402,45 @@ def generate_dashboard():
         </div>
     </div>
 
+"""
+
+    script = """
     <script>
-    const chartData = """ + json.dumps(chart_data) + """;
+    const API_URL = """ + json.dumps(api_url.rstrip('/') if api_url is not None else None) + """;
+    let chartData = """
+    script_end = """;
+
+    function startWorker(scriptId, dataId) {
+        // Filtering runs in a worker so the page stays responsive; each
+        // request returns a promise of the worker's reply
+        const source = new Blob([document.getElementById(scriptId).textContent], {type: 'text/javascript'});
+        const worker = new Worker(URL.createObjectURL(source));
+        const pending = new Map();
+        let nextId = 0;
+        worker.onmessage = e => {
+            pending.get(e.data.id)(e.data.result);
+            pending.delete(e.data.id);
+        };
+        worker.postMessage({op: 'load', text: document.getElementById(dataId).textContent});
+        return request => new Promise(resolve => {
+            const id = nextId++;
+            pending.set(id, resolve);
+            worker.postMessage({...request, id: id});
+        });
+    }
 
-    function updateCharts() {
+    const filterWorker = document.getElementById('series-data') ? startWorker('filter-worker', 'series-data') : null;
+
+    async function fetchChartData(selectedCrimes) {
+        const params = new URLSearchParams();
+        selectedCrimes.forEach(crime => params.append('type', crime));
+        params.set('year_from', document.getElementById('year-from').value);
+        params.set('year_to', document.getElementById('year-to').value);
+        if (document.getElementById('arrest-only').checked) params.set('arrest', '1');
+        return fetch(`${API_URL}/api/series?${params}`).then(response => response.json());
+    }
+
+    async function updateCharts() {
         const selectedCrimes = Array.from(document.querySelectorAll('input[name="crime-toggle"]:checked'))
             .map(cb => cb.value);
         
@@ -181,10 +449,22 @@ def generate_dashboard():
             return;
         }
 
+        if (API_URL !== null) {
+            chartData = await fetchChartData(selectedCrimes);
+        } else if (filterWorker !== null) {
+            chartData = await filterWorker({
+                op: 'series',
+                types: selectedCrimes,
+                yearFrom: parseInt(document.getElementById('year-from').value),
+                yearTo: parseInt(document.getElementById('year-to').value),
+                arrestOnly: document.getElementById('arrest-only').checked
+            });
+        }
+
         // Hourly Chart
         const hourlyTraces = selectedCrimes.map(crime => ({
             x: Array.from({length: 24}, (_, i) => i),
-            y: Array.from({length: 24}, (_, i) => chartData.hourly[crime][i] || 0),
+            y: Array.from({length: 24}, (_, i) => (chartData.hourly[i] || {})[crime] || 0),
             name: crime,
             type: 'scatter',
             mode: 'lines+markers'
@@ -210,10 +490,34 @@ def generate_dashboard():
 </html>
 """
 
-    with open('crime_analytics.html', 'w') as f:
-        f.write(html_content)
+    # Stream the page to disk, encoding the data sections as they are written
+    with PageWriter('crime_analytics.html', compress) as page:
+        page.write(html_content)
+        if series is not None:
+            # Neither block runs as page script; the worker is started from their text
+            page.write("""
+    <script type="javascript/worker" id="filter-worker">""" + FILTER_WORKER + """</script>
+    <script type="application/json" id="series-data">""")
+            page.write_json(series, script=True)
+            page.write("</script>\n")
+        page.write(script)
+        page.write_json(chart_data if api_url is None else None, script=True)
+        page.write(script_end)
     
     print("Analytics dashboard has been generated as 'crime_analytics.html'")
 
 if __name__ == '__main__':
-    generate_dashboard()
+    parser = argparse.ArgumentParser(description="Generate the crime analytics dashboard")
+    parser.add_argument('--db', default=DB_PATH, help="SQLite database written by generate_db.py")
+    parser.add_argument('--from-rows', action='store_true',
+                        help="Count the incident rows instead of reading the crime_rollup table")
+    parser.add_argument('--chunk-size', type=int, help="With --from-rows, rows loaded per chunk")
+    parser.add_argument('--server', action='store_true',
+                        help="Have the page fetch its series from server.py instead of embedding them")
+    parser.add_argument('--api-url', default='',
+                        help="With --server, base URL of server.py when it does not serve the page itself")
+    parser.add_argument('--compress', nargs='+', choices=['gzip', 'brotli'], default=[],
+                        help="Also write crime_analytics.html.gz and/or .br for a web server to send as is")
+    args = parser.parse_args()
+    generate_dashboard(from_rows=args.from_rows, chunksize=args.chunk_size,
+                       api_url=args.api_url if args.server else None, compress=args.compress, db_path=args.db)
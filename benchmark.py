@@ -0,0 +1,195 @@
+import argparse
+import calendar
+import multiprocessing
+import os
+import random
+import resource
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+import analytics
+import dashboard
+import generate_db
+from crime_loader import load_crime_partitions
+from snapshot import write_snapshot
+
+CRIME_TYPES = [
+    'HOMICIDE',
+    'CRIMINAL SEXUAL ASSAULT',
+    'OFFENSE INVOLVING CHILDREN',
+    'HUMAN TRAFFICKING',
+    'BURGLARY',
+    'ARSON'
+]
+
+def make_synthetic_db(n_rows, seed=0):
+    """Build an in-memory filtered_crimes table with n_rows random incidents, in the ingest schema"""
+    rng = random.Random(seed)
+    conn = sqlite3.connect(':memory:')
+    generate_db.create_table(conn)
+
+    start = datetime(2020, 1, 1)
+    span = int((datetime(2025, 1, 1) - start).total_seconds())
+
+    def rows():
+        for i in range(n_rows):
+            date = start + timedelta(seconds=rng.randrange(span))
+            lat, lng = 41.65 + rng.random() * 0.37, -87.85 + rng.random() * 0.33
+            date_text = date.strftime(generate_db.DATE_FORMAT)
+            yield (i + 1, f"JH{i:07d}", date_text, f"0{rng.randint(0, 99):02d}XX W MADISON ST", '0610',
+                   rng.choice(CRIME_TYPES), 'FORCIBLE ENTRY', 'RESIDENCE', rng.randint(0, 1), rng.randint(0, 1),
+                   rng.randint(111, 2535), rng.randint(1, 25), rng.randint(1, 50), rng.randint(1, 77), '05',
+                   1100000 + rng.random() * 100000, 1800000 + rng.random() * 100000, date.year, date_text,
+                   lat, lng, f"({lat}, {lng})",
+                   date.strftime('%Y-%m-%d %H:%M:%S'), calendar.timegm(date.timetuple()),
+                   date.month, date.hour, date.weekday())
+
+    placeholders = ", ".join("?" for _ in generate_db.table_columns())
+    conn.executemany(f"INSERT INTO filtered_crimes VALUES ({placeholders})", rows())
+    conn.commit()
+    return conn
+
+def write_synthetic_db(n_rows, db_path):
+    """Save make_synthetic_db(n_rows) to a database file"""
+    conn = make_synthetic_db(n_rows)
+    with sqlite3.connect(db_path) as disk:
+        conn.backup(disk)
+    conn.close()
+
+def bench_dashboard(sizes):
+    """Time dashboard.load_crime_data and report per-row cost at each size"""
+    print(f"{'rows':>10} {'seconds':>10} {'us/row':>10}")
+    for n_rows in sizes:
+        conn = make_synthetic_db(n_rows)
+        start = time.perf_counter()
+        dashboard.load_crime_data(conn)
+        elapsed = time.perf_counter() - start
+        conn.close()
+        print(f"{n_rows:>10,} {elapsed:>10.3f} {elapsed / n_rows * 1e6:>10.2f}")
+
+def legacy_prepare_chart_data(df):
+    """prepare_chart_data as it was before the one-pass count cube, kept as a baseline"""
+    return {
+        'hourly': df.groupby(['Primary Type', 'hour']).size().unstack(fill_value=0).to_dict(),
+        'daily': df.groupby(['Primary Type', 'day_of_week']).size().unstack(fill_value=0).to_dict(),
+        'monthly': df.groupby(['Primary Type', 'month']).size().unstack(fill_value=0).to_dict(),
+        'area': df.groupby(['Primary Type', 'Community Area']).size().unstack(fill_value=0).to_dict(),
+        'time_blocks': {
+            crime: df[df['Primary Type'] == crime].groupby(pd.cut(df['hour'], [0, 6, 12, 18, 24], labels=['Night', 'Morning', 'Afternoon', 'Evening'])).size().to_dict()
+            for crime in df['Primary Type'].unique()
+        },
+        'weekend_comparison': df.groupby(['Primary Type', 'is_weekend']).size().unstack(fill_value=0).to_dict()
+    }
+
+def make_analytics_frame(n_rows, seed=0):
+    """Random frame shaped like analytics.load_and_process_data output"""
+    rng = np.random.default_rng(seed)
+    day_of_week = np.array(analytics.DAY_NAMES, dtype=object)[rng.integers(0, 7, n_rows)]
+    return pd.DataFrame({
+        'Primary Type': np.array(CRIME_TYPES, dtype=object)[rng.integers(0, len(CRIME_TYPES), n_rows)],
+        'hour': rng.integers(0, 24, n_rows),
+        'day_of_week': day_of_week,
+        'month': np.array(analytics.MONTH_NAMES, dtype=object)[rng.integers(0, 12, n_rows)],
+        'Community Area': rng.integers(1, 78, n_rows),
+        'is_weekend': np.isin(day_of_week, ['Saturday', 'Sunday'])
+    })
+
+def bench_chart_data(sizes):
+    """Time analytics.prepare_chart_data against the per-dimension groupby baseline"""
+    print(f"{'rows':>12} {'groupby s':>10} {'one-pass s':>11} {'speedup':>8}")
+    for n_rows in sizes:
+        df = make_analytics_frame(n_rows)
+        start = time.perf_counter()
+        legacy_prepare_chart_data(df)
+        legacy = time.perf_counter() - start
+        start = time.perf_counter()
+        analytics.prepare_chart_data(df)
+        one_pass = time.perf_counter() - start
+        print(f"{n_rows:>12,} {legacy:>10.2f} {one_pass:>11.2f} {legacy / one_pass:>7.1f}x")
+
+def legacy_load_and_process_data(db_path):
+    """analytics.load_and_process_data as it was before the compact loader, kept as a baseline"""
+    conn = sqlite3.connect(db_path)
+    df = pd.read_sql_query("SELECT * FROM filtered_crimes WHERE year >= 2020 AND year <= 2024", conn)
+    conn.close()
+    df['Date'] = pd.to_datetime(df['Date'], format=generate_db.DATE_FORMAT)
+    df['hour'] = df['Date'].dt.hour
+    df['day_of_week'] = df['Date'].dt.day_name()
+    df['month'] = df['Date'].dt.month_name()
+    df['year'] = df['Date'].dt.year
+    df['is_weekend'] = df['day_of_week'].isin(['Saturday', 'Sunday'])
+    return df
+
+LOADERS = {
+    'SELECT * + names': lambda db_path: legacy_load_and_process_data(db_path),
+    'compact': lambda db_path: analytics.load_and_process_data(db_path),
+    'compact, chunked': lambda db_path: analytics.load_and_process_data(db_path, chunksize=100_000),
+}
+
+def measure_loader(name, db_path):
+    """Run one loader and return (MB resident before, peak MB, frame MB); meant for a fresh process"""
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    df = LOADERS[name](db_path)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux
+    return before / 1024, peak / 1024, df.memory_usage(deep=True).sum() / 2**20
+
+def bench_loader_memory(sizes):
+    """Peak RSS of the analytics loaders, each run in a freshly spawned interpreter"""
+    print(f"{'rows':>10} {'loader':>18} {'peak MB':>9} {'load MB':>9} {'frame MB':>9}")
+    context = multiprocessing.get_context('spawn')
+    for n_rows in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'filtered_crimes.db')
+            write_synthetic_db(n_rows, db_path)
+            for name in LOADERS:
+                with context.Pool(1) as pool:
+                    before, peak, frame = pool.apply(measure_loader, (name, db_path))
+                print(f"{n_rows:>10,} {name:>18} {peak:>9.0f} {peak - before:>9.0f} {frame:>9.1f}")
+
+SNAPSHOT_QUERIES = {
+    'all rows, all columns': {},
+    'one year, one type': {'columns': ['Date', 'Latitude', 'Longitude'], 'years': [2022], 'crime_types': ['BURGLARY']},
+    'chart columns': {'columns': analytics.CHART_COLUMNS, 'years': range(2020, 2025), 'compact': True},
+}
+
+def bench_snapshot(sizes):
+    """Time load_crime_partitions from SQLite and from parquet and arrow snapshots"""
+    print(f"{'rows':>10} {'query':>22} {'sqlite s':>9} {'parquet s':>10} {'arrow s':>8}")
+    for n_rows in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'crimes.db')
+            write_synthetic_db(n_rows, db_path)
+            timings = {name: [] for name in SNAPSHOT_QUERIES}
+            for source in ('sqlite', 'parquet', 'arrow'):
+                if source != 'sqlite':
+                    write_snapshot(db_path, file_format=source)
+                for name, query in SNAPSHOT_QUERIES.items():
+                    start = time.perf_counter()
+                    load_crime_partitions(db_path=db_path, **query)
+                    timings[name].append(time.perf_counter() - start)
+            for name, (sqlite_s, parquet_s, arrow_s) in timings.items():
+                print(f"{n_rows:>10,} {name:>22} {sqlite_s:>9.2f} {parquet_s:>10.2f} {arrow_s:>8.2f}")
+
+BENCHMARKS = {
+    'dashboard': (bench_dashboard, [100_000, 200_000, 400_000, 800_000]),
+    'chart_data': (bench_chart_data, [1_000_000, 5_000_000, 10_000_000]),
+    'loader_memory': (bench_loader_memory, [250_000, 1_000_000]),
+    'snapshot': (bench_snapshot, [1_000_000]),
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the RogueMap data pipelines on synthetic data")
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--sizes', type=int, nargs='+', help="Row counts to benchmark")
+    args = parser.parse_args()
+    bench, default_sizes = BENCHMARKS[args.benchmark]
+    bench(args.sizes or default_sizes)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+import argparse
+import sqlite3
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+import analytics
+import chart
+import dashboard
+from build_state import save_state
+from crime_loader import load_crime_partitions
+
+# Builds crime_map.html, crime_analytics.html and crimes_by_time.png from one
+# read of the incidents. The columns are loaded once, copied into shared
+# memory blocks, and a process pool renders the three outputs side by side
+# from views of those blocks, so a full rebuild takes about as long as the
+# slowest output rather than the sum of all three. Text columns travel as
+# int32 codes into a string table and missing integers as -1, which keeps
+# every shared column a flat NumPy array.
+
+LOAD_COLUMNS = ['ID', 'Primary Type', 'Latitude', 'Longitude', 'Date', 'Year', 'Block', 'Description',
+                'Arrest', 'Community Area', 'hour', 'dow', 'month']
+TEXT_COLUMNS = ['Primary Type', 'Block', 'Description']
+INT_COLUMNS = ['Date', 'Year', 'Community Area', 'hour', 'dow', 'month']
+
+MISSING = -1
+
+CHART_TYPES = ['OFFENSE INVOLVING CHILDREN', 'CRIMINAL SEXUAL ASSAULT']
+
+def load_columns(db_path):
+    """Read the columns every output needs, once, as ({name: array}, {name: strings}, max ID).
+
+    Rows are put in ID order, the order a plain scan of filtered_crimes
+    returns them in. Text columns become codes into a sorted string table
+    (-1 when missing) and Date becomes epoch seconds.
+    """
+    df = load_crime_partitions(LOAD_COLUMNS, db_path=db_path)
+    order = np.argsort(df['ID'].to_numpy(), kind='stable')
+    df = df.iloc[order].reset_index(drop=True)
+    df['Date'] = (df['Date'] - pd.Timestamp(0)) // pd.Timedelta(seconds=1)
+
+    columns = {}
+    strings = {}
+    for name in TEXT_COLUMNS:
+        codes, uniques = pd.factorize(df[name], sort=True)
+        columns[name] = codes.astype(np.int32)
+        strings[name] = list(uniques)
+    for name in INT_COLUMNS:
+        columns[name] = df[name].fillna(MISSING).to_numpy(dtype=np.int64)
+    columns['Latitude'] = df['Latitude'].to_numpy(dtype=np.float64, na_value=np.nan)
+    columns['Longitude'] = df['Longitude'].to_numpy(dtype=np.float64, na_value=np.nan)
+    columns['Arrest'] = df['Arrest'].fillna(False).to_numpy(dtype=bool)
+    max_id = int(df['ID'].iloc[-1]) if len(df) else 0
+    return columns, strings, max_id
+
+def share_columns(columns):
+    """Copy arrays into shared memory; returns the blocks and the specs attach_columns() takes"""
+    blocks = []
+    specs = {}
+    for name, array in columns.items():
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[:] = array
+        blocks.append(block)
+        specs[name] = (block.name, array.dtype.str, array.shape)
+    return blocks, specs
+
+# Blocks a worker has attached stay open for as long as its views are in use
+_attached = []
+
+def attach_columns(specs):
+    """Read-only views of shared columns, from inside a worker process"""
+    columns = {}
+    for name, (block_name, dtype, shape) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _attached.append(block)
+        columns[name] = np.ndarray(shape, dtype, buffer=block.buf)
+        columns[name].flags.writeable = False
+    return columns
+
+def build_map(specs, strings, options):
+    """Render crime_map.html the way dashboard.py does; returns seconds taken"""
+    start = time.perf_counter()
+    columns = attach_columns(specs)
+    types = strings['Primary Type']
+    # A trailing None makes code -1 decode to None with plain indexing
+    blocks = strings['Block'] + [None]
+    descriptions = strings['Description'] + [None]
+    located = ~np.isnan(columns['Latitude']) & ~np.isnan(columns['Longitude'])
+
+    crime_types = list(types)
+    crime_data = {crime_type: {"crimes": []} for crime_type in crime_types}
+    cube_counts = Counter()
+    rows = zip(*(columns[name][located].tolist() for name in
+                 ['Primary Type', 'Latitude', 'Longitude', 'Date', 'Year', 'Block', 'Description', 'Arrest']))
+    for ptype, lat, lng, epoch, year, block, desc, arrest in rows:
+        crime_type = types[ptype]
+        epoch = epoch if epoch != MISSING else None
+        year = year if year != MISSING else None
+        crime_data[crime_type]["crimes"].append(dashboard.crime_record(lat, lng, epoch, year, blocks[block],
+                                                                       descriptions[desc], int(arrest)))
+        cube_counts[crime_type, year, int(arrest)] += 1
+
+    # The same cube dashboard.load_count_cube builds from the rollup's (type, year, arrest, count) rows,
+    # in the rollup's order with unknown years first
+    cube_rows = sorted(cube_counts.items(), key=lambda item: (item[0][0], item[0][1] is not None, item[0][1] or 0,
+                                                              item[0][2]))
+    count_cube = dashboard.build_count_cube(
+        crime_types, ((crime_type, year, arrest, count) for (crime_type, year, arrest), count in cube_rows)
+    )
+
+    dashboard.render_map(crime_types, crime_data, count_cube, **options)
+    return time.perf_counter() - start
+
+def build_analytics(specs, types, compress=()):
+    """Render crime_analytics.html from 2020-2024 crimes; returns seconds taken"""
+    start = time.perf_counter()
+    columns = attach_columns(specs)
+    in_range = (columns['Year'] >= 2020) & (columns['Year'] <= 2024)
+
+    def nullable(name):
+        values = columns[name][in_range]
+        return pd.arrays.IntegerArray(values, values == MISSING)
+
+    month = columns['month'][in_range]
+    df = pd.DataFrame({
+        'Primary Type': pd.Categorical.from_codes(columns['Primary Type'][in_range], types),
+        'Community Area': nullable('Community Area'),
+        'hour': nullable('hour'),
+        'day_of_week': pd.Categorical.from_codes(columns['dow'][in_range], analytics.DAY_NAMES),
+        'month': pd.Categorical.from_codes(np.where(month == MISSING, MISSING, month - 1), analytics.MONTH_NAMES),
+        'Year': columns['Year'][in_range],
+        'Arrest': columns['Arrest'][in_range],
+    })
+    series = analytics.filter_cube(df)
+    type_counts = {crime_type: int(count) for crime_type, count in df['Primary Type'].value_counts().items() if count}
+    analytics.write_dashboard(None, type_counts, series=series, compress=compress)
+    return time.perf_counter() - start
+
+def build_chart(specs, types):
+    """Render crimes_by_time.png; returns seconds taken"""
+    start = time.perf_counter()
+    columns = attach_columns(specs)
+
+    def hourly(crime_type):
+        code = types.index(crime_type) if crime_type in types else -2
+        hours = columns['hour'][(columns['Primary Type'] == code) & (columns['hour'] != MISSING)]
+        counts = np.bincount(hours, minlength=24)
+        seen = np.flatnonzero(counts)
+        return pd.Series(counts[seen], index=seen)
+
+    chart.plot_hourly(*(hourly(crime_type) for crime_type in CHART_TYPES))
+    return time.perf_counter() - start
+
+def main(db_path='crimes.db', map_options=None, compress=()):
+    timings = {}
+    build_start = time.perf_counter()
+
+    start = time.perf_counter()
+    columns, strings, max_id = load_columns(db_path)
+    timings['load'] = time.perf_counter() - start
+    print(f"Loaded {len(columns['Year']):,} crimes")
+
+    start = time.perf_counter()
+    blocks, specs = share_columns(columns)
+    del columns
+    timings['share'] = time.perf_counter() - start
+
+    types = strings['Primary Type']
+    try:
+        with ProcessPoolExecutor(max_workers=3) as pool:
+            futures = {
+                'crime_map.html': pool.submit(build_map, specs, strings, {**(map_options or {}), "compress": compress}),
+                'crime_analytics.html': pool.submit(build_analytics, specs, types, compress),
+                'crimes_by_time.png': pool.submit(build_chart, specs, types),
+            }
+            for output, future in futures.items():
+                timings[output] = future.result()
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    if (map_options or {}).get("export_mode") == 'tiles':
+        # The point files now hold every crime loaded, as after a full dashboard.py tiles build
+        conn = sqlite3.connect(db_path)
+        save_state(conn, dashboard.state_key(map_options.get("data_dir", 'crime_map_data')), max_id)
+        conn.close()
+
+    total = time.perf_counter() - build_start
+    outputs = [timings[output] for output in futures]
+    print(f"\n{'stage':>22} {'seconds':>8}")
+    for stage, seconds in timings.items():
+        print(f"{stage:>22} {seconds:>8.2f}")
+    print(f"{'total wall time':>22} {total:>8.2f}  (outputs alone would take {sum(outputs):.2f} in a row)")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the map, analytics page and hourly chart from one data load")
+    parser.add_argument('--db', default='crimes.db', help="SQLite database to read")
+    parser.add_argument('--export', choices=['inline', 'tiles'], default='inline',
+                        help="Embed all map points in the page, or write per-type/per-year files next to it")
+    parser.add_argument('--data-dir', default='crime_map_data', help="Directory for point files in tiles mode")
+    parser.add_argument('--format', choices=['json', 'columnar'], default='json',
+                        help="Encoding of point files in tiles mode")
+    parser.add_argument('--clusters', action='store_true', help="Precompute per-zoom map clusters")
+    parser.add_argument('--heat-grids', action='store_true', help="Feed the heatmap pre-binned density grids")
+    parser.add_argument('--renderer', choices=['markers', 'canvas'], default='markers',
+                        help="Draw map points as clustered markers or on one canvas layer")
+    parser.add_argument('--compress', nargs='+', choices=['gzip', 'brotli'], default=[],
+                        help="Also write .gz and/or .br copies of both pages")
+    args = parser.parse_args()
+    if args.format == 'columnar' and args.export != 'tiles':
+        parser.error("--format columnar requires --export tiles")
+    main(args.db, {"export_mode": args.export, "data_dir": args.data_dir, "data_format": args.format,
+                   "clusters": args.clusters, "heat_grids": args.heat_grids,
+                   "renderer": args.renderer}, compress=args.compress)
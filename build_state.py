@@ -0,0 +1,42 @@
+import json
+
+# Incremental builds remember, per output, the highest incident ID they have
+# already folded in along with the options the output was built with. New
+# Chicago incidents always get a larger ID, so rows above the watermark are
+# exactly the ones a rebuild still has to read. Edits to rows below it
+# (e.g. a late arrest) are only picked up by a full rebuild.
+
+def ensure_state_table(conn):
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(build_state)")]
+    if columns and 'options' not in columns:
+        # Older versions kept merged aggregates here; losing the watermark only forces a full build
+        conn.execute("DROP TABLE build_state")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS build_state (
+            output TEXT PRIMARY KEY,
+            max_id INTEGER NOT NULL,
+            options TEXT
+        )
+    """)
+
+def current_max_id(conn):
+    """Highest incident ID currently in filtered_crimes, or 0 when empty"""
+    return conn.execute("SELECT COALESCE(MAX(ID), 0) FROM filtered_crimes").fetchone()[0]
+
+def load_state(conn, output):
+    """Return (max_id, options) recorded for an output, or (None, None)"""
+    ensure_state_table(conn)
+    row = conn.execute(
+        "SELECT max_id, options FROM build_state WHERE output = ?", (output,)
+    ).fetchone()
+    if row is None:
+        return None, None
+    return row[0], json.loads(row[1]) if row[1] is not None else None
+
+def save_state(conn, output, max_id, options=None):
+    ensure_state_table(conn)
+    conn.execute(
+        "INSERT OR REPLACE INTO build_state (output, max_id, options) VALUES (?, ?, ?)",
+        (output, max_id, json.dumps(options) if options is not None else None)
+    )
+    conn.commit()
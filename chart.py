@@ -1,34 +1,32 @@
 import sqlite3
-import pandas as pd
+
 import matplotlib.pyplot as plt
-from datetime import datetime
+import pandas as pd
+
+from rollup import ensure_rollup_table, rollup_counts
+
+def hourly_counts(counts, crime_type):
+    """Incidents per hour of one crime type, indexed by hour"""
+    rows = counts[(counts['Primary Type'] == crime_type) & counts['Hour'].notna()]
+    return rows.set_index(rows['Hour'].astype(int))['count'].sort_index()
 
 def main():
-    # Connect to database
+    # Get hourly counts of the relevant crimes from the rollup
     conn = sqlite3.connect('crimes.db')
-    
-    # Query to get relevant crimes and their times
-    query = """
-    SELECT 
-        `Primary Type`,
-        Date
-    FROM filtered_crimes
-    WHERE `Primary Type` IN (
-        'OFFENSE INVOLVING CHILDREN',
-        'CRIMINAL SEXUAL ASSAULT'
+    ensure_rollup_table(conn)
+    counts = pd.DataFrame(
+        rollup_counts(conn, ('type', 'hour'), type=['OFFENSE INVOLVING CHILDREN', 'CRIMINAL SEXUAL ASSAULT']),
+        columns=['Primary Type', 'Hour', 'count']
     )
-    """
-    
-    # Read data into DataFrame
-    df = pd.read_sql_query(query, conn)
-    
-    # Convert Date string to datetime and extract hour
-    df['Hour'] = df['Date'].apply(lambda x: datetime.strptime(x, '%m/%d/%Y %I:%M:%S %p').hour)
+    conn.close()
     
     # Create separate series for each crime type
-    children_crimes = df[df['Primary Type'] == 'OFFENSE INVOLVING CHILDREN']['Hour'].value_counts().sort_index()
-    sexual_assault = df[df['Primary Type'] == 'CRIMINAL SEXUAL ASSAULT']['Hour'].value_counts().sort_index()
-    
+    children_crimes = hourly_counts(counts, 'OFFENSE INVOLVING CHILDREN')
+    sexual_assault = hourly_counts(counts, 'CRIMINAL SEXUAL ASSAULT')
+    plot_hourly(children_crimes, sexual_assault)
+
+def plot_hourly(children_crimes, sexual_assault):
+    """Save crimes_by_time.png from two hour-indexed count series and print their peaks"""
     # Create the plot
     plt.figure(figsize=(15, 8))
     
@@ -75,8 +73,6 @@ def main():
     print("\nCriminal Sexual Assault:")
     print(f"Peak hour: {sexual_assault.idxmax():02d}:00 with {sexual_assault.max()} incidents")
     print(f"Lowest hour: {sexual_assault.idxmin():02d}:00 with {sexual_assault.min()} incidents")
-    
-    conn.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,147 @@
+import numpy as np
+import pandas as pd
+
+# Spatial clusters of incidents, kept in the database so re-runs don't redo
+# them. cluster_centroids holds the fitted centres per cluster count and
+# crime_clusters the cluster of every incident assigned so far. A run only
+# assigns incidents with no cached cluster, by nearest saved centroid, so its
+# cost follows the number of new rows. Refitting starts from the saved
+# centroids, which keeps cluster numbers stable and the result deterministic.
+# generate_db.py forgets the cached cluster of any incident it moves.
+
+ASSIGN_CHUNK = 1_000_000
+
+def ensure_cluster_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS cluster_centroids (
+            n_clusters INTEGER NOT NULL,
+            cluster INTEGER NOT NULL,
+            latitude REAL NOT NULL,
+            longitude REAL NOT NULL,
+            PRIMARY KEY (n_clusters, cluster)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS crime_clusters (
+            n_clusters INTEGER NOT NULL,
+            ID INTEGER NOT NULL,
+            cluster INTEGER NOT NULL,
+            PRIMARY KEY (ID, n_clusters)
+        ) WITHOUT ROWID
+    """)
+
+def load_centroids(conn, n_clusters):
+    """Saved (n_clusters, 2) lat/lng centroids, or None"""
+    rows = conn.execute(
+        "SELECT latitude, longitude FROM cluster_centroids WHERE n_clusters = ? ORDER BY cluster", (n_clusters,)
+    ).fetchall()
+    return np.array(rows) if len(rows) == n_clusters else None
+
+def save_centroids(conn, centroids):
+    conn.execute("DELETE FROM cluster_centroids WHERE n_clusters = ?", (len(centroids),))
+    conn.executemany(
+        "INSERT INTO cluster_centroids VALUES (?, ?, ?, ?)",
+        ((len(centroids), i, float(lat), float(lng)) for i, (lat, lng) in enumerate(centroids))
+    )
+
+def fit_centroids(points, n_clusters, init=None, minibatch=False, batch_size=10_000):
+    """Fit lat/lng centroids, warm-started from init when given.
+
+    minibatch streams the points through MiniBatchKMeans.partial_fit in
+    batch_size slices instead of running full-batch KMeans.
+    """
+    # Imported here so generate_db.py can use forget_assignments() without scikit-learn
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+
+    # A warm start has exactly one initialisation to run
+    warm = {'init': init, 'n_init': 1} if init is not None else {}
+    if not minibatch:
+        return KMeans(n_clusters=n_clusters, random_state=0, **warm).fit(points).cluster_centers_
+
+    model = MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size, random_state=0, **warm)
+    for batch_start in range(0, len(points), batch_size):
+        batch = points[batch_start:batch_start + batch_size]
+        # The first partial_fit has to see at least n_clusters points
+        if batch_start == 0 and len(batch) < n_clusters:
+            batch = points[:n_clusters]
+        model.partial_fit(batch)
+    return model.cluster_centers_
+
+def assign(points, centroids):
+    """Index of the nearest centroid of each point, computed a chunk at a time"""
+    labels = np.empty(len(points), dtype=np.int64)
+    for start in range(0, len(points), ASSIGN_CHUNK):
+        chunk = points[start:start + ASSIGN_CHUNK]
+        distances = ((chunk[:, None, :] - centroids[None, :, :]) ** 2).sum(axis=2)
+        labels[start:start + ASSIGN_CHUNK] = distances.argmin(axis=1)
+    return labels
+
+def cached_assignments(conn, n_clusters):
+    """Series of cached cluster numbers indexed by incident ID"""
+    return pd.read_sql_query(
+        "SELECT ID, cluster FROM crime_clusters WHERE n_clusters = ?", conn, params=(n_clusters,), index_col='ID'
+    )['cluster']
+
+def save_assignments(conn, n_clusters, ids, labels, replace_all=False):
+    if replace_all:
+        conn.execute("DELETE FROM crime_clusters WHERE n_clusters = ?", (n_clusters,))
+    conn.executemany(
+        "INSERT OR REPLACE INTO crime_clusters VALUES (?, ?, ?)",
+        ((n_clusters, crime_id, label) for crime_id, label in zip(ids.tolist(), labels.tolist()))
+    )
+
+def forget_assignments(conn, chunk):
+    """Drop cached clusters of the chunk's incidents that are new or whose coordinates changed.
+
+    Called before the chunk is upserted, so the stored coordinates are
+    still the old ones. Re-ingesting an export keeps every unmoved
+    incident's cached cluster.
+    """
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'crime_clusters'"
+    ).fetchone()
+    if not exists:
+        return
+
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS cluster_ids (id INTEGER PRIMARY KEY)")
+    conn.execute("DELETE FROM cluster_ids")
+    conn.executemany("INSERT OR IGNORE INTO cluster_ids VALUES (?)", ((int(i),) for i in chunk['ID']))
+    stored = pd.read_sql_query(
+        "SELECT ID, Latitude, Longitude FROM filtered_crimes WHERE ID IN (SELECT id FROM cluster_ids)",
+        conn, index_col='ID'
+    )
+    merged = chunk[['ID', 'Latitude', 'Longitude']].join(stored, on='ID', rsuffix='_stored')
+    unmoved = merged['ID'].isin(stored.index)
+    for column in ('Latitude', 'Longitude'):
+        new, old = merged[column].astype('float64'), merged[column + '_stored'].astype('float64')
+        unmoved &= (new == old) | (new.isna() & old.isna())
+    conn.executemany("DELETE FROM crime_clusters WHERE ID = ?", ((int(i),) for i in merged.loc[~unmoved, 'ID']))
+
+def cluster_incidents(conn, ids, points, n_clusters, minibatch=False, refit=False):
+    """Cluster number of every incident, using and updating the database cache.
+
+    Without saved centroids, or with refit, centroids are fitted (warm from
+    any saved ones) and every incident is reassigned. Otherwise only the
+    incidents missing from the cache are assigned to the saved centroids.
+    """
+    ensure_cluster_tables(conn)
+    ids = np.asarray(ids)
+    centroids = load_centroids(conn, n_clusters)
+
+    if centroids is None or refit:
+        centroids = fit_centroids(points, n_clusters, init=centroids, minibatch=minibatch)
+        labels = assign(points, centroids)
+        save_centroids(conn, centroids)
+        save_assignments(conn, n_clusters, ids, labels, replace_all=True)
+        conn.commit()
+        print(f"Fitted {n_clusters} clusters and assigned {len(ids):,} crimes")
+        return labels
+
+    cached = cached_assignments(conn, n_clusters).reindex(ids)
+    new = cached.isna().to_numpy()
+    labels = cached.fillna(-1).to_numpy(dtype=np.int64, copy=True)
+    labels[new] = assign(points[new], centroids)
+    save_assignments(conn, n_clusters, ids[new], labels[new])
+    conn.commit()
+    print(f"Assigned {new.sum():,} new crimes to the saved clusters")
+    return labels
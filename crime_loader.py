@@ -0,0 +1,127 @@
+import sqlite3
+
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from generate_db import COLUMNS as EXPORT_COLUMNS
+from snapshot import has_snapshot, read_snapshot, snapshot_dir_for
+
+# Every script reads incidents through here. generate_db.py parses the Chicago
+# date text once at ingest and stores it as epoch seconds plus Year, month,
+# hour and dow, so loading never has to run strptime over the rows again.
+# Scripts that select by year and crime type use load_crime_partitions(),
+# which reads the columnar snapshot from snapshot.py when it is up to date.
+
+DB_PATH = 'crimes.db'
+
+# Memory-lean dtypes for load_crimes(compact=True). Repetitive text becomes
+# categorical, calendar fields and small codes shrink to 8/16-bit integers
+# (nullable where the export can leave them blank) and coordinates drop to
+# float32, which still resolves about a metre.
+COMPACT_DTYPES = {
+    'Primary Type': 'category',
+    'Block': 'category',
+    'IUCR': 'category',
+    'Description': 'category',
+    'Location Description': 'category',
+    'FBI Code': 'category',
+    'Arrest': 'bool',
+    'Domestic': 'bool',
+    'Beat': 'Int16',
+    'District': 'Int8',
+    'Ward': 'Int8',
+    'Community Area': 'Int8',
+    'X Coordinate': 'float32',
+    'Y Coordinate': 'float32',
+    'Year': 'Int16',
+    'Latitude': 'float32',
+    'Longitude': 'float32',
+    'month': 'Int8',
+    'hour': 'Int8',
+    'dow': 'Int8',
+}
+
+def compact_frame(df):
+    """Cast the columns of df named in COMPACT_DTYPES to their compact dtype"""
+    return df.astype({column: dtype for column, dtype in COMPACT_DTYPES.items() if column in df})
+
+def concat_compact(chunks):
+    """Concatenate compact chunks, merging categoricals that saw different values"""
+    if len(chunks) == 1:
+        return chunks[0]
+    df = pd.concat(chunks, ignore_index=True)
+    for column in chunks[0].columns:
+        if isinstance(chunks[0][column].dtype, pd.CategoricalDtype):
+            df[column] = union_categoricals([chunk[column] for chunk in chunks])
+    return df
+
+def load_crimes(columns=None, where=None, params=(), db_path=DB_PATH, compact=False, chunksize=None):
+    """Load filtered_crimes into a DataFrame with dates already typed.
+
+    columns lists the columns to read and defaults to every column of the
+    Chicago export. Date comes back as datetime64, rebuilt from the stored
+    epoch seconds rather than parsed from text. where is an SQL condition
+    whose ? placeholders are filled from params.
+
+    compact=True casts columns to COMPACT_DTYPES. With chunksize the rows
+    are read and compacted that many at a time, so the full-width object
+    columns never exist for more than one chunk.
+    """
+    if columns is None:
+        columns = list(EXPORT_COLUMNS)
+    selected = ['epoch' if column == 'Date' else column for column in columns]
+
+    query = "SELECT " + ", ".join(f'"{column}"' for column in selected) + " FROM filtered_crimes"
+    if where:
+        query += f" WHERE {where}"
+
+    conn = sqlite3.connect(db_path)
+    if chunksize:
+        chunks = [
+            compact_frame(chunk) if compact else chunk
+            for chunk in pd.read_sql_query(query, conn, params=list(params), chunksize=chunksize)
+        ]
+        df = concat_compact(chunks) if chunks else pd.DataFrame(columns=selected)
+    else:
+        df = pd.read_sql_query(query, conn, params=list(params))
+        if compact:
+            df = compact_frame(df)
+    conn.close()
+
+    if 'Date' in columns:
+        df['epoch'] = pd.to_datetime(df['epoch'], unit='s')
+        df = df.rename(columns={'epoch': 'Date'})
+    return df
+
+def load_crime_partitions(columns=None, years=None, crime_types=None, located=False, db_path=DB_PATH,
+                          compact=False, chunksize=None):
+    """Load the crimes of some years and types, from the columnar snapshot when there is one.
+
+    years and crime_types select whole partitions of the snapshot and
+    located keeps only incidents with coordinates; None means no
+    restriction. Without a snapshot (or pyarrow) the same rows come from
+    load_crimes(), where compact and chunksize apply as there. Either way
+    Date is datetime64 and only the named columns are read.
+    """
+    if columns is None:
+        columns = list(EXPORT_COLUMNS)
+
+    snapshot_dir = snapshot_dir_for(db_path)
+    if has_snapshot(snapshot_dir, db_path):
+        table = read_snapshot(snapshot_dir, columns, years, crime_types, located)
+        df = table.to_pandas(strings_to_categorical=compact, self_destruct=True)
+        return compact_frame(df) if compact else df
+
+    conditions = []
+    params = []
+    if years is not None:
+        years = list(years)
+        conditions.append(f"Year IN ({', '.join('?' for _ in years)})")
+        params.extend(years)
+    if crime_types is not None:
+        crime_types = list(crime_types)
+        conditions.append(f'"Primary Type" IN ({", ".join("?" for _ in crime_types)})')
+        params.extend(crime_types)
+    if located:
+        conditions.append("Latitude IS NOT NULL AND Longitude IS NOT NULL")
+    return load_crimes(columns, " AND ".join(conditions) or None, params, db_path, compact, chunksize)
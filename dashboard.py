@@ -1,58 +1,606 @@
-import sqlite3
+import argparse
 import json
-from datetime import datetime
+import math
+import os
+import re
+import shutil
+import sqlite3
+import sys
+from array import array
 
-def parse_date(date_str):
-    try:
-        return datetime.strptime(date_str, '%m/%d/%Y %I:%M:%S %p').year
-    except:
-        return None
+import numpy as np
 
-def main():
-    # Connect to the database
-    conn = sqlite3.connect('crimes.db')
-    cursor = conn.cursor()
+from build_state import current_max_id, load_state, save_state
+from page_writer import PageWriter
+from rollup import ensure_rollup_table, rollup_counts
 
-    # Get distinct crime types
-    cursor.execute("""
+def load_crime_types(conn):
+    """Distinct crime types, sorted (answered from the type/year index)"""
+    return [row[0] for row in conn.execute("""
         SELECT DISTINCT `Primary Type`
         FROM filtered_crimes
         ORDER BY `Primary Type`
-    """)
-    crime_types = [row[0] for row in cursor.fetchall()]
+    """)]
+
+# Rows fetched at a time when the inline page is written straight from the database
+ROW_BATCH = 10_000
+
+def crime_record(lat, lng, epoch, year, block, desc, arrest):
+    """One crime as the map page reads it"""
+    return {
+        "lat": lat,
+        "lng": lng,
+        "epoch": epoch,
+        "year": year,
+        "block": block,
+        "description": desc,
+        "arrest": "Yes" if arrest == 1 else "No"
+    }
+
+def iter_crimes(conn, crime_type, batch_size=ROW_BATCH):
+    """Geocoded crimes of one type in year order (unknown first), fetched batch_size rows at a time"""
+    cursor = conn.execute("""
+        SELECT Latitude, Longitude, epoch, Year, Block, Description, Arrest
+        FROM filtered_crimes
+        WHERE `Primary Type` = ? AND Latitude IS NOT NULL AND Longitude IS NOT NULL
+        ORDER BY Year
+    """, (crime_type,))
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        for row in rows:
+            yield crime_record(*row)
+
+def in_year_order(crimes):
+    """crimes sorted by year as iter_crimes() yields them; streamed crimes are left as they are"""
+    if not isinstance(crimes, list):
+        return crimes
+    return sorted(crimes, key=lambda crime: (crime["year"] is not None, crime["year"] or 0))
+
+def load_crime_data(conn, min_id=None, max_id=None):
+    """Group geocoded crimes by type in a single streaming pass over the cursor.
+
+    min_id/max_id restrict the points to min_id < ID <= max_id for
+    incremental builds.
+    """
+    cursor = conn.cursor()
+    crime_types = load_crime_types(conn)
+
+    crime_data = {
+        crime_type: {"crimes": []}
+        for crime_type in crime_types
+    }
+
+    id_filter = ""
+    params = []
+    if min_id is not None:
+        id_filter += " AND ID > ?"
+        params.append(min_id)
+    if max_id is not None:
+        id_filter += " AND ID <= ?"
+        params.append(max_id)
 
     # Query to get the required fields including the Arrest column
-    cursor.execute("""
-        SELECT `Primary Type`, Latitude, Longitude, Date, Block, Description, Arrest
+    cursor.execute(f"""
+        SELECT `Primary Type`, Latitude, Longitude, epoch, Year,
+               Block, Description, Arrest
         FROM filtered_crimes
         WHERE Latitude IS NOT NULL 
-        AND Longitude IS NOT NULL
-    """)
-    crimes = cursor.fetchall()
-    
-    # Process data and add arrest status
-    crime_data = {}
+        AND Longitude IS NOT NULL{id_filter}
+    """, params)
+
+    # Bucket each row as it streams off the cursor instead of rescanning
+    # the full result once per crime type
+    for (ptype, lat, lng, epoch, year, block, desc, arrest) in cursor:
+        crime_data[ptype]["crimes"].append(crime_record(lat, lng, epoch, year, block, desc, arrest))
+
+    return crime_types, crime_data
+
+def load_count_cube(conn, crime_types):
+    """Count geocoded crimes as {type: {year: [total, arrests]}} from crime_rollup.
+
+    Each type also gets an 'all' entry, so the page can fill its sidebar
+    without rescanning the points.
+    """
+    ensure_rollup_table(conn)
+    return build_count_cube(crime_types, rollup_counts(conn, ('type', 'year', 'arrest'), located=1))
+
+def build_count_cube(crime_types, rows):
+    """{type: {year: [total, arrests]}} from (type, year, arrest, count) rows"""
+    count_cube = {crime_type: {"all": [0, 0]} for crime_type in crime_types}
+    for crime_type, year, arrest, count in rows:
+        counts = count_cube.setdefault(crime_type, {"all": [0, 0]})
+        year_counts = counts.setdefault(str(year) if year is not None else 'unknown', [0, 0])
+        for cell in (counts["all"], year_counts):
+            cell[0] += count
+            if arrest == 1:
+                cell[1] += count
+    return count_cube
+
+def type_slug(crime_type):
+    """Filesystem-safe directory name for a crime type"""
+    return re.sub(r'[^a-z0-9]+', '_', crime_type.lower()).strip('_')
+
+# Columnar slices store coordinates as int32 millionths of a degree (~0.1m)
+COORD_SCALE = 1_000_000
+
+# Column order and array typecodes of a columnar slice. For n rows the file
+# holds each column's n values back to back, little-endian, followed by the
+# arrest flags bit-packed into ceil(n / 8) bytes. Block and description are
+# indexes into the shared string tables.
+COLUMNAR_LAYOUT = [
+    ('lat', 'i'),
+    ('lng', 'i'),
+    ('block', 'I'),
+    ('description', 'I'),
+    ('date', 'I'),
+    ('year', 'H')
+]
+
+def columnar_columns(crimes, block_ids, description_ids):
+    """Column arrays for a slice, assigning new string ids as needed"""
+    return {
+        'lat': array('i', (round(crime["lat"] * COORD_SCALE) for crime in crimes)),
+        'lng': array('i', (round(crime["lng"] * COORD_SCALE) for crime in crimes)),
+        'block': array('I', (block_ids.setdefault(crime["block"], len(block_ids)) for crime in crimes)),
+        'description': array('I', (description_ids.setdefault(crime["description"], len(description_ids))
+                                   for crime in crimes)),
+        'date': array('I', (crime["epoch"] or 0 for crime in crimes)),
+        'year': array('H', (crime["year"] or 0 for crime in crimes)),
+        'arrest': [1 if crime["arrest"] == "Yes" else 0 for crime in crimes]
+    }
+
+def pack_columnar(columns):
+    arrest = bytearray((len(columns['arrest']) + 7) // 8)
+    for i, flag in enumerate(columns['arrest']):
+        if flag:
+            arrest[i >> 3] |= 1 << (i & 7)
+
+    parts = []
+    for name, typecode in COLUMNAR_LAYOUT:
+        column = columns[name]
+        if sys.byteorder == 'big':
+            column = array(typecode, column)
+            column.byteswap()
+        parts.append(column.tobytes())
+    return b''.join(parts) + bytes(arrest)
+
+def unpack_columnar(data, count):
+    columns = {}
+    offset = 0
+    for name, typecode in COLUMNAR_LAYOUT:
+        column = array(typecode)
+        size = column.itemsize * count
+        column.frombytes(data[offset:offset + size])
+        if sys.byteorder == 'big':
+            column.byteswap()
+        columns[name] = column
+        offset += size
+    columns['arrest'] = [(data[offset + (i >> 3)] >> (i & 7)) & 1 for i in range(count)]
+    return columns
+
+# Zoom levels served as precomputed clusters; the page switches to
+# individual markers once zoomed in past the last one
+CLUSTER_ZOOMS = range(8, 16)
+CLUSTER_CELL_PX = 60
+
+def mercator_px(lat, lng, zoom):
+    """Web Mercator pixel coordinates of a point at the given zoom level"""
+    scale = 256 * 2 ** zoom
+    sin_lat = math.sin(math.radians(lat))
+    x = (lng + 180) / 360 * scale
+    y = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * scale
+    return x, y
+
+def cluster_cells(cells):
+    return [[round(lat_sum / count, 5), round(lng_sum / count, 5), count, cell_x, cell_y]
+            for (cell_x, cell_y), (lat_sum, lng_sum, count) in cells.items()]
+
+def build_cluster_index(crime_types, crime_data):
+    """Grid-cluster every (type, year) slice at each zoom in CLUSTER_ZOOMS.
+
+    Returns {type: {year: {zoom: [[lat, lng, count, cell_x, cell_y], ...]}}}
+    with an 'all' year per type. The cell index lets later builds merge
+    into a cluster without re-deriving its cell from a rounded centroid. Points are projected once at the deepest zoom; coarser
+    grids reuse that projection with a proportionally larger cell.
+    """
+    max_zoom = CLUSTER_ZOOMS[-1]
+    cluster_index = {}
     for crime_type in crime_types:
-        crime_data[crime_type] = {
-            "crimes": [],
-            "total_arrests": 0
-        }
-        for (ptype, lat, lng, date, block, desc, arrest) in crimes:
-            if ptype == crime_type:
-                crime_data[crime_type]["crimes"].append({
-                    "lat": lat,
-                    "lng": lng,
-                    "date": date,
-                    "year": parse_date(date),
-                    "block": block,
-                    "description": desc,
-                    "arrest": "Yes" if arrest == 1 else "No"
-                })
-                if arrest == 1:
-                    crime_data[crime_type]["total_arrests"] += 1
+        # {year key: {zoom: {cell: [lat sum, lng sum, count]}}}
+        grids = {}
+        for crime in crime_data[crime_type]["crimes"]:
+            lat, lng = crime["lat"], crime["lng"]
+            x, y = mercator_px(lat, lng, max_zoom)
+            year_key = str(crime["year"]) if crime["year"] is not None else 'unknown'
+            for key in ('all', year_key):
+                year_grids = grids.setdefault(key, {})
+                for zoom in CLUSTER_ZOOMS:
+                    cell_px = CLUSTER_CELL_PX * 2 ** (max_zoom - zoom)
+                    cell = year_grids.setdefault(zoom, {}).setdefault(
+                        (int(x // cell_px), int(y // cell_px)), [0.0, 0.0, 0])
+                    cell[0] += lat
+                    cell[1] += lng
+                    cell[2] += 1
+
+        cluster_index[crime_type] = {
+            key: {zoom: cluster_cells(cells) for zoom, cells in year_grids.items()}
+            for key, year_grids in grids.items()
+        }
+    return cluster_index
+
+# Heatmap grids cover the data extent at these cells-per-side; the page
+# picks a finer grid as the map zooms in
+HEAT_RESOLUTIONS = (64, 128, 256)
+
+def merge_clusters(old, new):
+    """Combine two {zoom: [[lat, lng, count, cell_x, cell_y], ...]} cluster sets cell by cell"""
+    merged = {}
+    for zoom in CLUSTER_ZOOMS:
+        cells = {}
+        for lat, lng, count, cell_x, cell_y in old.get(str(zoom), []) + new.get(zoom, []):
+            cell = cells.setdefault((cell_x, cell_y), [0.0, 0.0, 0])
+            cell[0] += lat * count
+            cell[1] += lng * count
+            cell[2] += count
+        merged[zoom] = cluster_cells(cells)
+    return merged
 
+def build_heat_grids(crime_types, crime_data, bounds=None):
+    """Bin every (type, year) slice into 2D count histograms at each heat resolution.
+
+    Returns {"bounds": [south, west, north, east], "resolutions": [...],
+    "grids": {type: {year: {resolution: [row, col, count, ...]}}}} where
+    only non-empty cells are listed. Points are binned once at the finest
+    resolution and coarser grids are derived from those bin indexes.
+    Pass the bounds of an earlier build to bin new points onto its grid.
+    """
+    columns = {}
+    for crime_type in crime_types:
+        crimes = crime_data[crime_type]["crimes"]
+        columns[crime_type] = (
+            np.fromiter((crime["lat"] for crime in crimes), dtype=np.float64, count=len(crimes)),
+            np.fromiter((crime["lng"] for crime in crimes), dtype=np.float64, count=len(crimes)),
+            np.fromiter((crime["year"] or 0 for crime in crimes), dtype=np.int32, count=len(crimes))
+        )
+
+    all_lat = np.concatenate([lat for lat, _, _ in columns.values()] or [np.zeros(0)])
+    all_lng = np.concatenate([lng for _, lng, _ in columns.values()] or [np.zeros(0)])
+    if bounds is None and len(all_lat) == 0:
+        return {"bounds": None, "resolutions": list(HEAT_RESOLUTIONS),
+                "grids": {crime_type: {} for crime_type in crime_types}}
+    if bounds is None:
+        bounds = [float(all_lat.min()), float(all_lng.min()), float(all_lat.max()), float(all_lng.max())]
+    south, west, north, east = bounds
+
+    finest = HEAT_RESOLUTIONS[-1]
+    grids = {}
+    for crime_type, (lat, lng, year) in columns.items():
+        row = np.clip(((lat - south) / max(north - south, 1e-9) * finest).astype(np.int64), 0, finest - 1)
+        col = np.clip(((lng - west) / max(east - west, 1e-9) * finest).astype(np.int64), 0, finest - 1)
+
+        type_grids = {}
+        slices = [('all', None)] + [(str(y) if y else 'unknown', y) for y in np.unique(year).tolist()]
+        for key, y in slices:
+            mask = slice(None) if y is None else year == y
+            slice_row, slice_col = row[mask], col[mask]
+            type_grids[key] = {}
+            for resolution in HEAT_RESOLUTIONS:
+                factor = finest // resolution
+                counts = np.bincount((slice_row // factor) * resolution + slice_col // factor,
+                                     minlength=resolution * resolution)
+                cells = np.flatnonzero(counts)
+                type_grids[key][resolution] = np.column_stack(
+                    [cells // resolution, cells % resolution, counts[cells]]).ravel().tolist()
+        grids[crime_type] = type_grids
+
+    return {"bounds": list(bounds), "resolutions": list(HEAT_RESOLUTIONS), "grids": grids}
+
+def merge_heat(old, new):
+    """Sum two {resolution: [row, col, count, ...]} heat grid sets"""
+    merged = {}
+    for resolution in HEAT_RESOLUTIONS:
+        cells = {}
+        for flat in (old.get(str(resolution), []), new.get(resolution, [])):
+            for i in range(0, len(flat), 3):
+                cells[flat[i], flat[i + 1]] = cells.get((flat[i], flat[i + 1]), 0) + flat[i + 2]
+        merged[resolution] = [value for (row, col), count in sorted(cells.items())
+                              for value in (row, col, count)]
+    return merged
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+def write_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(data, f)
+
+def export_tiles(crime_types, crime_data, out_dir, data_format='json', cluster_index=None,
+                 heat_grids=None, incremental=False):
+    """Write one file per (crime type, year) slice plus a manifest describing them.
+
+    With incremental=True, crime_data holds only new incidents. They are
+    merged into the slices, clusters and heat grids already in out_dir, and
+    only the files they touch are rewritten.
+    """
+    strings_path = os.path.join(out_dir, 'strings.json')
+    if incremental:
+        manifest = read_json(os.path.join(out_dir, 'manifest.json'))
+    else:
+        shutil.rmtree(out_dir, ignore_errors=True)
+        manifest = {
+            "format": data_format,
+            "options": {"clusters": cluster_index is not None, "heat_grids": heat_grids is not None},
+            "types": {}
+        }
+
+    strings = read_json(strings_path) if incremental and data_format == 'columnar' else {}
+    block_ids = {block: i for i, block in enumerate(strings.get("blocks", []))}
+    description_ids = {description: i for i, description in enumerate(strings.get("descriptions", []))}
+    string_count = len(block_ids) + len(description_ids)
+
+    extension = 'bin' if data_format == 'columnar' else 'json'
+    for crime_type in crime_types:
+        type_entry = manifest["types"].setdefault(crime_type, {"slices": []})
+        slices = {slice["year"]: slice for slice in type_entry["slices"]}
+
+        by_year = {}
+        for crime in crime_data[crime_type]["crimes"]:
+            by_year.setdefault(crime["year"], []).append(crime)
+
+        for year, crimes in by_year.items():
+            existing = slices.get(year)
+            name = f"{type_slug(crime_type)}/{year if year is not None else 'unknown'}.{extension}"
+            path = os.path.join(out_dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if data_format == 'columnar':
+                columns = columnar_columns(crimes, block_ids, description_ids)
+                if existing:
+                    with open(path, 'rb') as f:
+                        old_columns = unpack_columnar(f.read(), existing["count"])
+                    for key, column in columns.items():
+                        old_columns[key].extend(column)
+                    columns = old_columns
+                with open(path, 'wb') as f:
+                    f.write(pack_columnar(columns))
+            else:
+                write_json(path, (read_json(path) if existing else []) + crimes)
+            slices[year] = {
+                "year": year,
+                "file": name,
+                "count": (existing["count"] if existing else 0) + len(crimes)
+            }
+        type_entry["slices"] = [slices[year] for year in sorted(slices, key=lambda y: (y is None, y))]
+
+        if cluster_index is not None:
+            # One file per year holding that year's clusters at every zoom
+            clusters = type_entry.setdefault("clusters", {})
+            for key, zooms in cluster_index[crime_type].items():
+                name = f"{type_slug(crime_type)}/clusters/{key}.json"
+                path = os.path.join(out_dir, name)
+                if key in clusters:
+                    zooms = merge_clusters(read_json(path), zooms)
+                write_json(path, zooms)
+                clusters[key] = name
+
+        if heat_grids is not None:
+            heat = type_entry.setdefault("heat", {})
+            for key, resolutions in heat_grids["grids"][crime_type].items():
+                name = f"{type_slug(crime_type)}/heat/{key}.json"
+                path = os.path.join(out_dir, name)
+                if key in heat:
+                    resolutions = merge_heat(read_json(path), resolutions)
+                write_json(path, resolutions)
+                heat[key] = name
+
+    if heat_grids is not None and not incremental:
+        manifest["heat"] = {"bounds": heat_grids["bounds"], "resolutions": heat_grids["resolutions"]}
+
+    if data_format == 'columnar':
+        # String tables shared by every slice, in id order
+        manifest["coord_scale"] = COORD_SCALE
+        if len(block_ids) + len(description_ids) != string_count or not incremental:
+            write_json(strings_path, {"blocks": list(block_ids), "descriptions": list(description_ids)})
+
+    write_json(os.path.join(out_dir, 'manifest.json'), manifest)
+
+# Web Mercator pixels at zoom 0, the projection Leaflet uses; shared by the
+# canvas renderer and the filter worker
+PROJECTION_JS = """
+        function worldX(lng) {
+            return 256 * (lng + 180) / 360;
+        }
+
+        function worldY(lat) {
+            const sin = Math.sin(Math.max(-85.0511287798, Math.min(85.0511287798, lat)) * Math.PI / 180);
+            return 256 * (0.5 - Math.log((1 + sin) / (1 - sin)) / (4 * Math.PI));
+        }
+"""
+
+# Runs in a Web Worker on inline pages (see startWorker in the page). It
+# parses the same embedded JSON as the page, keeps each type's coordinates
+# in typed arrays and answers point requests off the main thread. Records
+# are embedded in year order, so a year is one contiguous run of rows and
+# the answers are row numbers into the page's own crimeData.
+FILTER_WORKER = PROJECTION_JS + """
+        const columns = {};
+
+        function load(text) {
+            Object.entries(JSON.parse(text)).forEach(([crimeType, data]) => {
+                const crimes = data.crimes;
+                const lat = new Float64Array(crimes.length);
+                const lng = new Float64Array(crimes.length);
+                const ranges = {all: [0, crimes.length]};
+                for (let i = 0; i < crimes.length; i++) {
+                    lat[i] = crimes[i].lat;
+                    lng[i] = crimes[i].lng;
+                    const year = crimes[i].year || 'unknown';
+                    if (ranges[year]) ranges[year][1] = i + 1;
+                    else ranges[year] = [i, i + 1];
+                }
+                columns[crimeType] = {lat: lat, lng: lng, ranges: ranges};
+            });
+        }
+
+        function points(request) {
+            // Rows of the year's run, optionally only those inside [south, west, north, east]
+            const {lat, lng, ranges} = columns[request.type];
+            const [start, end] = ranges[request.year] || [0, 0];
+            const [south, west, north, east] = request.bounds || [-90, -180, 90, 180];
+            const rows = new Uint32Array(end - start);
+            let count = 0;
+            for (let i = start; i < end; i++) {
+                if (lat[i] >= south && lat[i] <= north && lng[i] >= west && lng[i] <= east) rows[count++] = i;
+            }
+            const result = {rows: rows.slice(0, count), lat: new Float64Array(count), lng: new Float64Array(count)};
+            for (let k = 0; k < count; k++) {
+                result.lat[k] = lat[result.rows[k]];
+                result.lng[k] = lng[result.rows[k]];
+            }
+            return [result, [result.rows.buffer, result.lat.buffer, result.lng.buffer]];
+        }
+
+        function pointSet(request) {
+            // Every row projected for the canvas renderer, with the year runs as its ranges
+            const {lat, lng, ranges} = columns[request.type];
+            const x = new Float64Array(lat.length);
+            const y = new Float64Array(lat.length);
+            for (let i = 0; i < lat.length; i++) {
+                x[i] = worldX(lng[i]);
+                y[i] = worldY(lat[i]);
+            }
+            return [{length: lat.length, x: x, y: y, ranges: ranges}, [x.buffer, y.buffer]];
+        }
+
+        onmessage = ({data}) => {
+            if (data.op === 'load') {
+                load(data.text);
+                return;
+            }
+            const [result, transfer] = data.op === 'points' ? points(data) : pointSet(data);
+            postMessage({id: data.id, result: result}, transfer);
+        };
+"""
+
+def state_key(data_dir):
+    """build_state output name of a tiles build, so each data directory keeps its own watermark"""
+    return f"crime_map:{os.path.abspath(data_dir)}"
+
+def main(export_mode='inline', data_dir='crime_map_data', data_format='json', clusters=False,
+         heat_grids=False, incremental=False, api_url='', renderer='markers', compress=()):
+    # Connect to the database
+    conn = sqlite3.connect('crimes.db')
+    max_id = current_max_id(conn)
+
+    # An incremental build needs the state and the files of a tiles build
+    # into the same data_dir made with the same options; anything else falls
+    # back to a full build
+    since_id, _ = load_state(conn, state_key(data_dir)) if incremental else (None, None)
+    manifest_path = os.path.join(data_dir, 'manifest.json')
+    manifest = read_json(manifest_path) if since_id is not None and os.path.exists(manifest_path) else None
+    options = {"clusters": clusters, "heat_grids": heat_grids}
+    if since_id is not None and (manifest is None or manifest.get("format") != data_format
+                                 or manifest.get("options") != options):
+        print("No matching previous build found, rebuilding everything")
+        since_id = None
+    if since_id is not None and since_id >= max_id:
+        conn.close()
+        print("\nMap is already up to date")
+        return
+
+    if export_mode in ('server', 'pyramid'):
+        # The page asks server.py for its points, or draws pre-rendered tiles, so none are read here
+        crime_types = load_crime_types(conn)
+        crime_data = {crime_type: {"crimes": []} for crime_type in crime_types}
+    elif export_mode == 'inline' and not (clusters or heat_grids):
+        # Nothing else needs the points, so the page's data section is written
+        # straight from the cursor and only one batch of rows is held at a time
+        crime_types = load_crime_types(conn)
+        crime_data = {crime_type: {"crimes": iter_crimes(conn, crime_type)} for crime_type in crime_types}
+    else:
+        crime_types, crime_data = load_crime_data(conn, min_id=since_id, max_id=max_id)
+    # Sidebar counts always cover every crime, whatever the points build read
+    count_cube = load_count_cube(conn, crime_types)
+    if since_id is not None:
+        print(f"Merging {sum(len(data['crimes']) for data in crime_data.values())} new crimes")
+
+    heat_bounds = manifest["heat"]["bounds"] if since_id is not None and heat_grids else None
+    render_map(crime_types, crime_data, count_cube, export_mode, data_dir, data_format, clusters, heat_grids,
+               incremental=since_id is not None, heat_bounds=heat_bounds, api_url=api_url,
+               renderer=renderer, compress=compress)
+    if export_mode == 'tiles':
+        save_state(conn, state_key(data_dir), max_id)
     conn.close()
 
+def render_map(crime_types, crime_data, count_cube, export_mode='inline', data_dir='crime_map_data',
+               data_format='json', clusters=False, heat_grids=False, incremental=False, heat_bounds=None,
+               api_url='', renderer='markers', compress=()):
+    """Write crime_map.html, plus its point files in tiles mode, from already loaded crimes.
+
+    incremental merges crime_data into the files of the previous tiles
+    build; heat_bounds then keeps the heat grids on that build's bounds.
+    In server mode the page fetches points and counts from server.py at
+    api_url ('' when server.py also serves the page). renderer 'canvas'
+    draws points on one canvas layer instead of as Leaflet markers.
+
+    The page is streamed to disk, with a .gz/.br copy for each of 'gzip'
+    and 'brotli' in compress. In inline mode each type's "crimes" may be
+    any iterable in year order, such as iter_crimes(); lists are sorted.
+    """
+    cluster_index = build_cluster_index(crime_types, crime_data) if clusters else None
+    cluster_zooms = list(CLUSTER_ZOOMS) if clusters else []
+    worker_block = ""
+    json_blocks = {}
+    heat_grid_data = build_heat_grids(crime_types, crime_data, heat_bounds) if heat_grids else None
+
+    if export_mode == 'tiles':
+        # Points live in per-type, per-year files the page fetches on demand
+        export_tiles(crime_types, crime_data, data_dir, data_format, cluster_index, heat_grid_data,
+                     incremental=incremental)
+        data_script = f"""
+        const DATA_MODE = 'tiles';
+        const DATA_DIR = {json.dumps(data_dir)};
+        const manifestPromise = fetch(`${{DATA_DIR}}/manifest.json`).then(response => response.json());
+"""
+    elif export_mode == 'pyramid':
+        # Tiles are rendered separately by tile_pyramid.py into data_dir
+        data_script = f"""
+        const DATA_MODE = 'pyramid';
+        const DATA_DIR = {json.dumps(data_dir)};
+        const manifestPromise = fetch(`${{DATA_DIR}}/manifest.json`).then(response => response.json());
+"""
+    elif export_mode == 'server':
+        data_script = f"""
+        const DATA_MODE = 'server';
+        const API_URL = {json.dumps(api_url.rstrip('/'))};
+"""
+    else:
+        # Records go in year order, so each year is one contiguous run for the filter worker
+        crime_data = {
+            crime_type: dict(data, crimes=in_year_order(data["crimes"])) for crime_type, data in crime_data.items()
+        }
+        # None of these blocks runs as page script. The page and the worker
+        # parse the same crime JSON, which is streamed into the file
+        worker_block = """
+    <script type="javascript/worker" id="filter-worker">""" + FILTER_WORKER + """</script>"""
+        json_blocks = {'crime-data': crime_data, 'cluster-index': cluster_index, 'heat-grids': heat_grid_data}
+        data_script = """
+        const DATA_MODE = 'inline';
+        const crimeData = JSON.parse(document.getElementById('crime-data').textContent);
+        const filterWorker = startWorker('filter-worker', 'crime-data');
+        const clusterIndex = JSON.parse(document.getElementById('cluster-index').textContent);
+        const heatGrids = JSON.parse(document.getElementById('heat-grids').textContent);
+"""
+
+    data_script += f"""
+        const CLUSTER_ZOOMS = {json.dumps(cluster_zooms)};
+        const HEAT_GRIDS = {json.dumps(heat_grids)};
+        const RENDERER = {json.dumps(renderer)};
+"""
+
     html = """
 <!DOCTYPE html>
 <html>
@@ -337,24 +885,32 @@ def main():
     </div>
     <script src="https://unpkg.com/leaflet@1.7.1/dist/leaflet.js"></script>
     <script src="https://unpkg.com/leaflet.markercluster@1.4.1/dist/leaflet.markercluster.js"></script>
-    <script src="https://unpkg.com/leaflet.heat@0.2.0/dist/leaflet-heat.js"></script>
+    <script src="https://unpkg.com/leaflet.heat@0.2.0/dist/leaflet-heat.js"></script>"""
+
+    script = """
     <script>
         const map = L.map('map').setView([41.8781, -87.6298], 11);
         L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
             attribution: '© OpenStreetMap contributors'
         }).addTo(map);
 
-        const crimeData = """ + json.dumps(crime_data) + """;
+""" + data_script + """
+        const crimeTypes = """ + json.dumps(crime_types) + """;
+        // In server mode the counts arrive from the server after the page loads
+        let countCube = DATA_MODE === 'server' ? null : """ + json.dumps(count_cube) + """;
         const layers = {};
         const heatmaps = {};
+        const sliceCache = {};
+        let stringsPromise = null;
         let currentYear = 'all';
         let isHeatmapMode = false;
+        let renderGeneration = 0;
 
         function formatPopup(crime, crimeType) {
             return `
                 <div class="popup-content">
                     <div class="popup-title">${crimeType}</div>
-                    <div class="popup-detail"><strong>Date:</strong> ${crime.date}</div>
+                    <div class="popup-detail"><strong>Date:</strong> ${formatDate(crime.epoch)}</div>
                     <div class="popup-detail"><strong>Location:</strong> ${crime.block}</div>
                     <div class="popup-detail"><strong>Details:</strong> ${crime.description || 'Not provided'}</div>
                     <div class="popup-detail"><strong>Arrest Made:</strong> ${crime.arrest}</div>
@@ -362,71 +918,617 @@ def main():
             `;
         }
 
-        function createHeatmapData(crimeType) {
-            return crimeData[crimeType]["crimes"]
-                .filter(crime => currentYear === 'all' || crime.year === parseInt(currentYear))
-                .map(crime => [crime.lat, crime.lng, 1]);
+        function startWorker(scriptId, dataId) {
+            // Filtering runs in a worker so the page stays responsive; each
+            // request returns a promise of the worker's reply
+            const source = new Blob([document.getElementById(scriptId).textContent], {type: 'text/javascript'});
+            const worker = new Worker(URL.createObjectURL(source));
+            const pending = new Map();
+            let nextId = 0;
+            worker.onmessage = e => {
+                pending.get(e.data.id)(e.data.result);
+                pending.delete(e.data.id);
+            };
+            worker.postMessage({op: 'load', text: document.getElementById(dataId).textContent});
+            return request => new Promise(resolve => {
+                const id = nextId++;
+                pending.set(id, resolve);
+                worker.postMessage({...request, id: id});
+            });
         }
 
-        function updateVisualization() {
-            Object.keys(crimeData).forEach(crimeType => {
-                const checkbox = document.querySelector(`input[value="${crimeType}"]`);
-                if (checkbox.checked) {
-                    if (layers[crimeType]) map.removeLayer(layers[crimeType]);
-                    if (heatmaps[crimeType]) map.removeLayer(heatmaps[crimeType]);
+        function matchesYear(year) {
+            return currentYear === 'all' || year === parseInt(currentYear);
+        }
+
+        function formatDate(epoch) {
+            if (!epoch) return 'Unknown';
+            const d = new Date(epoch * 1000);
+            const pad = value => String(value).padStart(2, '0');
+            const hours = d.getUTCHours();
+            return `${pad(d.getUTCMonth() + 1)}/${pad(d.getUTCDate())}/${d.getUTCFullYear()} ` +
+                `${pad(hours % 12 || 12)}:${pad(d.getUTCMinutes())}:${pad(d.getUTCSeconds())} ${hours < 12 ? 'AM' : 'PM'}`;
+        }
+
+        // A batch exposes coordinate columns plus a per-row accessor for popups,
+        // so JSON and columnar slices render through the same code
+        function objectBatch(crimes) {
+            return {
+                length: crimes.length,
+                lat: crimes.map(crime => crime.lat),
+                lng: crimes.map(crime => crime.lng),
+                year: crimes.map(crime => crime.year),
+                crime: i => crimes[i]
+            };
+        }
+
+        function columnarBatch(buffer, count, strings, coordScale) {
+            const latQ = new Int32Array(buffer, 0, count);
+            const lngQ = new Int32Array(buffer, 4 * count, count);
+            const block = new Uint32Array(buffer, 8 * count, count);
+            const description = new Uint32Array(buffer, 12 * count, count);
+            const date = new Uint32Array(buffer, 16 * count, count);
+            const year = new Uint16Array(buffer, 20 * count, count);
+            const arrest = new Uint8Array(buffer, 22 * count, (count + 7) >> 3);
+
+            const lat = new Float32Array(count);
+            const lng = new Float32Array(count);
+            for (let i = 0; i < count; i++) {
+                lat[i] = latQ[i] / coordScale;
+                lng[i] = lngQ[i] / coordScale;
+            }
+
+            return {
+                length: count,
+                lat: lat,
+                lng: lng,
+                year: year,
+                crime: i => ({
+                    lat: lat[i],
+                    lng: lng[i],
+                    epoch: date[i],
+                    year: year[i] || null,
+                    block: strings.blocks[block[i]],
+                    description: strings.descriptions[description[i]],
+                    arrest: (arrest[i >> 3] >> (i & 7)) & 1 ? "Yes" : "No"
+                })
+            };
+        }
+
+        async function fetchSlice(slice, manifest) {
+            if (!sliceCache[slice.file]) {
+                const response = fetch(`${DATA_DIR}/${slice.file}`);
+                if (manifest.format === 'columnar') {
+                    stringsPromise = stringsPromise ||
+                        fetch(`${DATA_DIR}/strings.json`).then(response => response.json());
+                    sliceCache[slice.file] = Promise.all([response.then(r => r.arrayBuffer()), stringsPromise])
+                        .then(([buffer, strings]) => columnarBatch(buffer, slice.count, strings, manifest.coord_scale));
+                } else {
+                    sliceCache[slice.file] = response.then(r => r.json()).then(objectBatch);
+                }
+            }
+            return sliceCache[slice.file];
+        }
+
+        async function loadCrimes(crimeType, viewport) {
+            if (DATA_MODE === 'server') {
+                // Ask for the points around the current view; panning fetches again
+                const bounds = map.getBounds().pad(0.25);
+                const params = new URLSearchParams({
+                    type: crimeType,
+                    bbox: [bounds.getSouth(), bounds.getWest(), bounds.getNorth(), bounds.getEast()].join(',')
+                });
+                if (currentYear !== 'all') params.set('year', currentYear);
+                const response = await fetch(`${API_URL}/api/points?${params}`).then(r => r.json());
+                return [objectBatch(response.crimes)];
+            }
+            if (DATA_MODE === 'inline') {
+                // The worker picks the year's rows, and of those the ones in viewport when given
+                const points = await filterWorker({
+                    op: 'points',
+                    type: crimeType,
+                    year: currentYear,
+                    bounds: viewport ? [viewport.getSouth(), viewport.getWest(), viewport.getNorth(), viewport.getEast()] : null
+                });
+                const crimes = crimeData[crimeType]["crimes"];
+                return [{
+                    length: points.rows.length,
+                    lat: points.lat,
+                    lng: points.lng,
+                    crime: i => crimes[points.rows[i]]
+                }];
+            }
+            // Only fetch the slices for the selected year
+            const manifest = await manifestPromise;
+            const slices = manifest.types[crimeType].slices.filter(slice => matchesYear(slice.year));
+            return Promise.all(slices.map(slice => fetchSlice(slice, manifest)));
+        }
+
+        function createHeatmapData(batches) {
+            const points = [];
+            batches.forEach(batch => {
+                for (let i = 0; i < batch.length; i++) {
+                    points.push([batch.lat[i], batch.lng[i], 1]);
+                }
+            });
+            return points;
+        }
+
+        async function loadHeatGrid(crimeType) {
+            let meta, grids;
+            if (DATA_MODE === 'inline') {
+                meta = heatGrids;
+                grids = heatGrids.grids[crimeType][currentYear];
+            } else {
+                const manifest = await manifestPromise;
+                const file = manifest.types[crimeType].heat[currentYear];
+                meta = manifest.heat;
+                if (file && !sliceCache[file]) {
+                    sliceCache[file] = fetch(`${DATA_DIR}/${file}`).then(response => response.json());
+                }
+                grids = file ? await sliceCache[file] : null;
+            }
+            if (!grids) return [];
+
+            // One grid step finer per zoom level past 11
+            const level = Math.min(Math.max(map.getZoom() - 11, 0), meta.resolutions.length - 1);
+            const resolution = meta.resolutions[level];
+            const cells = grids[resolution];
+            const [south, west, north, east] = meta.bounds;
+            const cellLat = (north - south) / resolution;
+            const cellLng = (east - west) / resolution;
+
+            let maxCount = 1;
+            for (let i = 2; i < cells.length; i += 3) maxCount = Math.max(maxCount, cells[i]);
+
+            const points = new Array(cells.length / 3);
+            for (let i = 0, j = 0; i < cells.length; i += 3, j++) {
+                points[j] = [
+                    south + (cells[i] + 0.5) * cellLat,
+                    west + (cells[i + 1] + 0.5) * cellLng,
+                    cells[i + 2] / maxCount
+                ];
+            }
+            return points;
+        }
+
+        function clusterZoom() {
+            // Zoom level of the precomputed clusters to show, or null for raw points
+            if (CLUSTER_ZOOMS.length === 0) return null;
+            const zoom = Math.max(map.getZoom(), CLUSTER_ZOOMS[0]);
+            return zoom <= CLUSTER_ZOOMS[CLUSTER_ZOOMS.length - 1] ? zoom : null;
+        }
+
+        async function loadClusters(crimeType, zoom) {
+            if (DATA_MODE === 'inline') {
+                return ((clusterIndex[crimeType][currentYear] || {})[zoom]) || [];
+            }
+            const manifest = await manifestPromise;
+            const file = manifest.types[crimeType].clusters[currentYear];
+            if (!file) return [];
+            if (!sliceCache[file]) {
+                sliceCache[file] = fetch(`${DATA_DIR}/${file}`).then(response => response.json());
+            }
+            return (await sliceCache[file])[zoom] || [];
+        }
+
+        function createClusterLayer(cells) {
+            const group = L.layerGroup();
+            cells.forEach(([lat, lng, count]) => {
+                const size = count < 10 ? 'small' : count < 100 ? 'medium' : 'large';
+                L.marker([lat, lng], {
+                    icon: L.divIcon({
+                        html: `<div><span>${count}</span></div>`,
+                        className: `marker-cluster marker-cluster-${size}`,
+                        iconSize: L.point(40, 40)
+                    })
+                }).on('click', () => map.setView([lat, lng], map.getZoom() + 2)).addTo(group);
+            });
+            return group;
+        }
+
+        function createViewportLayer(batches, crimeType) {
+            // Past the deepest cluster zoom, draw only the points in view
+            const bounds = map.getBounds();
+            const south = bounds.getSouth(), north = bounds.getNorth();
+            const west = bounds.getWest(), east = bounds.getEast();
+            const group = L.layerGroup();
+            batches.forEach(batch => {
+                for (let i = 0; i < batch.length; i++) {
+                    const lat = batch.lat[i], lng = batch.lng[i];
+                    if (lat < south || lat > north || lng < west || lng > east) continue;
+                    L.marker([lat, lng])
+                        .bindPopup(formatPopup(batch.crime(i), crimeType))
+                        .addTo(group);
+                }
+            });
+            return group;
+        }
+
+        // Canvas renderer: the points of every checked type are drawn onto one
+        // canvas straight from typed arrays. A type's points are stored in
+        // year order, so the year filter only changes which index range is
+        // drawn, and a popup is built when a click hits a point rather than
+        // up front for every marker.
+        const POINT_COLOR = 0xB30000CC;  // rgba(204, 0, 0, 0.7) as little-endian RGBA bytes
+        const HIT_RADIUS = 6;
+        // Hit-test grid cells are 1/256 of a zoom-0 pixel, 16 screen pixels at zoom 12
+        const HIT_GRID = 65536;
+        const pointSets = {};
+        const pointSetPromises = {};
+
+""" + PROJECTION_JS + """
+        function buildPointSet(batches) {
+            // Count each year's points, then place them year after year
+            const counts = new Map();
+            batches.forEach(batch => {
+                for (let i = 0; i < batch.length; i++) {
+                    const year = batch.year[i] || 0;
+                    counts.set(year, (counts.get(year) || 0) + 1);
+                }
+            });
+            const ranges = {};
+            const next = new Map();
+            let length = 0;
+            [...counts.keys()].sort((a, b) => a - b).forEach(year => {
+                ranges[year || 'unknown'] = [length, length + counts.get(year)];
+                next.set(year, length);
+                length += counts.get(year);
+            });
+            ranges.all = [0, length];
+
+            const x = new Float64Array(length);
+            const y = new Float64Array(length);
+            const batchOf = new Uint16Array(length);
+            const rowOf = new Uint32Array(length);
+            batches.forEach((batch, b) => {
+                for (let i = 0; i < batch.length; i++) {
+                    const year = batch.year[i] || 0;
+                    const j = next.get(year);
+                    next.set(year, j + 1);
+                    x[j] = worldX(batch.lng[i]);
+                    y[j] = worldY(batch.lat[i]);
+                    batchOf[j] = b;
+                    rowOf[j] = i;
+                }
+            });
+            return {
+                length: length,
+                x: x,
+                y: y,
+                ranges: ranges,
+                crime: j => batches[batchOf[j]].crime(rowOf[j]),
+                index: null
+            };
+        }
+
+        function loadPointSet(crimeType) {
+            // Every year of a type is loaded once; the year filter picks a range of it
+            if (pointSetPromises[crimeType]) return pointSetPromises[crimeType];
+            if (DATA_MODE === 'inline') {
+                // Records are in year order, so the worker's point j is record j
+                const crimes = crimeData[crimeType]["crimes"];
+                pointSetPromises[crimeType] = filterWorker({op: 'pointSet', type: crimeType}).then(set => {
+                    pointSets[crimeType] = Object.assign(set, {crime: j => crimes[j], index: null});
+                });
+            } else {
+                pointSetPromises[crimeType] = manifestPromise
+                    .then(manifest => Promise.all(
+                        manifest.types[crimeType].slices.map(slice => fetchSlice(slice, manifest))))
+                    .then(batches => {
+                        pointSets[crimeType] = buildPointSet(batches);
+                    });
+            }
+            return pointSetPromises[crimeType];
+        }
+
+        function hitCell(value) {
+            return Math.max(0, Math.min(HIT_GRID - 1, Math.floor(value * 256)));
+        }
+
+        function hitIndex(set) {
+            // Point numbers sorted by grid cell (row-major), built on the first click
+            if (!set.index) {
+                const n = set.length;
+                // Each point's cell and number packed into one double, exact below 2^21 points,
+                // so a plain numeric sort orders them without a comparator
+                const packed = new Float64Array(n);
+                for (let j = 0; j < n; j++) {
+                    packed[j] = (hitCell(set.y[j]) * HIT_GRID + hitCell(set.x[j])) * n + j;
+                }
+                packed.sort();
+                const order = new Uint32Array(n);
+                const keys = new Uint32Array(n);
+                for (let k = 0; k < n; k++) {
+                    keys[k] = Math.floor(packed[k] / n);
+                    order[k] = packed[k] - keys[k] * n;
+                }
+                set.index = {order: order, keys: keys};
+            }
+            return set.index;
+        }
+
+        function lowerBound(values, target) {
+            let low = 0, high = values.length;
+            while (low < high) {
+                const middle = (low + high) >> 1;
+                if (values[middle] < target) low = middle + 1;
+                else high = middle;
+            }
+            return low;
+        }
+
+        function nearestPoint(set, x, y, radius) {
+            // Closest point of the current year within radius (zoom-0 pixels), or -1
+            const [start, end] = set.ranges[currentYear] || [0, 0];
+            const index = hitIndex(set);
+            let best = -1, bestDistance = radius * radius;
+            for (let row = hitCell(y - radius); row <= hitCell(y + radius); row++) {
+                // The cells of one grid row are contiguous in key order
+                const stop = lowerBound(index.keys, row * HIT_GRID + hitCell(x + radius) + 1);
+                for (let k = lowerBound(index.keys, row * HIT_GRID + hitCell(x - radius)); k < stop; k++) {
+                    const j = index.order[k];
+                    if (j < start || j >= end) continue;
+                    const distance = (set.x[j] - x) ** 2 + (set.y[j] - y) ** 2;
+                    if (distance <= bestDistance) {
+                        best = j;
+                        bestDistance = distance;
+                    }
+                }
+            }
+            return {point: best, distance: bestDistance};
+        }
+
+        const PointCanvasLayer = L.Layer.extend({
+            onAdd: function(map) {
+                this._canvas = L.DomUtil.create('canvas', 'leaflet-zoom-hide', this.getPane());
+                map.on('moveend resize', this.redraw, this);
+                map.on('click', this._openPopup, this);
+                this.redraw();
+            },
+
+            onRemove: function(map) {
+                L.DomUtil.remove(this._canvas);
+                map.off('moveend resize', this.redraw, this);
+                map.off('click', this._openPopup, this);
+            },
+
+            _visibleTypes: function() {
+                return crimeTypes.filter(crimeType => pointSets[crimeType] &&
+                    document.querySelector(`input[value="${crimeType}"]`).checked);
+            },
+
+            redraw: function() {
+                if (!this._map) return;
+                const map = this._map;
+                const size = map.getSize();
+                const width = size.x, height = size.y;
+                const canvas = this._canvas;
+                canvas.width = width;
+                canvas.height = height;
+                const topLeft = map.containerPointToLayerPoint([0, 0]);
+                L.DomUtil.setPosition(canvas, topLeft);
+                // Pixel coordinates at the current zoom of the canvas's top-left corner
+                const origin = topLeft.add(map.getPixelOrigin());
+                const scale = 2 ** map.getZoom();
+
+                const ctx = canvas.getContext('2d');
+                const image = ctx.createImageData(width, height);
+                const pixels = new Uint32Array(image.data.buffer);
+                this._visibleTypes().forEach(crimeType => {
+                    const set = pointSets[crimeType];
+                    const [start, end] = set.ranges[currentYear] || [0, 0];
+                    for (let j = start; j < end; j++) {
+                        const px = Math.round(set.x[j] * scale - origin.x);
+                        const py = Math.round(set.y[j] * scale - origin.y);
+                        if (px < 1 || py < 1 || px >= width - 1 || py >= height - 1) continue;
+                        // A 3x3 square around the point
+                        for (let at = (py - 1) * width + px; at <= (py + 1) * width + px; at += width) {
+                            pixels[at - 1] = pixels[at] = pixels[at + 1] = POINT_COLOR;
+                        }
+                    }
+                });
+                ctx.putImageData(image, 0, 0);
+            },
+
+            _openPopup: function(e) {
+                const map = this._map;
+                const scale = 2 ** map.getZoom();
+                const click = map.project(e.latlng, map.getZoom());
+                let best = null;
+                this._visibleTypes().forEach(crimeType => {
+                    const hit = nearestPoint(pointSets[crimeType], click.x / scale, click.y / scale, HIT_RADIUS / scale);
+                    if (hit.point >= 0 && (!best || hit.distance < best.distance)) {
+                        best = {crimeType: crimeType, point: hit.point, distance: hit.distance};
+                    }
+                });
+                if (!best) return;
+                const crime = pointSets[best.crimeType].crime(best.point);
+                L.popup()
+                    .setLatLng([crime.lat, crime.lng])
+                    .setContent(formatPopup(crime, best.crimeType))
+                    .openOn(map);
+            }
+        });
+
+        const pointCanvas = new PointCanvasLayer();
+
+        async function renderLayer(crimeType, generation) {
+            const checkbox = document.querySelector(`input[value="${crimeType}"]`);
+            if (!checkbox.checked) return;
 
-                    if (isHeatmapMode) {
-                        heatmaps[crimeType] = L.heatLayer(createHeatmapData(crimeType), {
-                            radius: 30,
-                            blur: 20,
-                            maxZoom: 15,
-                            max: 1.0,
-                            gradient: {
-                                0.1: '#edf8fb',
-                                0.2: '#bfd3e6',
-                                0.3: '#9ebcda',
-                                0.4: '#8c96c6',
-                                0.5: '#8c6bb1',
-                                0.6: '#88419d',
-                                0.7: '#810f7c',
-                                0.8: '#ce1256',
-                                0.9: '#ef3b2c',
-                                1.0: '#ff0000'
-                            }
-                        }).addTo(map);
-                    } else {
-                        layers[crimeType] = L.markerClusterGroup({
-                            maxClusterRadius: 50,
-                            spiderfyOnMaxZoom: true,
-                            showCoverageOnHover: false,
-                            zoomToBoundsOnClick: true
-                        });
-
-                        crimeData[crimeType]["crimes"]
-                            .filter(crime => currentYear === 'all' || crime.year === parseInt(currentYear))
-                            .forEach(crime => {
-                                L.marker([crime.lat, crime.lng])
-                                    .bindPopup(formatPopup(crime, crimeType))
-                                    .addTo(layers[crimeType]);
-                            });
-
-                        map.addLayer(layers[crimeType]);
+            if (DATA_MODE === 'pyramid') {
+                const manifest = await manifestPromise;
+                if (generation !== renderGeneration || !checkbox.checked) return;
+                if (layers[crimeType]) map.removeLayer(layers[crimeType]);
+                layers[crimeType] = createPyramidLayer(manifest, crimeType).addTo(map);
+                return;
+            }
+
+            if (RENDERER === 'canvas' && !isHeatmapMode) {
+                await loadPointSet(crimeType);
+                if (generation !== renderGeneration || !checkbox.checked) return;
+                if (heatmaps[crimeType]) map.removeLayer(heatmaps[crimeType]);
+                pointCanvas.addTo(map);
+                pointCanvas.redraw();
+                return;
+            }
+
+            const zoom = isHeatmapMode ? null : clusterZoom();
+            const clusters = zoom !== null ? await loadClusters(crimeType, zoom) : null;
+            const heatPoints = isHeatmapMode && HEAT_GRIDS ? await loadHeatGrid(crimeType) : null;
+            // Past the deepest cluster zoom only the points in view are drawn
+            const inView = CLUSTER_ZOOMS.length > 0 && !isHeatmapMode && clusters === null;
+            const batches = clusters === null && heatPoints === null
+                ? await loadCrimes(crimeType, inView ? map.getBounds() : null) : null;
+            // A newer filter change or an unchecked box supersedes this render
+            if (generation !== renderGeneration || !checkbox.checked) return;
+
+            if (layers[crimeType]) map.removeLayer(layers[crimeType]);
+            if (heatmaps[crimeType]) map.removeLayer(heatmaps[crimeType]);
+
+            if (clusters !== null) {
+                layers[crimeType] = createClusterLayer(clusters).addTo(map);
+            } else if (CLUSTER_ZOOMS.length > 0 && !isHeatmapMode) {
+                layers[crimeType] = createViewportLayer(batches, crimeType).addTo(map);
+            } else if (isHeatmapMode) {
+                heatmaps[crimeType] = L.heatLayer(heatPoints || createHeatmapData(batches), {
+                    radius: 30,
+                    blur: 20,
+                    maxZoom: 15,
+                    max: 1.0,
+                    gradient: {
+                        0.1: '#edf8fb',
+                        0.2: '#bfd3e6',
+                        0.3: '#9ebcda',
+                        0.4: '#8c96c6',
+                        0.5: '#8c6bb1',
+                        0.6: '#88419d',
+                        0.7: '#810f7c',
+                        0.8: '#ce1256',
+                        0.9: '#ef3b2c',
+                        1.0: '#ff0000'
+                    }
+                }).addTo(map);
+            } else {
+                layers[crimeType] = L.markerClusterGroup({
+                    maxClusterRadius: 50,
+                    spiderfyOnMaxZoom: true,
+                    showCoverageOnHover: false,
+                    zoomToBoundsOnClick: true
+                });
+
+                batches.forEach(batch => {
+                    for (let i = 0; i < batch.length; i++) {
+                        L.marker([batch.lat[i], batch.lng[i]])
+                            .bindPopup(formatPopup(batch.crime(i), crimeType))
+                            .addTo(layers[crimeType]);
                     }
+                });
+
+                map.addLayer(layers[crimeType]);
+            }
+        }
+
+        // Tiles from tile_pyramid.py; the grid layer fetches only the tiles in view
+        const DENSITY_COLORS = ['#edf8fb', '#bfd3e6', '#9ebcda', '#8c96c6', '#8c6bb1',
+                                '#88419d', '#810f7c', '#ce1256', '#ef3b2c', '#ff0000'];
+
+        function drawPyramidTile(ctx, data, options, zoom, size) {
+            const manifest = options.manifest;
+            if (manifest.format === 'png') {
+                ctx.drawImage(data, 0, 0, size, size);
+                return;
+            }
+            const scale = size / manifest.extent;
+            if (options.kind === 'points') {
+                const xy = new Uint16Array(data);
+                ctx.fillStyle = 'rgba(204, 0, 0, 0.7)';
+                for (let i = 0; i < xy.length; i += 2) {
+                    ctx.fillRect(xy[i] * scale - 1.5, xy[i + 1] * scale - 1.5, 3, 3);
                 }
+                return;
+            }
+            const n = data.byteLength / 6;
+            const counts = new Uint32Array(data, 0, n);
+            const cells = new Uint16Array(data, 4 * n, n);
+            const side = manifest.density_cells;
+            const cellSize = size / side;
+            const maxLevel = Math.log1p(options.entry.density_max[options.year][zoom] || 1);
+            ctx.globalAlpha = 0.7;
+            for (let i = 0; i < n; i++) {
+                const level = Math.log1p(counts[i]) / maxLevel;
+                ctx.fillStyle = DENSITY_COLORS[Math.min(DENSITY_COLORS.length - 1, Math.floor(level * DENSITY_COLORS.length))];
+                ctx.fillRect((cells[i] % side) * cellSize, Math.floor(cells[i] / side) * cellSize, cellSize, cellSize);
+            }
+        }
+
+        const PyramidLayer = L.GridLayer.extend({
+            createTile: function(coords, done) {
+                const tile = document.createElement('canvas');
+                const size = this.getTileSize();
+                tile.width = size.x;
+                tile.height = size.y;
+                const options = this.options;
+                const png = options.manifest.format === 'png';
+                fetch(`${DATA_DIR}/${options.entry.slug}/${options.year}/${options.kind}/` +
+                      `${coords.z}/${coords.x}/${coords.y}.${png ? 'png' : 'bin'}`)
+                    .then(response => {
+                        // Tiles without incidents are never written
+                        if (!response.ok) return null;
+                        return png ? response.blob().then(createImageBitmap) : response.arrayBuffer();
+                    })
+                    .then(data => {
+                        if (data) drawPyramidTile(tile.getContext('2d'), data, options, coords.z, size.x);
+                        done(null, tile);
+                    })
+                    .catch(error => done(error, tile));
+                return tile;
+            }
+        });
+
+        function createPyramidLayer(manifest, crimeType) {
+            const entry = manifest.types[crimeType];
+            if (!entry || !entry.years.includes(currentYear)) return L.layerGroup();
+            return new PyramidLayer({
+                manifest: manifest,
+                entry: entry,
+                year: currentYear,
+                kind: isHeatmapMode ? 'density' : 'points',
+                minNativeZoom: manifest.zooms[0],
+                maxNativeZoom: manifest.zooms[manifest.zooms.length - 1],
+                zIndex: 2
+            });
+        }
 
-                // Update crime and arrest counts
-                const totalCrimes = crimeData[crimeType]["crimes"].filter(crime => 
-                    currentYear === 'all' || crime.year === parseInt(currentYear)
-                ).length;
-                const totalArrests = crimeData[crimeType]["crimes"].filter(crime => 
-                    (currentYear === 'all' || crime.year === parseInt(currentYear)) && crime.arrest === "Yes"
-                ).length;
+        function updateCounts(crimeType) {
+            // Update crime and arrest counts from the precomputed cube
+            if (!countCube) return;
+            const [total, arrests] = countCube[crimeType][currentYear] || [0, 0];
+            document.getElementById(`${crimeType}_count`).textContent = `Total: ${total}`;
+            document.getElementById(`${crimeType}_arrest_count`).textContent = `Arrests: ${arrests}`;
+        }
 
-                document.getElementById(`${crimeType}_count`).textContent = `Total: ${totalCrimes}`;
-                document.getElementById(`${crimeType}_arrest_count`).textContent = `Arrests: ${totalArrests}`;
+        function updateVisualization() {
+            const generation = ++renderGeneration;
+            if (RENDERER === 'canvas' && isHeatmapMode) map.removeLayer(pointCanvas);
+            crimeTypes.forEach(crimeType => {
+                updateCounts(crimeType);
+                // Only checked types cost any point work
+                if (document.querySelector(`input[value="${crimeType}"]`).checked) {
+                    renderLayer(crimeType, generation);
+                }
             });
         }
 
+        // Precomputed clusters and heat grids change with zoom, and deep
+        // zooms draw only the points in view
+        map.on('moveend', () => {
+            if (DATA_MODE === 'server' || (isHeatmapMode ? HEAT_GRIDS : CLUSTER_ZOOMS.length > 0)) {
+                updateVisualization();
+            }
+        });
+
         document.getElementById('yearFilter').addEventListener('change', function(e) {
             currentYear = e.target.value;
             updateVisualization();
@@ -454,23 +1556,77 @@ def main():
                 if (!this.checked) {
                     if (layers[crimeType]) map.removeLayer(layers[crimeType]);
                     if (heatmaps[crimeType]) map.removeLayer(heatmaps[crimeType]);
+                    if (RENDERER === 'canvas') pointCanvas.redraw();
                 } else {
                     updateVisualization();
                 }
             });
         });
 
+        if (DATA_MODE === 'server') {
+            fetch(`${API_URL}/api/counts`).then(r => r.json()).then(counts => {
+                countCube = counts;
+                crimeTypes.forEach(updateCounts);
+            });
+        }
+
         updateVisualization();
     </script>
 </body>
 </html>
 """
 
-    # Save the generated HTML to a file
-    with open('crime_map.html', 'w') as f:
-        f.write(html)
+    # Stream the page to disk, encoding the data sections as they are written
+    with PageWriter('crime_map.html', compress) as page:
+        page.write(html)
+        page.write(worker_block)
+        for block_id, value in json_blocks.items():
+            page.write(f'\n    <script type="application/json" id="{block_id}">')
+            page.write_json(value, script=True)
+            page.write('</script>')
+        page.write(script)
 
     print("\nMap has been generated as 'crime_map.html'")
+    if export_mode == 'tiles':
+        print(f"Point data has been written to '{data_dir}/' (serve over HTTP, e.g. python -m http.server)")
+    elif export_mode == 'server':
+        print("The page loads its data from server.py (run python server.py and open it from there)")
+    elif export_mode == 'pyramid':
+        print(f"The page draws the tiles in '{data_dir}/' (build them with python tile_pyramid.py --out {data_dir})")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Generate the RogueHunter crime map")
+    parser.add_argument('--export', choices=['inline', 'tiles', 'server', 'pyramid'], default='inline',
+                        help="Embed all points in the page, write per-type/per-year files next to it, "
+                             "fetch them from server.py, or draw tiles pre-rendered by tile_pyramid.py")
+    parser.add_argument('--data-dir',
+                        help="Directory for point files in tiles mode (default crime_map_data) "
+                             "or of the tile pyramid in pyramid mode (default crime_map_tiles)")
+    parser.add_argument('--format', choices=['json', 'columnar'], default='json',
+                        help="Encoding of point files in tiles mode")
+    parser.add_argument('--clusters', action='store_true',
+                        help="Precompute per-zoom clusters so the browser never clusters raw points")
+    parser.add_argument('--heat-grids', action='store_true',
+                        help="Feed the heatmap pre-binned density grids instead of raw points")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Merge only crimes added since the last tiles build into its files; "
+                             "edits to existing crimes (e.g. a late arrest) need a full build")
+    parser.add_argument('--api-url', default='',
+                        help="With --export server, base URL of server.py when it does not serve the page itself")
+    parser.add_argument('--renderer', choices=['markers', 'canvas'], default='markers',
+                        help="Draw points as clustered markers, or all at once on a canvas layer")
+    parser.add_argument('--compress', nargs='+', choices=['gzip', 'brotli'], default=[],
+                        help="Also write crime_map.html.gz and/or .br for a web server to send as is")
+    args = parser.parse_args()
+    if args.format == 'columnar' and args.export != 'tiles':
+        parser.error("--format columnar requires --export tiles")
+    if args.incremental and args.export != 'tiles':
+        parser.error("--incremental requires --export tiles")
+    if args.export in ('server', 'pyramid') and (args.clusters or args.heat_grids):
+        parser.error(f"--clusters and --heat-grids are not available with --export {args.export}")
+    if args.renderer == 'canvas' and args.export not in ('inline', 'tiles'):
+        parser.error("--renderer canvas requires --export inline or tiles")
+    data_dir = args.data_dir or ('crime_map_tiles' if args.export == 'pyramid' else 'crime_map_data')
+    main(export_mode=args.export, data_dir=data_dir, data_format=args.format, clusters=args.clusters,
+         heat_grids=args.heat_grids, incremental=args.incremental, api_url=args.api_url,
+         renderer=args.renderer, compress=args.compress)
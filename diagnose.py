@@ -1,50 +1,104 @@
-import sqlite3
 import pandas as pd
 from xgboost import XGBRegressor
 from sklearn.preprocessing import LabelEncoder
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import mean_absolute_error
-from sklearn.cluster import KMeans
 import numpy as np
+import argparse
+import sqlite3
+import time
+
+from clustering import cluster_incidents, ensure_cluster_tables, load_centroids
+from crime_loader import DB_PATH, load_crime_partitions
+from model_registry import artifact_status, fingerprint, high_water_mark, load_artifact, save_artifact
+
+N_CLUSTERS = 5
+
+LOAD_COLUMNS = ['ID', 'Date', 'Primary Type', 'Latitude', 'Longitude', 'dow']
+XGB_PARAMS = {'objective': 'reg:squarederror', 'random_state': 42}
+TEST_SIZE = 0.2
+# Extra boosting rounds fitted on the counts new crimes changed when updating a saved model
+UPDATE_ROUNDS = 10
 
 # Load data from the database
 def load_data():
-    conn = sqlite3.connect("crimes.db")
-    query = """
-        SELECT Date, Primary_Type AS crime_type, Latitude, Longitude
-        FROM filtered_crimes
-        WHERE Latitude IS NOT NULL AND Longitude IS NOT NULL
-    """
-    data = pd.read_sql_query(query, conn)
-    conn.close()
+    data = load_crime_partitions(LOAD_COLUMNS, located=True)
+    data = data.rename(columns={'Primary Type': 'crime_type', 'dow': 'day_of_week'})
 
-    # Parse dates and add day-related columns
-    data['Date'] = pd.to_datetime(data['Date'], errors='coerce')
-    data = data.dropna(subset=['Date'])  # Drop rows with invalid dates
-    data['day_of_week'] = data['Date'].dt.dayofweek
+    # Dates were parsed at ingest; drop rows whose date could not be
+    data = data.dropna(subset=['Date'])
     data['is_weekend'] = data['day_of_week'].apply(lambda x: 1 if x >= 5 else 0)
 
     return data
 
-# Perform clustering on crime locations
-def apply_clustering(data):
-    kmeans = KMeans(n_clusters=5, random_state=0)
-    data['cluster'] = kmeans.fit_predict(data[['Latitude', 'Longitude']])
+# Perform clustering on crime locations. Clusters are cached in the database,
+# so only crimes added since the last run are assigned unless refit is set.
+def apply_clustering(data, minibatch=False, refit=False, db_path=DB_PATH):
+    conn = sqlite3.connect(db_path)
+    data['cluster'] = cluster_incidents(
+        conn, data['ID'], data[['Latitude', 'Longitude']].to_numpy(dtype=np.float64), N_CLUSTERS,
+        minibatch=minibatch, refit=refit
+    )
+    conn.close()
     return data
 
-# Encode crime types
-def encode_crime_types(data):
+# Encode crime types, with the classes of a saved model when given so codes match it
+def encode_crime_types(data, classes=None):
     label_encoder = LabelEncoder()
-    data['crime_type_encoded'] = label_encoder.fit_transform(data['crime_type'])
-    return data
+    if classes is None:
+        data['crime_type_encoded'] = label_encoder.fit_transform(data['crime_type'])
+    else:
+        label_encoder.classes_ = np.array(classes, dtype=object)
+        data['crime_type_encoded'] = label_encoder.transform(data['crime_type'])
+    return data, label_encoder
+
+MODEL_FEATURES = ['day_of_week', 'is_weekend', 'cluster', 'crime_type_encoded']
+
+# Count crimes per (day, cluster, crime type) so the model learns real counts.
+# by='date' gives one row per calendar day, zero-count days included;
+# by='day_of_week' averages those into one row per weekday.
+def aggregate_counts(data, by='date'):
+    dates = data['Date'].dt.normalize()
+    all_dates = pd.date_range(dates.min(), dates.max(), freq='D', name='date')
+    counts = data.groupby([dates.rename('date'), 'cluster', 'crime_type_encoded']).size()
+    full_index = pd.MultiIndex.from_product(
+        [all_dates, np.sort(data['cluster'].unique()), np.sort(data['crime_type_encoded'].unique())],
+        names=['date', 'cluster', 'crime_type_encoded']
+    )
+    counts = counts.reindex(full_index, fill_value=0).rename('crime_count').reset_index()
+    counts['day_of_week'] = counts['date'].dt.dayofweek
+
+    if by == 'day_of_week':
+        counts = counts.groupby(['day_of_week', 'cluster', 'crime_type_encoded'], as_index=False)['crime_count'].mean()
+
+    counts['is_weekend'] = (counts['day_of_week'] >= 5).astype(int)
+    return counts
+
+def training_rows(data, train_on):
+    return data if train_on == 'rows' else aggregate_counts(data, train_on)
+
+# Rows whose values changed once crimes above after_id arrived: those crimes
+# themselves, the days they fell on, or every weekday average
+def changed_training_rows(data, train_on, after_id):
+    new = data['ID'] > after_id
+    if train_on == 'rows':
+        return data[new]
+    counts = aggregate_counts(data, train_on)
+    if train_on == 'date':
+        return counts[counts['date'].isin(data.loc[new, 'Date'].dt.normalize().unique())]
+    return counts
+
+def training_target(data):
+    # Rows that are single incidents have no count to learn, only a placeholder of ones
+    return data['crime_count'] if 'crime_count' in data else np.ones(len(data))
 
 # Train the prediction model
 def train_model(data):
-    X = data[['day_of_week', 'is_weekend', 'cluster', 'crime_type_encoded']]
-    y = data['crime_count'] if 'crime_count' in data else np.ones(len(X))  # Placeholder target variable
+    X = data[MODEL_FEATURES]
+    y = training_target(data)
 
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
-    model = XGBRegressor(objective="reg:squarederror", random_state=42)
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=TEST_SIZE, random_state=42)
+    model = XGBRegressor(**XGB_PARAMS)
     model.fit(X_train, y_train)
 
     predictions = model.predict(X_test)
@@ -52,42 +106,187 @@ def train_model(data):
     print(f"Mean Absolute Error: {mae}")
     return model
 
-# Generate predictions for January 2024
-def generate_january_predictions(data, model):
-    january_data = pd.DataFrame({
-        'day_of_week': range(7),
-        'is_weekend': [1 if i >= 5 else 0 for i in range(7)],
+# Continue boosting a trained model on rows that are new since it was saved
+def update_model(model, data):
+    updated = XGBRegressor(**XGB_PARAMS, n_estimators=UPDATE_ROUNDS)
+    updated.fit(data[MODEL_FEATURES], training_target(data), xgb_model=model.get_booster())
+    return updated
+
+def model_key(train_on, centroids):
+    return fingerprint(table='filtered_crimes', columns=LOAD_COLUMNS, located=True, train_on=train_on,
+                       features=MODEL_FEATURES, params=XGB_PARAMS, test_size=TEST_SIZE,
+                       centroids=np.round(centroids, 9).tolist())
+
+def saved_centroids(db_path=DB_PATH):
+    conn = sqlite3.connect(db_path)
+    ensure_cluster_tables(conn)
+    centroids = load_centroids(conn, N_CLUSTERS)
+    conn.close()
+    return centroids
+
+def load_model(model_path):
+    model = XGBRegressor()
+    model.load_model(model_path)
+    return model
+
+# Return (model, crime type classes), reusing the model registry. The
+# cluster centroids are part of the model key, so reclustering retrains.
+def fit_or_load(train_on='date', minibatch=False, refit=False, retrain=False, db_path=DB_PATH):
+    mark = high_water_mark(db_path)
+
+    # With clusters already fitted and a model trained on exactly these
+    # crimes, nothing needs reading: forecasting is inference only
+    centroids = saved_centroids(db_path)
+    if centroids is not None and not refit and not retrain:
+        artifact = load_artifact('diagnose', model_key(train_on, centroids))
+        if artifact_status(artifact, mark, db_path) == 'current':
+            print(f"Loaded the model trained on crimes up to ID {mark['max_id']}")
+            return load_model(artifact[0]), artifact[1]["crime_types"]
+
+    data = apply_clustering(load_data(), minibatch=minibatch, refit=refit, db_path=db_path)
+    centroids = saved_centroids(db_path)
+    key = model_key(train_on, centroids)
+    artifact = None if retrain else load_artifact('diagnose', key)
+    status = artifact_status(artifact, mark, db_path)
+
+    if status is not None:
+        model_path, metadata = artifact
+        classes = metadata["crime_types"]
+        # A crime type the saved encoder never saw needs a new model
+        if data['crime_type'].isin(classes).all():
+            model = load_model(model_path)
+            if status == 'current':
+                print(f"Loaded the model trained on crimes up to ID {mark['max_id']}")
+                return model, classes
+            data, _ = encode_crime_types(data, classes)
+            changed = changed_training_rows(data, train_on, metadata["mark"]["max_id"])
+            print(f"Boosting {UPDATE_ROUNDS} more rounds on {len(changed):,} rows changed by new crimes")
+            model = update_model(model, changed)
+        else:
+            status = None
+
+    if status is None:
+        data, label_encoder = encode_crime_types(data)
+        classes = label_encoder.classes_.tolist()
+        model = train_model(training_rows(data, train_on))
+
+    save_artifact('diagnose', key, model, {
+        "mark": mark,
+        "train_on": train_on,
+        "crime_types": classes,
+        "centroids": centroids.tolist(),
+    })
+    return model, classes
+
+# Build the feature grid of every (date, cluster, crime type) in start..end,
+# dates outermost, with one repeat/tile per column so any sizes line up
+def forecast_grid(start, end, clusters, crime_types):
+    dates = pd.date_range(start, end, freq='D')
+    clusters = np.asarray(clusters)
+    crime_types = np.asarray(crime_types)
+    per_date = len(clusters) * len(crime_types)
+
+    day_of_week = dates.dayofweek.to_numpy(dtype=np.int64)
+    return pd.DataFrame({
+        'date': np.repeat(dates.to_numpy(), per_date),
+        'day_of_week': np.repeat(day_of_week, per_date),
+        'is_weekend': np.repeat((day_of_week >= 5).astype(np.int64), per_date),
+        'cluster': np.tile(np.repeat(clusters, len(crime_types)), len(dates)),
+        'crime_type_encoded': np.tile(crime_types, len(dates) * len(clusters)),
     })
 
-    # Expand to cover each cluster and crime type
-    clusters = data['cluster'].unique()
-    crime_types = data['crime_type_encoded'].unique()
-    january_data = january_data.assign(cluster=np.repeat(clusters, len(january_data)),
-                                       crime_type_encoded=np.tile(crime_types, len(january_data) * len(clusters) // len(crime_types)))
-    
-    # Predict crime counts
-    january_data['predicted_crimes'] = model.predict(january_data[['day_of_week', 'is_weekend', 'cluster', 'crime_type_encoded']])
-    return january_data
-
-# Save predictions to a text file
-def save_predictions_to_file(predictions):
-    with open("predictions_analysis.txt", "w") as f:
-        f.write("CRIME PREDICTION ANALYSIS FOR JANUARY 2024\n")
+# Predict the crime count of every grid row in one batched call
+def forecast(model, start, end, clusters, crime_types):
+    grid = forecast_grid(start, end, clusters, crime_types)
+    grid['predicted_crimes'] = model.predict(grid[MODEL_FEATURES])
+    return grid
+
+# Heading for a forecast period, e.g. "JANUARY 2024" or "2024-01-01 TO 2024-12-31"
+def period_label(start, end):
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    if start.day == 1 and end == start + pd.offsets.MonthEnd(0):
+        return start.strftime('%B %Y').upper()
+    return f"{start:%Y-%m-%d} TO {end:%Y-%m-%d}"
+
+# Save predictions as text, CSV or Parquet. Crime types are written by name;
+# text is formatted a column at a time and written with one call.
+def save_predictions_to_file(predictions, crime_types, path, file_format='text', title=''):
+    predictions = predictions.assign(
+        crime_type=np.asarray(crime_types, dtype=object)[predictions['crime_type_encoded'].to_numpy()]
+    )
+    if file_format == 'csv':
+        predictions.to_csv(path, index=False, date_format='%Y-%m-%d', float_format='%.4f')
+        return
+    if file_format == 'parquet':
+        predictions.to_parquet(path, index=False)
+        return
+
+    entries = ("Date: " + predictions['date'].dt.strftime('%Y-%m-%d')
+               + ", Day of Week: " + predictions['day_of_week'].astype(str)
+               + ", Cluster: " + predictions['cluster'].astype(str)
+               + ", Crime Type: " + predictions['crime_type']
+               + "\n  Predicted Crimes: " + pd.Series(np.char.mod('%.2f', predictions['predicted_crimes'].to_numpy()),
+                                                      index=predictions.index)
+               + "\n" + "-" * 20 + "\n")
+    with open(path, "w") as f:
+        f.write(f"CRIME PREDICTION ANALYSIS FOR {title}\n")
         f.write("="*40 + "\n\n")
+        f.write("".join(entries.tolist()))
+
+# Time per-incident and aggregated training, scoring both on the same held-out daily counts
+def compare_training_modes(data):
+    results = []
+
+    start = time.perf_counter()
+    row_model = train_model(data)
+    results.append(('rows', len(data), time.perf_counter() - start, row_model))
+
+    for by in ('date', 'day_of_week'):
+        start = time.perf_counter()
+        counts = aggregate_counts(data, by)
+        model = train_model(counts)
+        results.append((by, len(counts), time.perf_counter() - start, model))
+
+    # Same split train_model makes of the daily counts, so the 'date' model never saw these rows
+    _, held_out = train_test_split(aggregate_counts(data, 'date'), test_size=TEST_SIZE, random_state=42)
+
+    print(f"\n{'training mode':>14} {'rows':>10} {'seconds':>8} {'daily MAE':>10}")
+    for mode, rows, seconds, model in results:
+        mae = mean_absolute_error(held_out['crime_count'], model.predict(held_out[MODEL_FEATURES]))
+        print(f"{mode:>14} {rows:>10,} {seconds:>8.2f} {mae:>10.3f}")
 
-        for index, row in predictions.iterrows():
-            f.write(f"Day of Week: {row['day_of_week']}, Cluster: {row['cluster']}, Crime Type Encoded: {row['crime_type_encoded']}\n")
-            f.write(f"  Predicted Crimes: {row['predicted_crimes']:.2f}\n")
-            f.write("-" * 20 + "\n")
+FORECAST_EXTENSIONS = {'text': 'txt', 'csv': 'csv', 'parquet': 'parquet'}
 
-def main():
-    data = load_data()
-    data = apply_clustering(data)
-    data = encode_crime_types(data)
+def main(train_on='date', compare=False, minibatch=False, refit=False, retrain=False,
+         start='2024-01-01', end='2024-01-31', output=None, output_format='text'):
+    if compare:
+        data = apply_clustering(load_data(), minibatch=minibatch, refit=refit)
+        data, _ = encode_crime_types(data)
+        compare_training_modes(data)
+        return
 
-    model = train_model(data)
-    january_predictions = generate_january_predictions(data, model)
-    save_predictions_to_file(january_predictions)
+    model, crime_types = fit_or_load(train_on, minibatch, refit, retrain)
+    predictions = forecast(model, start, end, np.arange(N_CLUSTERS), np.arange(len(crime_types)))
+    output = output or f"predictions_analysis.{FORECAST_EXTENSIONS[output_format]}"
+    save_predictions_to_file(predictions, crime_types, output, output_format, period_label(start, end))
+    print(f"Wrote {len(predictions):,} predictions to '{output}'")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Cluster crime locations and forecast daily crime counts")
+    parser.add_argument('--train-on', choices=['date', 'day_of_week', 'rows'], default='date',
+                        help="Train on counts per date or per weekday, or on raw incident rows")
+    parser.add_argument('--compare', action='store_true',
+                        help="Report training time and MAE of every training mode instead of predicting")
+    parser.add_argument('--minibatch', action='store_true',
+                        help="Fit clusters with streaming mini-batch k-means instead of full k-means")
+    parser.add_argument('--recluster', action='store_true',
+                        help="Refit the clusters, warm-started from the saved ones, and reassign every crime")
+    parser.add_argument('--retrain', action='store_true', help="Train from scratch even if a saved model is usable")
+    parser.add_argument('--start', default='2024-01-01', help="First day to forecast")
+    parser.add_argument('--end', default='2024-01-31', help="Last day to forecast")
+    parser.add_argument('--output', help="File to write; defaults to predictions_analysis with the format's extension")
+    parser.add_argument('--format', choices=sorted(FORECAST_EXTENSIONS), default='text',
+                        help="File format of the forecast")
+    args = parser.parse_args()
+    main(train_on=args.train_on, compare=args.compare, minibatch=args.minibatch, refit=args.recluster,
+         retrain=args.retrain, start=args.start, end=args.end, output=args.output, output_format=args.format)
@@ -1,64 +1,223 @@
-import pandas as pd
+import argparse
 import sqlite3
+import time
+
+import pandas as pd
+
+from clustering import forget_assignments
+from rollup import apply_rollup, ensure_rollup_table, prune_rollup, stage_rollup_ids
+from snapshot import FORMATS as SNAPSHOT_FORMATS, remove_snapshot, write_snapshot
 
-# Load the CSV file
-data = pd.read_csv('crime_data.csv')
-
-# Filter data for the years 2020 to 2024 and the specified primary types
-filtered_data = data[
-    (import pandas as pd
-    import xgboost as xgb
-    from sklearn.model_selection import train_test_split
-    from sklearn.metrics import accuracy_score
-    
-    # Load data from crimes.db
-    df = pd.read_sql_query("SELECT * FROM crimes", "sqlite:///crimes.db")
-    
-    # Preprocess data
-    df['date'] = pd.to_datetime(df['date'])
-    df['month'] = df['date'].dt.month
-    df['year'] = df['date'].dt.year
-    
-    # Split data into training and testing sets
-    train_df, test_df = train_test_split(df, test_size=0.2, random_state=42)
-    
-    # Define XGBoost model
-    xgb_model = xgb.XGBClassifier(objective='multi:softmax', num_class=10)
-    
-    # Train model on training data
-    xgb_model.fit(train_df.drop('crime_type', axis=1), train_df['crime_type'])
-    
-    # Make predictions for November 2024
-    nov_2024_df = test_df[test_df['year'] == 2024]
-    nov_2024_df = nov_2024_df[nov_2024_df['month'] == 11]
-    predictions = xgb_model.predict(nov_2024_df.drop('crime_type', axis=1))
-    
-    # Compare predictions with actual values
-    accuracy = accuracy_score(nov_2024_df['crime_type'], predictions)
-    print(f"Accuracy: {accuracy:.3f}")
-    
-    # Print comparison of predictions and actual values to a txt file
-    with open('comparison.txt', 'w') as f:
-        f.write("Predicted vs Actual Crimes for November 2024\n")
-        for i, row in nov_2024_df.iterrows():
-            f.write(f"Predicted: {predictions[i]}, Actual: {row['crime_type']}\n")data['Year'].between(2020, 2024)) & 
-    (data['Primary Type'].isin([
-        'HOMICIDE', 
-        'CRIMINAL SEXUAL ASSAULT', 
-        'OFFENSE INVOLVING CHILDREN', 
-        'HUMAN TRAFFICKING', 
-        'BURGLARY', 
-        'ARSON'
-    ]))
+CRIME_TYPES = [
+    'HOMICIDE',
+    'CRIMINAL SEXUAL ASSAULT',
+    'OFFENSE INVOLVING CHILDREN',
+    'HUMAN TRAFFICKING',
+    'BURGLARY',
+    'ARSON'
 ]
 
-# Connect to (or create) the SQLite database
-conn = sqlite3.connect('crimes.db')
+# Columns of the Chicago export, the dtype each is read as and its SQLite type.
+# Reading with explicit dtypes skips pandas' per-chunk type inference and keeps
+# codes like IUCR '0486' as text.
+COLUMNS = {
+    'ID': ('int64', 'INTEGER PRIMARY KEY'),
+    'Case Number': ('str', 'TEXT'),
+    'Date': ('str', 'TEXT'),
+    'Block': ('str', 'TEXT'),
+    'IUCR': ('str', 'TEXT'),
+    'Primary Type': ('str', 'TEXT'),
+    'Description': ('str', 'TEXT'),
+    'Location Description': ('str', 'TEXT'),
+    'Arrest': ('bool', 'INTEGER'),
+    'Domestic': ('bool', 'INTEGER'),
+    'Beat': ('Int64', 'INTEGER'),
+    'District': ('Int64', 'INTEGER'),
+    'Ward': ('Int64', 'INTEGER'),
+    'Community Area': ('Int64', 'INTEGER'),
+    'FBI Code': ('str', 'TEXT'),
+    'X Coordinate': ('float64', 'REAL'),
+    'Y Coordinate': ('float64', 'REAL'),
+    'Year': ('int64', 'INTEGER'),
+    'Updated On': ('str', 'TEXT'),
+    'Latitude': ('float64', 'REAL'),
+    'Longitude': ('float64', 'REAL'),
+    'Location': ('str', 'TEXT'),
+}
+
+# Columns derived from Date at ingest so consumers can filter and group on
+# typed values without parsing the text again. Year comes straight from
+# the export.
+DERIVED_COLUMNS = {
+    'date_iso': 'TEXT',  # 'YYYY-MM-DD HH:MM:SS', sorts chronologically
+    'epoch': 'INTEGER',  # Chicago local time in seconds since 1970, as if it were UTC
+    'month': 'INTEGER',
+    'hour': 'INTEGER',
+    'dow': 'INTEGER',  # Monday = 0
+}
+
+DATE_FORMAT = '%m/%d/%Y %I:%M:%S %p'
+
+INDEXES = {
+    'idx_crimes_type_year': '"Primary Type", Year',
+    'idx_crimes_year_location': 'Year, Latitude, Longitude',
+    'idx_crimes_date': 'date_iso',
+}
+
+CHUNK_SIZE = 100_000
+
+def configure_connection(conn):
+    """Tune SQLite for one large bulk load"""
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -65536")  # 64 MB
+
+def table_columns():
+    """(name, SQLite type) of every filtered_crimes column, in table order"""
+    return [(name, sql_type) for name, (_, sql_type) in COLUMNS.items()] + list(DERIVED_COLUMNS.items())
+
+def create_table(conn):
+    existing = [row[1] for row in conn.execute("PRAGMA table_info(filtered_crimes)")]
+    if existing and existing != [name for name, _ in table_columns()]:
+        # Tables from older versions of this script lack the typed columns
+        print("Existing filtered_crimes table has an old schema, recreating it")
+        conn.execute("DROP TABLE filtered_crimes")
+        conn.execute("DROP TABLE IF EXISTS filtered_crimes_rtree")
+        conn.execute("DROP TABLE IF EXISTS crime_rollup")
+
+    columns = ",\n            ".join(f'"{name}" {sql_type}' for name, sql_type in table_columns())
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS filtered_crimes (
+            {columns}
+        )
+    """)
+
+def create_indexes(conn):
+    for name, columns in INDEXES.items():
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON filtered_crimes ({columns})")
+    conn.execute("ANALYZE")
+
+def create_rtree(conn):
+    """Create the optional R*Tree over incident coordinates; False if SQLite lacks the module"""
+    try:
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS filtered_crimes_rtree
+            USING rtree(id, min_lat, max_lat, min_lng, max_lng)
+        """)
+    except sqlite3.OperationalError as e:
+        print(f"Skipping spatial index, SQLite has no R*Tree support: {e}")
+        return False
+    return True
+
+def add_derived_columns(chunk):
+    """Parse Date once, vectorised, into the DERIVED_COLUMNS"""
+    dates = pd.to_datetime(chunk['Date'], format=DATE_FORMAT, errors='coerce')
+    chunk = chunk.copy()
+    chunk['date_iso'] = dates.dt.strftime('%Y-%m-%d %H:%M:%S')
+    chunk['epoch'] = (dates - pd.Timestamp(0)).dt.total_seconds().astype('Int64')
+    chunk['month'] = dates.dt.month.astype('Int64')
+    chunk['hour'] = dates.dt.hour.astype('Int64')
+    chunk['dow'] = dates.dt.dayofweek.astype('Int64')
+    return chunk
+
+def update_rtree(conn, chunk):
+    located = chunk['Latitude'].notna() & chunk['Longitude'].notna()
+    conn.executemany(
+        "INSERT OR REPLACE INTO filtered_crimes_rtree VALUES (?, ?, ?, ?, ?)",
+        zip(chunk.loc[located, 'ID'].tolist(),
+            chunk.loc[located, 'Latitude'].tolist(), chunk.loc[located, 'Latitude'].tolist(),
+            chunk.loc[located, 'Longitude'].tolist(), chunk.loc[located, 'Longitude'].tolist())
+    )
+    # An updated incident may have lost its coordinates
+    conn.executemany(
+        "DELETE FROM filtered_crimes_rtree WHERE id = ?",
+        ((crime_id,) for crime_id in chunk.loc[~located, 'ID'].tolist())
+    )
+
+def filter_chunk(chunk):
+    """Keep 2020-2024 incidents of the tracked crime types"""
+    return chunk[chunk['Year'].between(2020, 2024) & chunk['Primary Type'].isin(CRIME_TYPES)]
+
+def chunk_rows(chunk):
+    """Rows of a chunk as plain Python values, with missing values as None"""
+    return chunk.astype(object).where(chunk.notna(), None).itertuples(index=False, name=None)
+
+def ingest(csv_path, db_path, chunk_size=CHUNK_SIZE, rtree=False):
+    """Stream the CSV into filtered_crimes one chunk at a time.
+
+    Only one chunk is held in memory at once, so peak memory does not grow
+    with the size of the export. Rows are upserted by ID, so re-running
+    on a newer export updates existing incidents and appends new ones.
+    Indexes are built once the rows are in, which is cheaper than
+    maintaining them row by row on a fresh table.
+    The crime_rollup counts are updated chunk by chunk in the same
+    transaction.
+    """
+    conn = sqlite3.connect(db_path)
+    configure_connection(conn)
+    create_table(conn)
+    rtree = rtree and create_rtree(conn)
+    ensure_rollup_table(conn)
+
+    column_names = [name for name, _ in table_columns()]
+    placeholders = ", ".join("?" for _ in column_names)
+    insert = f"INSERT OR REPLACE INTO filtered_crimes VALUES ({placeholders})"
+
+    rows_read = 0
+    rows_kept = 0
+    start = time.perf_counter()
+    reader = pd.read_csv(
+        csv_path,
+        usecols=list(COLUMNS),
+        dtype={name: dtype for name, (dtype, _) in COLUMNS.items()},
+        chunksize=chunk_size
+    )
+
+    # One transaction for the whole load; committing per chunk would force
+    # a WAL sync every chunk
+    with conn:
+        for chunk in reader:
+            rows_read += len(chunk)
+            chunk = add_derived_columns(filter_chunk(chunk))[column_names]
+            # Keep the rollup in step: uncount the rows being replaced, then
+            # count them again once their new values are in. The cached
+            # spatial clusters of incidents that moved no longer hold either.
+            stage_rollup_ids(conn, chunk['ID'])
+            apply_rollup(conn, -1)
+            forget_assignments(conn, chunk)
+            conn.executemany(insert, chunk_rows(chunk))
+            apply_rollup(conn, 1)
+            if rtree:
+                update_rtree(conn, chunk)
+            rows_kept += len(chunk)
+
+            elapsed = time.perf_counter() - start
+            print(f"  {rows_read:,} rows read, {rows_kept:,} kept ({rows_read / elapsed:,.0f} rows/sec)")
+
+        print("Building indexes...")
+        create_indexes(conn)
+        prune_rollup(conn)
 
-# Save filtered data to a new table in the database
-filtered_data.to_sql('filtered_crimes', conn, if_exists='replace', index=False)
+    conn.close()
+    elapsed = time.perf_counter() - start
+    print(f"Read {rows_read:,} rows and saved {rows_kept:,} in {elapsed:.1f}s "
+          f"({rows_read / max(elapsed, 1e-9):,.0f} rows/sec)")
+    return rows_kept
 
-# Close the connection
-conn.close()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load the Chicago crime export into SQLite")
+    parser.add_argument('--csv', default='crime_data.csv', help="Path of the Chicago crime CSV export")
+    parser.add_argument('--db', default='crimes.db', help="SQLite database to write")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="Rows read per chunk")
+    parser.add_argument('--rtree', action='store_true', help="Also maintain an R*Tree index over coordinates")
+    parser.add_argument('--snapshot-format', choices=sorted(SNAPSHOT_FORMATS), default='parquet',
+                        help="File format of the columnar snapshot written after the load")
+    parser.add_argument('--no-snapshot', action='store_true', help="Skip writing the columnar snapshot")
+    args = parser.parse_args()
 
-print("Data has been filtered and saved to 'crimes.db' in the 'filtered_crimes' table.")
+    ingest(args.csv, args.db, args.chunk_size, args.rtree)
+    print(f"Data has been filtered and saved to '{args.db}' in the 'filtered_crimes' table.")
+    # A snapshot left from an earlier ingest would hide the rows just loaded
+    if args.no_snapshot or not write_snapshot(args.db, file_format=args.snapshot_format, chunk_size=args.chunk_size):
+        remove_snapshot(args.db)
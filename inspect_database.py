@@ -1,5 +1,6 @@
 import pandas as pd
-import sqlite3
+
+from crime_loader import load_crime_partitions
 
 def process_data(data):
     # Check if the data frame is empty before processing
@@ -7,24 +8,14 @@ def process_data(data):
         print("Data retrieved from database is empty.")
         return data
 
-    # Convert date to datetime and check for parsing issues
-    try:
-        data['Date'] = pd.to_datetime(data['Date'], errors='coerce')
-    except Exception as e:
-        print("Error during date conversion:", e)
-        return pd.DataFrame()  # Return an empty DataFrame if there's an issue
-
-    # Drop rows where 'Date' could not be parsed
+    # Drop rows whose date could not be parsed at ingest
     data.dropna(subset=['Date'], inplace=True)
     
     if data.empty:
-        print("Data is empty after date parsing. Check date formats in the database.")
+        print("Data is empty after dropping unparsed dates. Check date formats in the export.")
         return data
 
-    # Extract year, month, and day of week as features
-    data['year'] = data['Date'].dt.year
-    data['month'] = data['Date'].dt.month
-    data['day_of_week'] = data['Date'].dt.dayofweek
+    # Year, month and day of week were extracted at ingest
     data['is_weekend'] = data['day_of_week'].isin([5, 6]).astype(int)
     data['day_of_year'] = data['Date'].dt.dayofyear
     data['quarter'] = data['Date'].dt.quarter
@@ -33,16 +24,11 @@ def process_data(data):
     return data
 
 print("Connecting to the database and retrieving data...")
-conn = sqlite3.connect('crimes.db')
-
-query = """
-SELECT Date, "Primary Type" AS primary_type, Block
-FROM filtered_crimes 
-WHERE Date >= '2022-01-01' AND Date < '2024-02-01'
-"""
 
-data = pd.read_sql(query, conn)
-conn.close()
+# Read the 2022-2024 partitions, then trim to the exact date range
+data = load_crime_partitions(['Date', 'Primary Type', 'Block', 'Year', 'month', 'dow'], years=range(2022, 2025))
+data = data[(data['Date'] >= pd.Timestamp('2022-01-01')) & (data['Date'] < pd.Timestamp('2024-02-01'))]
+data = data.rename(columns={'Primary Type': 'primary_type', 'Year': 'year', 'dow': 'day_of_week'})
 
 # Check if any data was retrieved
 if data.empty:
@@ -0,0 +1,103 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+import urllib.request
+from urllib.parse import urlencode, urlsplit
+
+# Load test for server.py: a number of keep-alive connections replay a
+# random mix of map and chart requests and the latency of each is reported
+# as p50/p99 per endpoint. Parameters are drawn from a fixed pool, so as
+# in real use some requests repeat and are served from the server's cache.
+
+YEARS = range(2020, 2025)
+# Roughly Chicago, split into a grid of view-sized boxes
+CITY = (41.64, -87.94, 42.02, -87.52)
+BBOX_GRID = 4
+
+def request_pool(types, size, rng):
+    """size distinct request paths across the API endpoints"""
+    south, west, north, east = CITY
+    lat_step, lng_step = (north - south) / BBOX_GRID, (east - west) / BBOX_GRID
+    paths = set()
+    while len(paths) < size:
+        endpoint = rng.choice(['points', 'counts', 'series'])
+        params = [('type', crime_type) for crime_type in rng.sample(types, rng.randint(1, min(3, len(types))))]
+        if endpoint == 'points':
+            params = params[:1] + [('year', rng.choice(YEARS))]
+            row, col = rng.randrange(BBOX_GRID), rng.randrange(BBOX_GRID)
+            params.append(('bbox', f"{south + row * lat_step},{west + col * lng_step},"
+                                   f"{south + (row + 1) * lat_step},{west + (col + 1) * lng_step}"))
+        else:
+            year_from = rng.choice(YEARS)
+            params += [('year_from', year_from), ('year_to', rng.choice([y for y in YEARS if y >= year_from]))]
+        if rng.random() < 0.3:
+            params.append(('arrest', 1))
+        paths.add(f"/api/{endpoint}?{urlencode(params)}")
+    return sorted(paths)
+
+async def client(host, port, paths, requests, rng, latencies, cache_states):
+    """One keep-alive connection sending requests one after another"""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for _ in range(requests):
+            path = rng.choice(paths)
+            start = time.perf_counter()
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+            await writer.drain()
+            status = await reader.readline()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            await reader.readexactly(int(headers.get('content-length', 0)))
+            elapsed = time.perf_counter() - start
+            if not status.startswith(b'HTTP/1.1 200'):
+                raise RuntimeError(f"{path}: {status.decode().strip()}")
+            latencies.setdefault(path.split('?')[0], []).append(elapsed)
+            cache_states.append(headers.get('x-cache'))
+    finally:
+        writer.close()
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+async def run(url, connections, requests, pool_size, seed):
+    parts = urlsplit(url)
+    with urllib.request.urlopen(f"{url}/api/types") as response:
+        types = json.load(response)
+    rng = random.Random(seed)
+    paths = request_pool(types, pool_size, rng)
+
+    latencies = {}
+    cache_states = []
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        client(parts.hostname, parts.port or 80, paths, requests // connections, random.Random(seed + i),
+               latencies, cache_states)
+        for i in range(connections)
+    ))
+    elapsed = time.perf_counter() - start
+
+    total = sum(len(values) for values in latencies.values())
+    print(f"{total:,} requests over {connections} connections in {elapsed:.2f}s "
+          f"({total / elapsed:,.0f} requests/sec), {cache_states.count('hit') / max(total, 1):.0%} cache hits")
+    print(f"\n{'endpoint':>12} {'requests':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for endpoint, values in sorted(latencies.items()) + [('all', [v for vs in latencies.values() for v in vs])]:
+        print(f"{endpoint.rsplit('/', 1)[-1]:>12} {len(values):>9,} "
+              f"{percentile(values, 0.5) * 1000:>8.2f} {percentile(values, 0.99) * 1000:>8.2f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure server.py latency under concurrent load")
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help="Base URL of a running server.py")
+    parser.add_argument('--connections', type=int, default=16, help="Concurrent keep-alive connections")
+    parser.add_argument('--requests', type=int, default=4000, help="Total requests to send")
+    parser.add_argument('--distinct', type=int, default=200, help="Distinct requests in the replayed pool")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the request mix")
+    args = parser.parse_args()
+    asyncio.run(run(args.url.rstrip('/'), args.connections, args.requests, args.distinct, args.seed))
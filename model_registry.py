@@ -0,0 +1,86 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+
+from build_state import current_max_id
+
+# Trained models are saved under models/<name>/<key>/ so a rerun can reuse
+# them instead of training again. The key is a fingerprint of everything
+# that decides what the model learns apart from the rows themselves: the
+# training query, the features and encoders it was built with and its
+# hyperparameters. Next to the booster, artifact.json records the encoders
+# (category values, centroids) and the data high-water mark the model was
+# trained up to, in the same max-ID sense as build_state.py.
+#
+# A saved artifact is then either current (same mark, load and predict),
+# behind only by appended rows (continue boosting on those), or unusable
+# (rows disappeared, so train again). Edits to rows below the mark are not
+# seen; pass --retrain after re-ingesting a corrected export.
+
+REGISTRY_DIR = 'models'
+MODEL_FILE = 'model.ubj'
+METADATA_FILE = 'artifact.json'
+
+def fingerprint(**parts):
+    """Short stable hash of JSON-serialisable parts"""
+    text = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+def high_water_mark(db_path):
+    """{"max_id", "rows"} of filtered_crimes as it stands"""
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute("SELECT COUNT(*) FROM filtered_crimes").fetchone()[0]
+    mark = {"max_id": current_max_id(conn), "rows": rows}
+    conn.close()
+    return mark
+
+def only_appended(mark, db_path):
+    """True when every row added since mark has a higher ID and none were removed"""
+    conn = sqlite3.connect(db_path)
+    rows, above = conn.execute(
+        "SELECT COUNT(*), COUNT(CASE WHEN ID > ? THEN 1 END) FROM filtered_crimes", (mark["max_id"],)
+    ).fetchone()
+    conn.close()
+    return rows == mark["rows"] + above
+
+def artifact_dir(name, key, registry_dir=REGISTRY_DIR):
+    return os.path.join(registry_dir, name, key)
+
+def load_artifact(name, key, registry_dir=REGISTRY_DIR):
+    """(model file path, metadata) of a saved artifact, or None"""
+    directory = artifact_dir(name, key, registry_dir)
+    try:
+        with open(os.path.join(directory, METADATA_FILE)) as f:
+            metadata = json.load(f)
+    except FileNotFoundError:
+        return None
+    return os.path.join(directory, MODEL_FILE), metadata
+
+def save_artifact(name, key, model, metadata, registry_dir=REGISTRY_DIR):
+    """Save an XGBoost model and its metadata as the artifact for key.
+
+    The files are written beside the old artifact and swapped in once
+    complete, so an interrupted run never leaves half an artifact.
+    """
+    directory = artifact_dir(name, key, registry_dir)
+    building = directory + '.building'
+    shutil.rmtree(building, ignore_errors=True)
+    os.makedirs(building)
+    model.save_model(os.path.join(building, MODEL_FILE))
+    with open(os.path.join(building, METADATA_FILE), 'w') as f:
+        json.dump(metadata, f)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.rename(building, directory)
+
+def artifact_status(artifact, mark, db_path):
+    """'current', 'appended' or None (train from scratch) for a loaded artifact"""
+    if artifact is None:
+        return None
+    trained_mark = artifact[1]["mark"]
+    if trained_mark == mark:
+        return 'current'
+    if mark["max_id"] > trained_mark["max_id"] and only_appended(trained_mark, db_path):
+        return 'appended'
+    return None
@@ -0,0 +1,143 @@
+import json
+import os
+import zlib
+
+# Streaming writer for the generated pages. A page is written as a run of
+# template fragments and JSON data sections; the JSON is encoded piece by
+# piece (see iter_json), so neither the data section nor the page ever
+# exists as one string. The same bytes can go through gzip and brotli
+# compressors in the same pass, giving page.html.gz / page.html.br for a
+# web server to send as they are. Everything is written to temporary files
+# that replace the previous page only once it is complete.
+
+BUFFER_SIZE = 1 << 16
+# Scalar lists up to this long are encoded in one call
+JSON_BATCH = 1000
+GZIP_LEVEL = 9
+# Quality 11 takes several times longer on a large page for a few percent
+BROTLI_QUALITY = 9
+EXTENSIONS = {'gzip': '.gz', 'brotli': '.br'}
+
+encode = json.JSONEncoder(separators=(',', ':')).encode
+
+def is_scalar(value):
+    return value is None or isinstance(value, (str, int, float))
+
+def json_key(key):
+    """Encoded object key, converting non-strings as json.dumps does"""
+    return encode(key if isinstance(key, str) else encode(key))
+
+def iter_json(value):
+    """Yield the JSON encoding of value in pieces.
+
+    The result equals json.dumps(value, separators=(',', ':')), but
+    containers are walked with an explicit stack instead of recursion.
+    Dicts whose values are all scalars (one record) and short scalar lists
+    are encoded in a single call. Any other iterable, such as a generator
+    reading rows from the database, is written as an array as it is
+    consumed.
+    """
+    # Each frame is [iterator, closing bracket, first item still to come]
+    frames = [[iter((value,)), '', True]]
+    while frames:
+        frame = frames[-1]
+        try:
+            item = next(frame[0])
+        except StopIteration:
+            frames.pop()
+            yield frame[1]
+            continue
+
+        prefix = '' if frame[2] else ','
+        frame[2] = False
+        if frame[1] == '}':
+            key, item = item
+            prefix += json_key(key) + ':'
+
+        if is_scalar(item):
+            yield prefix + encode(item)
+        elif isinstance(item, dict):
+            if all(map(is_scalar, item.values())):
+                yield prefix + encode(item)
+            else:
+                yield prefix + '{'
+                frames.append([iter(item.items()), '}', True])
+        elif isinstance(item, (list, tuple)) and len(item) <= JSON_BATCH and all(map(is_scalar, item)):
+            yield prefix + encode(item)
+        else:
+            yield prefix + '['
+            frames.append([iter(item), ']', True])
+
+def compressor(encoding):
+    """(compress, finish) functions of a streaming compressor, or None when unavailable"""
+    if encoding == 'gzip':
+        # wbits 16 + MAX_WBITS writes a gzip header and trailer
+        stream = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return stream.compress, stream.flush
+    try:
+        import brotli
+    except ImportError as e:
+        print(f"Skipping the brotli copy, brotli is not installed: {e}")
+        return None
+    stream = brotli.Compressor(quality=BROTLI_QUALITY)
+    return stream.process, stream.finish
+
+class PageWriter:
+    """Write path, plus a compressed copy per encoding in compress, in one pass.
+
+    Use as a context manager; the files replace any previous ones when the
+    block exits cleanly and are discarded if it raises.
+    """
+
+    def __init__(self, path, compress=()):
+        self.path = path
+        self.outputs = []
+        self.buffer = []
+        self.buffered = 0
+        for encoding in (None, *compress):
+            functions = compressor(encoding) if encoding else (None, None)
+            if functions is None:
+                continue
+            final = path + EXTENSIONS.get(encoding, '')
+            self.outputs.append((final, open(final + '.tmp', 'wb'), *functions))
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= BUFFER_SIZE:
+            self.flush()
+
+    def write_json(self, value, script=False):
+        """Write value as JSON; script escapes '</' so the JSON can sit inside a <script> block"""
+        for piece in iter_json(value):
+            # '<' only occurs inside string literals, which are never split across pieces
+            self.write(piece.replace('</', '<\\/') if script else piece)
+
+    def flush(self):
+        data = ''.join(self.buffer).encode()
+        self.buffer = []
+        self.buffered = 0
+        for _, f, compress, _ in self.outputs:
+            f.write(compress(data) if compress else data)
+
+    def close(self):
+        self.flush()
+        for final, f, _, finish in self.outputs:
+            if finish:
+                f.write(finish())
+            f.close()
+            os.replace(final + '.tmp', final)
+
+    def discard(self):
+        for final, f, _, _ in self.outputs:
+            f.close()
+            os.remove(final + '.tmp')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
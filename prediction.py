@@ -1,67 +1,219 @@
-import dask.dataframe as dd
+import argparse
+import os
+import sqlite3
+import tempfile
+
+import numpy as np
 import pandas as pd
 import xgboost as xgb
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import accuracy_score
-from sklearn.preprocessing import LabelEncoder
-import sqlite3
 
-# Load data from crimes.db
-conn = sqlite3.connect('crimes.db')
-query = """
-    SELECT * FROM filtered_crimes
-"""
-df_pd = pd.read_sql(query, conn, index_col='ID')
-conn.close()
-
-# Convert Pandas DataFrame to Dask DataFrame
-df = dd.from_pandas(df_pd)
-
-# Print column names
-print(df.columns)
-
-# Preprocess data
-df['Date'] = dd.to_datetime(df['Date'], format='%m/%d/%Y %I:%M:%S %p')
-df['Month'] = df['Date'].dt.month
-df['Year'] = df['Date'].dt.year
-
-# Encode categorical columns using LabelEncoder
-categorical_features = ['Case Number', 'Block', 'IUCR', 'Description', 'Location Description', 'FBI Code', 'Updated On', 'Location']
-for feature in categorical_features:
-    # Handle missing values
-    df[feature] = df[feature].fillna('Unknown')
-    
-    # Encode the column
-    le = LabelEncoder()
-    encoded_feature = le.fit_transform(df[feature].compute().values)
-    df[feature] = dd.from_pandas(pd.Series(encoded_feature).astype(int))
-
-# Encode the 'Primary Type' column
-df['Primary Type'] = df['Primary Type'].fillna('Unknown')
-le = LabelEncoder()
-encoded_feature = le.fit_transform(df['Primary Type'].compute().values)
-df['Primary Type'] = dd.from_pandas(pd.Series(encoded_feature).astype(int))
-
-# Split data into training and testing sets
-train_df, test_df = df.random_split([0.8, 0.2], random_state=42)
-
-# Define XGBoost model
-xgb_model = xgb.XGBClassifier(objective='multi:softmax', num_class=len(df['Primary Type'].unique().compute()))
-
-# Train model on training data
-xgb_model.fit(train_df.drop(['Date', 'Month', 'Year', 'Primary Type'], axis=1).compute(), train_df['Primary Type'].compute())
-
-# Make predictions for November 2024
-nov_2024_df = test_df[test_df['Year'] == 2024]
-nov_2024_df = nov_2024_df[nov_2024_df['Month'] == 11]
-predictions = xgb_model.predict(nov_2024_df.drop(['Date', 'Month', 'Year', 'Primary Type'], axis=1).compute())
-
-# Compare predictions with actual values
-accuracy = accuracy_score(nov_2024_df['Primary Type'].compute(), predictions)
-print(f"Accuracy: {accuracy:.3f}")
-
-# Print comparison of predictions and actual values to a txt file
-with open('comparison.txt', 'w') as f:
-    f.write("Predicted vs Actual Crimes for November 2024\n")
-    for i, row in nov_2024_df.iterrows():
-        f.write(f"Predicted: {predictions[i]}, Actual: {row['Primary Type']}\n")
\ No newline at end of file
+from crime_loader import DB_PATH, load_crimes
+from model_registry import artifact_status, fingerprint, high_water_mark, load_artifact, save_artifact
+
+# Trains the crime type classifier without ever holding the whole table.
+# Incidents are read from SQLite in ID ranges; one pass over the ranges
+# builds the categorical dictionaries, and XGBoost then pulls the encoded
+# ranges through a DataIter, either into a QuantileDMatrix (which keeps only
+# the quantised feature bins) or, with --external-memory, into on-disk pages.
+# Peak memory is one partition plus the dictionaries and the model's matrix.
+# The trained booster and dictionaries are kept in the model registry; a
+# rerun on unchanged data only predicts, and one after new incidents were
+# ingested continues boosting on the new ID ranges alone.
+
+CATEGORICAL_FEATURES = ['Case Number', 'Block', 'IUCR', 'Description', 'Location Description', 'FBI Code',
+                        'Updated On', 'Location']
+NUMERIC_FEATURES = ['Arrest', 'Domestic', 'Beat', 'District', 'Ward', 'Community Area',
+                    'X Coordinate', 'Y Coordinate', 'Latitude', 'Longitude']
+FEATURES = CATEGORICAL_FEATURES + NUMERIC_FEATURES
+LABEL = 'Primary Type'
+
+PARTITION_ROWS = 250_000
+TEST_PERCENT = 20
+
+PARAMS = {
+    'objective': 'multi:softmax',
+    'tree_method': 'hist',
+}
+NUM_BOOST_ROUND = 100
+# Extra rounds boosted on newly ingested incidents when updating a saved model
+UPDATE_ROUNDS = 10
+
+def id_ranges(db_path=DB_PATH, partition_rows=PARTITION_ROWS, after_id=None):
+    """(low, high] ID bounds that split filtered_crimes into partition_rows-row partitions
+
+    after_id restricts the ranges to incidents with a higher ID.
+    """
+    conn = sqlite3.connect(db_path)
+    ranges = []
+    if after_id is None:
+        low = conn.execute("SELECT MIN(ID) - 1 FROM filtered_crimes").fetchone()[0]
+    else:
+        low = after_id
+    while low is not None:
+        # Walks the primary key index, so finding each boundary is cheap
+        high = conn.execute(
+            "SELECT ID FROM filtered_crimes WHERE ID > ? ORDER BY ID LIMIT 1 OFFSET ?",
+            (low, partition_rows - 1)
+        ).fetchone()
+        if high is None:
+            high = conn.execute("SELECT MAX(ID) FROM filtered_crimes WHERE ID > ?", (low,)).fetchone()
+            if high[0] is not None:
+                ranges.append((low, high[0]))
+            break
+        ranges.append((low, high[0]))
+        low = high[0]
+    conn.close()
+    return ranges
+
+def read_partition(id_range, columns, db_path=DB_PATH):
+    """Rows with low < ID <= high, indexed by ID"""
+    return load_crimes(['ID'] + columns, where="ID > ? AND ID <= ?", params=id_range,
+                       db_path=db_path).set_index('ID')
+
+def build_dictionaries(ranges, db_path=DB_PATH):
+    """Sorted category values of each categorical column and the label, in one pass over the partitions"""
+    columns = CATEGORICAL_FEATURES + [LABEL]
+    seen = {column: set() for column in columns}
+    for id_range in ranges:
+        partition = read_partition(id_range, columns, db_path)
+        for column in columns:
+            seen[column].update(partition[column].fillna('Unknown').unique())
+    return {column: pd.Index(sorted(values)) for column, values in seen.items()}
+
+def extend_dictionaries(dictionaries, new):
+    """Append values only seen in new to the end of each dictionary, keeping existing codes"""
+    return {column: values.append(new[column].difference(values)) for column, values in dictionaries.items()}
+
+def encode(partition, dictionaries):
+    """Float32 feature matrix and int label codes of a partition"""
+    features = np.empty((len(partition), len(FEATURES)), dtype=np.float32)
+    for i, column in enumerate(FEATURES):
+        if column in dictionaries:
+            features[:, i] = dictionaries[column].get_indexer(partition[column].fillna('Unknown'))
+        else:
+            features[:, i] = partition[column].astype('float64').to_numpy(na_value=np.nan)
+    labels = dictionaries[LABEL].get_indexer(partition[LABEL].fillna('Unknown'))
+    return features, labels
+
+def is_test(ids):
+    """Stable pseudo-random TEST_PERCENT% split by ID, so every pass agrees"""
+    return (np.asarray(ids, dtype=np.uint64) * np.uint64(2654435761)) % np.uint64(100) < TEST_PERCENT
+
+class CrimePartitions(xgb.DataIter):
+    """Feeds XGBoost the training rows of each ID range in turn"""
+
+    def __init__(self, ranges, dictionaries, db_path=DB_PATH, cache_prefix=None):
+        self.ranges = ranges
+        self.dictionaries = dictionaries
+        self.db_path = db_path
+        self.position = 0
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data):
+        if self.position == len(self.ranges):
+            return False
+        partition = read_partition(self.ranges[self.position], FEATURES + [LABEL], self.db_path)
+        partition = partition[~is_test(partition.index)]
+        features, labels = encode(partition, self.dictionaries)
+        input_data(data=features, label=labels)
+        self.position += 1
+        return True
+
+    def reset(self):
+        self.position = 0
+
+def read_test_rows(dictionaries, year, month, db_path=DB_PATH):
+    """Encoded held-out rows from one month; a month is small enough to read at once"""
+    rows = load_crimes(['ID'] + FEATURES + [LABEL], where="Year = ? AND month = ?", params=(year, month),
+                       db_path=db_path).set_index('ID')
+    return encode(rows[is_test(rows.index)], dictionaries)
+
+def train(ranges, dictionaries, db_path=DB_PATH, external_memory=False, num_boost_round=NUM_BOOST_ROUND,
+          xgb_model=None):
+    """Train on the ranges, or continue boosting xgb_model on them when given"""
+    params = dict(PARAMS, num_class=len(dictionaries[LABEL]))
+    if not external_memory:
+        return xgb.train(params, xgb.QuantileDMatrix(CrimePartitions(ranges, dictionaries, db_path)),
+                         num_boost_round=num_boost_round, xgb_model=xgb_model)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        partitions = CrimePartitions(ranges, dictionaries, db_path, cache_prefix=os.path.join(cache_dir, 'cache'))
+        # ExtMemQuantileDMatrix arrived in XGBoost 3.0; older versions page a plain DMatrix
+        matrix_type = getattr(xgb, 'ExtMemQuantileDMatrix', xgb.DMatrix)
+        return xgb.train(params, matrix_type(partitions), num_boost_round=num_boost_round, xgb_model=xgb_model)
+
+def model_key():
+    """Registry key: what is read, how it is split and how the booster is trained"""
+    return fingerprint(table='filtered_crimes', features=FEATURES, categorical=CATEGORICAL_FEATURES, label=LABEL,
+                       test_percent=TEST_PERCENT, params=PARAMS, num_boost_round=NUM_BOOST_ROUND)
+
+def fit_or_load(db_path=DB_PATH, partition_rows=PARTITION_ROWS, external_memory=False, retrain=False):
+    """(booster, dictionaries), from the registry when it has a usable model"""
+    mark = high_water_mark(db_path)
+    key = model_key()
+    artifact = None if retrain else load_artifact('prediction', key)
+    status = artifact_status(artifact, mark, db_path)
+
+    if status is not None:
+        model_path, metadata = artifact
+        model = xgb.Booster(model_file=model_path)
+        dictionaries = {column: pd.Index(values) for column, values in metadata["dictionaries"].items()}
+        if status == 'current':
+            print(f"Loaded the model trained on crimes up to ID {mark['max_id']}")
+            return model, dictionaries
+
+        ranges = id_ranges(db_path, partition_rows, after_id=metadata["mark"]["max_id"])
+        new_dictionaries = extend_dictionaries(dictionaries, build_dictionaries(ranges, db_path))
+        # The number of classes is fixed once trained, so a new crime type needs a new model
+        if len(new_dictionaries[LABEL]) == len(dictionaries[LABEL]):
+            print(f"Boosting {UPDATE_ROUNDS} more rounds on {len(ranges)} partitions of new crimes")
+            model = train(ranges, new_dictionaries, db_path, external_memory, UPDATE_ROUNDS, xgb_model=model)
+            dictionaries = new_dictionaries
+        else:
+            print("New crime types since the saved model, training from scratch")
+            status = None
+
+    if status is None:
+        ranges = id_ranges(db_path, partition_rows)
+        print(f"Reading {len(ranges)} partitions of up to {partition_rows:,} crimes")
+        dictionaries = build_dictionaries(ranges, db_path)
+        print(f"Encoded {len(CATEGORICAL_FEATURES)} categorical features; {len(dictionaries[LABEL])} crime types")
+        model = train(ranges, dictionaries, db_path, external_memory)
+
+    save_artifact('prediction', key, model, {
+        "mark": mark,
+        "dictionaries": {column: values.tolist() for column, values in dictionaries.items()},
+    })
+    return model, dictionaries
+
+def main(db_path=DB_PATH, partition_rows=PARTITION_ROWS, external_memory=False, retrain=False):
+    model, dictionaries = fit_or_load(db_path, partition_rows, external_memory, retrain)
+    crime_types = dictionaries[LABEL]
+
+    # Make predictions for November 2024
+    features, actual = read_test_rows(dictionaries, 2024, 11, db_path)
+    predictions = model.predict(xgb.DMatrix(features)).astype(int) if len(features) else np.empty(0, dtype=int)
+
+    # Compare predictions with actual values
+    if len(actual):
+        print(f"Accuracy: {np.mean(predictions == actual):.3f}")
+    else:
+        print("No held-out crimes from November 2024 to score")
+
+    # Print comparison of predictions and actual values to a txt file
+    # Lines are built a column at a time and written with one call
+    names = crime_types.to_numpy(dtype=object)
+    lines = "Predicted: " + names[predictions] + ", Actual: " + names[actual] + "\n"
+    with open('comparison.txt', 'w') as f:
+        f.write("Predicted vs Actual Crimes for November 2024\n")
+        f.write("".join(lines.tolist()))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Train the crime type classifier partition by partition")
+    parser.add_argument('--db', default=DB_PATH, help="SQLite database to read")
+    parser.add_argument('--partition-rows', type=int, default=PARTITION_ROWS, help="Crimes read per partition")
+    parser.add_argument('--external-memory', action='store_true',
+                        help="Page the training matrix to disk instead of holding its quantised form in memory")
+    parser.add_argument('--retrain', action='store_true', help="Train from scratch even if a saved model is usable")
+    args = parser.parse_args()
+    main(args.db, args.partition_rows, args.external_memory, args.retrain)
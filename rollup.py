@@ -0,0 +1,121 @@
+import sqlite3
+
+# crime_rollup holds one count per combination of the dimensions the pages
+# chart, so regenerating them reads a few thousand rollup rows instead of
+# every incident. generate_db.py keeps it in step with filtered_crimes as
+# chunks are upserted. Missing values are stored as -1 rather than NULL,
+# since NULLs never conflict in a primary key and upserts would duplicate
+# them; rollup_counts() hands them back as None.
+
+# Rollup column -> expression over filtered_crimes
+DIMENSIONS = {
+    'type': '"Primary Type"',
+    'year': 'COALESCE(Year, -1)',
+    'month': 'COALESCE(month, -1)',
+    'dow': 'COALESCE(dow, -1)',  # Monday = 0
+    'hour': 'COALESCE(hour, -1)',
+    'area': 'COALESCE("Community Area", -1)',
+    'arrest': 'COALESCE(Arrest, -1)',
+    'located': '(Latitude IS NOT NULL AND Longitude IS NOT NULL)',
+}
+
+MISSING = -1
+
+def ensure_rollup_table(conn):
+    """Create crime_rollup, filling it from filtered_crimes when it is new"""
+    tables = {row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ('crime_rollup', 'filtered_crimes')"
+    )}
+    exists = 'crime_rollup' in tables
+    # Checked first so a wrong database path is not left with an empty rollup table
+    if not exists and 'filtered_crimes' not in tables:
+        raise sqlite3.OperationalError("no such table: filtered_crimes")
+    columns = ", ".join(DIMENSIONS)
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS crime_rollup (
+            type TEXT NOT NULL,
+            year INTEGER NOT NULL,
+            month INTEGER NOT NULL,
+            dow INTEGER NOT NULL,
+            hour INTEGER NOT NULL,
+            area INTEGER NOT NULL,
+            arrest INTEGER NOT NULL,
+            located INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY ({columns})
+        ) WITHOUT ROWID
+    """)
+    if not exists:
+        rebuild_rollup(conn)
+        conn.commit()
+
+def rebuild_rollup(conn):
+    """Recount crime_rollup from every row of filtered_crimes"""
+    positions = ", ".join(str(i + 1) for i in range(len(DIMENSIONS)))
+    conn.execute("DELETE FROM crime_rollup")
+    conn.execute(f"""
+        INSERT INTO crime_rollup
+        SELECT {", ".join(DIMENSIONS.values())}, COUNT(*)
+        FROM filtered_crimes
+        GROUP BY {positions}
+    """)
+
+def stage_rollup_ids(conn, ids):
+    """Remember the IDs of a chunk about to be upserted for apply_rollup()"""
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS rollup_ids (id INTEGER PRIMARY KEY)")
+    conn.execute("DELETE FROM rollup_ids")
+    conn.executemany("INSERT OR IGNORE INTO rollup_ids VALUES (?)", ((int(i),) for i in ids))
+
+def apply_rollup(conn, sign):
+    """Add (sign=1) or subtract (sign=-1) the staged rows' current counts.
+
+    Called with -1 before a chunk is upserted, so the incidents it replaces
+    stop counting, and with 1 afterwards to count their new values.
+    """
+    positions = ", ".join(str(i + 1) for i in range(len(DIMENSIONS)))
+    columns = ", ".join(DIMENSIONS)
+    conn.execute(f"""
+        INSERT INTO crime_rollup
+        SELECT {", ".join(DIMENSIONS.values())}, {int(sign)} * COUNT(*)
+        FROM filtered_crimes
+        WHERE ID IN (SELECT id FROM rollup_ids)
+        GROUP BY {positions}
+        ON CONFLICT ({columns}) DO UPDATE SET count = count + excluded.count
+    """)
+
+def prune_rollup(conn):
+    """Drop combinations whose incidents have all been replaced"""
+    conn.execute("DELETE FROM crime_rollup WHERE count = 0")
+
+def rollup_counts(conn, by=(), **filters):
+    """Sum incident counts grouped by the dimensions in by.
+
+    Each filter restricts a dimension to one value or to any of a list of
+    values, e.g. rollup_counts(conn, ('type', 'hour'), year=range(2020, 2025),
+    located=1). Returns a list of (*by values, count) tuples with missing
+    values as None.
+    """
+    unknown = set(by) | set(filters)
+    unknown -= set(DIMENSIONS)
+    if unknown:
+        raise ValueError(f"Unknown rollup dimensions: {', '.join(sorted(unknown))}")
+
+    conditions = []
+    params = []
+    for dimension, value in filters.items():
+        values = [value] if value is None or isinstance(value, (str, int)) else list(value)
+        values = [MISSING if v is None else v for v in values]
+        conditions.append(f"{dimension} IN ({', '.join('?' for _ in values)})")
+        params.extend(values)
+
+    query = f"SELECT {', '.join([*by, 'SUM(count)'])} FROM crime_rollup"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    if by:
+        query += f" GROUP BY {', '.join(by)} ORDER BY {', '.join(by)}"
+
+    rows = conn.execute(query, params).fetchall()
+    return [
+        tuple(None if value == MISSING else value for value in row[:-1]) + (row[-1] or 0,)
+        for row in rows
+    ]
@@ -0,0 +1,350 @@
+import argparse
+import asyncio
+import json
+import mimetypes
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import numpy as np
+import pandas as pd
+
+from analytics import DAY_NAMES, MONTH_NAMES, prepare_chart_data
+from crime_loader import DB_PATH
+from dashboard import build_count_cube, crime_record, load_crime_types
+from rollup import MISSING, ensure_rollup_table
+
+# A small local HTTP server the pages can query instead of having every
+# slice baked into them. It needs nothing beyond the standard library and
+# the database: asyncio handles the connections, SQLite reads run on a
+# thread pool, and finished responses are kept in a bounded LRU keyed by
+# the request and the data version, so repeated slices are answered from
+# memory and a new ingest invalidates them all at once. It also serves the
+# files in its root directory, so the generated pages can be opened from it
+# and fetch the API from the same origin.
+#
+# Counts and chart series come from crime_rollup, which is read into memory
+# once per data version; each request then only masks and sums that frame.
+#
+#   /api/types                            crime types
+#   /api/points?type=&year=&bbox=&arrest= geocoded crimes, as in the map page
+#   /api/counts?type=&year=&arrest=       {type: {year: [total, arrests]}}
+#   /api/series?type=&year=&arrest=       prepare_chart_data() output
+#
+# type and year may repeat; year_from/year_to give a year range instead.
+# bbox is south,west,north,east. arrest=1 keeps arrests only, arrest=0
+# crimes without one.
+
+CACHE_ENTRIES = 1024
+CACHE_MB = 64
+POINT_LIMIT = 50_000
+
+class BadRequest(Exception):
+    pass
+
+class LRUCache:
+    """Response bodies by key, evicting the least recently used past max_entries or max_bytes"""
+
+    def __init__(self, max_entries=CACHE_ENTRIES, max_bytes=CACHE_MB * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+        self.entries[key] = value
+        self.size += len(value)
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+def data_version(db_path):
+    """Changes whenever the database is written: size and mtime of the file and its WAL"""
+    version = []
+    for path in (db_path, db_path + '-wal'):
+        try:
+            stat = os.stat(path)
+            version.append((stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            version.append(None)
+    return tuple(version)
+
+# Each pool thread keeps its own read-only connection
+_local = threading.local()
+
+def connection(db_path):
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(f"file:{os.path.abspath(db_path)}?mode=ro", uri=True)
+        _local.conn = conn
+    return conn
+
+def load_rollup(conn):
+    """Every crime_rollup row, laid out as analytics.load_rollup_frame() plus year, arrest and located"""
+    df = pd.read_sql_query("SELECT * FROM crime_rollup", conn)
+    dow, month = df['dow'].to_numpy(), df['month'].to_numpy()
+    return pd.DataFrame({
+        'Primary Type': df['type'],
+        'hour': df['hour'].astype('Int64').mask(df['hour'] == MISSING),
+        'day_of_week': pd.Categorical.from_codes(dow, DAY_NAMES),
+        'month': pd.Categorical.from_codes(np.where(month == MISSING, MISSING, month - 1), MONTH_NAMES),
+        'Community Area': df['area'].astype('Int64').mask(df['area'] == MISSING),
+        'year': df['year'],
+        'arrest': df['arrest'],
+        'located': df['located'],
+        'count': df['count'],
+    })
+
+_rollup_lock = threading.Lock()
+_rollup = {}
+
+def rollup_frame(db_path, version):
+    """The in-memory rollup of the given data version, read on first use"""
+    with _rollup_lock:
+        if version not in _rollup:
+            _rollup.clear()
+            _rollup[version] = load_rollup(connection(db_path))
+        return _rollup[version]
+
+def rollup_mask(frame, filters):
+    mask = np.ones(len(frame), dtype=bool)
+    if 'type' in filters:
+        mask &= frame['Primary Type'].isin(filters['type']).to_numpy()
+    if 'year' in filters:
+        mask &= frame['year'].isin(filters['year']).to_numpy()
+    if 'arrest' in filters:
+        mask &= frame['arrest'].to_numpy() == filters['arrest']
+    return mask
+
+def has_rtree(conn):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'filtered_crimes_rtree'"
+    ).fetchone() is not None
+
+def int_values(params, name):
+    try:
+        return [int(value) for value in params.get(name, [])]
+    except ValueError:
+        raise BadRequest(f"{name} must be an integer")
+
+def crime_filters(params):
+    """rollup_counts()-style filters from the type, year(_from/_to) and arrest parameters"""
+    filters = {}
+    if 'type' in params:
+        filters['type'] = params['type']
+    years = int_values(params, 'year')
+    year_from, year_to = int_values(params, 'year_from'), int_values(params, 'year_to')
+    if year_from or year_to:
+        years = list(range(year_from[0] if year_from else 2020, (year_to[0] if year_to else 2024) + 1))
+    if years:
+        filters['year'] = years
+    arrest = int_values(params, 'arrest')
+    if arrest:
+        filters['arrest'] = arrest[0]
+    return filters
+
+def query_types(db_path, version, params):
+    return load_crime_types(connection(db_path))
+
+def query_counts(db_path, version, params):
+    """The map sidebar's count cube of geocoded crimes"""
+    filters = crime_filters(params)
+    frame = rollup_frame(db_path, version)
+    frame = frame[rollup_mask(frame, filters) & (frame['located'] == 1).to_numpy()]
+    counts = frame.groupby(['Primary Type', 'year', 'arrest'])['count'].sum()
+    rows = ((crime_type, None if year == MISSING else year, None if arrest == MISSING else arrest, count)
+            for (crime_type, year, arrest), count in zip(counts.index.tolist(), counts.tolist()))
+    crime_types = filters.get('type') or load_crime_types(connection(db_path))
+    return build_count_cube(crime_types, rows)
+
+def query_series(db_path, version, params):
+    """The analytics page's chart data, 2020-2024 unless years are given"""
+    filters = crime_filters(params)
+    filters.setdefault('year', list(range(2020, 2025)))
+    frame = rollup_frame(db_path, version)
+    return prepare_chart_data(frame[rollup_mask(frame, filters)])
+
+def query_points(db_path, version, params):
+    """Geocoded crimes matching the filters, in the map page's format"""
+    conn = connection(db_path)
+    filters = crime_filters(params)
+    conditions = ["Latitude IS NOT NULL AND Longitude IS NOT NULL"]
+    values = []
+    for column, name in (('"Primary Type"', 'type'), ('Year', 'year')):
+        if name in filters:
+            conditions.append(f"{column} IN ({', '.join('?' for _ in filters[name])})")
+            values.extend(filters[name])
+    if 'arrest' in filters:
+        conditions.append("Arrest = ?")
+        values.append(filters['arrest'])
+
+    if 'bbox' in params:
+        try:
+            south, west, north, east = (float(value) for value in params['bbox'][0].split(','))
+        except ValueError:
+            raise BadRequest("bbox must be south,west,north,east")
+        if has_rtree(conn):
+            conditions.append("""ID IN (SELECT id FROM filtered_crimes_rtree
+                                        WHERE min_lat >= ? AND max_lat <= ? AND min_lng >= ? AND max_lng <= ?)""")
+        else:
+            conditions.append("Latitude BETWEEN ? AND ? AND Longitude BETWEEN ? AND ?")
+        values.extend([south, north, west, east])
+
+    limit = (int_values(params, 'limit') or [POINT_LIMIT])[0]
+    rows = conn.execute(f"""
+        SELECT Latitude, Longitude, epoch, Year, Block, Description, Arrest
+        FROM filtered_crimes
+        WHERE {" AND ".join(conditions)}
+        LIMIT ?
+    """, values + [limit + 1]).fetchall()
+
+    crimes = [crime_record(*row) for row in rows[:limit]]
+    return {"crimes": crimes, "truncated": len(rows) > limit}
+
+ENDPOINTS = {
+    '/api/types': query_types,
+    '/api/points': query_points,
+    '/api/counts': query_counts,
+    '/api/series': query_series,
+}
+
+def run_query(db_path, version, endpoint, params):
+    return json.dumps(ENDPOINTS[endpoint](db_path, version, params)).encode()
+
+def read_static(root, path):
+    """(content type, bytes) of a file under root, or None"""
+    relative = os.path.normpath(unquote(path).lstrip('/') or 'index.html')
+    full_path = os.path.join(root, relative)
+    if relative.startswith('..') or os.path.isabs(relative) or not os.path.isfile(full_path):
+        return None
+    with open(full_path, 'rb') as f:
+        return mimetypes.guess_type(full_path)[0] or 'application/octet-stream', f.read()
+
+class QueryServer:
+    def __init__(self, db_path=DB_PATH, root='.', cache=None, workers=None):
+        self.db_path = db_path
+        self.root = root
+        self.cache = cache or LRUCache()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        # Identical requests that arrive while one is running share its result
+        self.pending = {}
+
+    async def api(self, endpoint, params):
+        """(body, 'hit' or 'miss') for an API request"""
+        version = data_version(self.db_path)
+        key = (endpoint, tuple(sorted((name, tuple(values)) for name, values in params.items())), version)
+        body = self.cache.get(key)
+        if body is not None:
+            return body, 'hit'
+        if key not in self.pending:
+            loop = asyncio.get_running_loop()
+            self.pending[key] = loop.run_in_executor(self.pool, run_query, self.db_path, version, endpoint, params)
+        try:
+            body = await self.pending[key]
+        finally:
+            self.pending.pop(key, None)
+        self.cache.put(key, body)
+        return body, 'miss'
+
+    async def respond(self, method, target):
+        """(status, headers, body) for one request"""
+        if method != 'GET':
+            return '405 Method Not Allowed', {}, b''
+        url = urlsplit(target)
+        if url.path in ENDPOINTS:
+            try:
+                body, cache_state = await self.api(url.path, parse_qs(url.query))
+            except BadRequest as e:
+                return '400 Bad Request', {'Content-Type': 'application/json'}, json.dumps({"error": str(e)}).encode()
+            return '200 OK', {'Content-Type': 'application/json', 'X-Cache': cache_state}, body
+
+        loop = asyncio.get_running_loop()
+        static = await loop.run_in_executor(self.pool, read_static, self.root, url.path)
+        if static is None:
+            return '404 Not Found', {}, b''
+        return '200 OK', {'Content-Type': static[0]}, static[1]
+
+    async def handle(self, reader, writer):
+        """Serve requests on one connection until the client closes it or asks to"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                try:
+                    status, response_headers, body = await self.respond(method, target)
+                except Exception as e:
+                    print(f"Error serving {target}: {e!r}")
+                    status, response_headers, body = '500 Internal Server Error', {}, b''
+
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                response_headers.update({
+                    'Content-Length': str(len(body)),
+                    # The pages may also be opened from disk or another port
+                    'Access-Control-Allow-Origin': '*',
+                    'Connection': 'keep-alive' if keep_alive else 'close',
+                })
+                head = f"HTTP/1.1 {status}\r\n" + "".join(f"{name}: {value}\r\n"
+                                                         for name, value in response_headers.items())
+                writer.write(head.encode('latin-1') + b"\r\n" + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+async def serve(db_path=DB_PATH, host='127.0.0.1', port=8000, root='.', cache_entries=CACHE_ENTRIES,
+                cache_mb=CACHE_MB):
+    # The rollup is created once up front; requests only ever read
+    conn = sqlite3.connect(db_path)
+    ensure_rollup_table(conn)
+    conn.close()
+
+    query_server = QueryServer(db_path, root, LRUCache(cache_entries, cache_mb * 1024 * 1024))
+    server = await asyncio.start_server(query_server.handle, host, port)
+    print(f"Serving '{db_path}' and the files in '{os.path.abspath(root)}' on http://{host}:{port}/")
+    async with server:
+        await server.serve_forever()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve crime queries and the generated pages over HTTP")
+    parser.add_argument('--db', default=DB_PATH, help="SQLite database to read")
+    parser.add_argument('--host', default='127.0.0.1', help="Address to listen on")
+    parser.add_argument('--port', type=int, default=8000, help="Port to listen on")
+    parser.add_argument('--root', default='.', help="Directory whose files are served alongside the API")
+    parser.add_argument('--cache-entries', type=int, default=CACHE_ENTRIES, help="Most responses kept cached")
+    parser.add_argument('--cache-mb', type=int, default=CACHE_MB, help="Most megabytes of responses kept cached")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.db, args.host, args.port, args.root, args.cache_entries, args.cache_mb))
+    except KeyboardInterrupt:
+        pass
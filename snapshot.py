@@ -0,0 +1,165 @@
+import json
+import os
+import shutil
+import sqlite3
+
+import pandas as pd
+
+# A columnar copy of filtered_crimes, partitioned by year and crime type into
+# <db name>_snapshot/Year=2021/Primary Type=ARSON/... so a reader opens only
+# the partitions it asks for and decodes only the columns it names, straight
+# into Arrow buffers instead of building Python objects row by row the way
+# sqlite3 does. generate_db.py rewrites it after every ingest. pyarrow is
+# optional: without it no snapshot is written and crime_loader.py reads
+# SQLite as before. The manifest records the row count and max ID the
+# snapshot was written from, and a snapshot that no longer matches
+# filtered_crimes is ignored.
+
+# Date is stored as a timestamp built from epoch, which with date_iso is
+# then left out as redundant
+DROPPED_COLUMNS = {'epoch', 'date_iso'}
+BOOL_COLUMNS = {'Arrest', 'Domestic'}
+SMALL_INT_COLUMNS = {'month', 'hour', 'dow'}
+
+# The arrow format is uncompressed Arrow IPC, which is memory-mapped and read
+# with no decoding at all; parquet is smaller on disk
+FORMATS = {'parquet': 'parquet', 'arrow': 'ipc'}
+
+MANIFEST = '_snapshot.json'
+
+def snapshot_dir_for(db_path):
+    """Default snapshot directory of a database, e.g. crimes.db -> crimes_snapshot"""
+    return os.path.splitext(db_path)[0] + '_snapshot'
+
+def snapshot_schema(conn):
+    """Arrow schema of the snapshot, from the filtered_crimes declared column types"""
+    import pyarrow as pa
+
+    fields = []
+    for _, name, sql_type, *_ in conn.execute("PRAGMA table_info(filtered_crimes)"):
+        if name in DROPPED_COLUMNS:
+            continue
+        if name == 'Date':
+            arrow_type = pa.timestamp('s')
+        elif name in BOOL_COLUMNS:
+            arrow_type = pa.bool_()
+        elif name in SMALL_INT_COLUMNS:
+            arrow_type = pa.int8()
+        elif sql_type.startswith('INTEGER'):
+            arrow_type = pa.int64()
+        elif sql_type == 'REAL':
+            arrow_type = pa.float64()
+        else:
+            arrow_type = pa.string()
+        fields.append(pa.field(name, arrow_type))
+    return pa.schema(fields)
+
+def table_mark(conn):
+    """(row count, max ID) of filtered_crimes"""
+    return conn.execute("SELECT COUNT(*), COALESCE(MAX(ID), 0) FROM filtered_crimes").fetchone()
+
+def partitioning():
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    return ds.partitioning(pa.schema([('Year', pa.int64()), ('Primary Type', pa.string())]), flavor='hive')
+
+def write_snapshot(db_path, snapshot_dir=None, file_format='parquet', chunk_size=100_000):
+    """Rewrite the snapshot of db_path's filtered_crimes; False if pyarrow is missing.
+
+    Rows are streamed out of SQLite chunk_size at a time, so memory stays
+    flat however large the table is. The new snapshot is built beside the
+    old one and swapped in once complete.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+    except ImportError as e:
+        print(f"Skipping columnar snapshot, pyarrow is not installed: {e}")
+        return False
+
+    snapshot_dir = snapshot_dir or snapshot_dir_for(db_path)
+    # write_dataset pulls batches from its own thread; they are still read one at a time
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    schema = snapshot_schema(conn)
+    selected = ['epoch' if field.name == 'Date' else field.name for field in schema]
+    query = "SELECT " + ", ".join(f'"{column}"' for column in selected) + " FROM filtered_crimes"
+
+    def batches():
+        for chunk in pd.read_sql_query(query, conn, chunksize=chunk_size):
+            chunk.columns = schema.names
+            yield pa.RecordBatch.from_pandas(chunk, schema=schema, preserve_index=False)
+
+    building = snapshot_dir + '.building'
+    shutil.rmtree(building, ignore_errors=True)
+    ds.write_dataset(
+        batches(), building, schema=schema, format=FORMATS[file_format],
+        partitioning=partitioning(), existing_data_behavior='error'
+    )
+    rows, max_id = table_mark(conn)
+    conn.close()
+
+    with open(os.path.join(building, MANIFEST), 'w') as f:
+        json.dump({"format": file_format, "rows": rows, "max_id": max_id}, f)
+    shutil.rmtree(snapshot_dir, ignore_errors=True)
+    os.rename(building, snapshot_dir)
+    print(f"Wrote the {file_format} snapshot of {rows:,} rows to '{snapshot_dir}'")
+    return True
+
+def remove_snapshot(db_path, snapshot_dir=None):
+    """Delete the snapshot of db_path, e.g. when an ingest did not rewrite it"""
+    snapshot_dir = snapshot_dir or snapshot_dir_for(db_path)
+    if os.path.exists(snapshot_dir):
+        shutil.rmtree(snapshot_dir)
+        print(f"Removed the outdated snapshot '{snapshot_dir}'")
+
+def has_snapshot(snapshot_dir, db_path):
+    """True when snapshot_dir holds a complete snapshot of db_path as it stands that pyarrow can read"""
+    try:
+        with open(os.path.join(snapshot_dir, MANIFEST)) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return False
+    try:
+        import pyarrow.dataset  # noqa: F401
+    except ImportError:
+        return False
+
+    conn = sqlite3.connect(db_path)
+    rows, max_id = table_mark(conn)
+    conn.close()
+    if (manifest.get("rows"), manifest.get("max_id")) != (rows, max_id):
+        print(f"Ignoring the snapshot '{snapshot_dir}', it no longer matches '{db_path}'")
+        return False
+    return True
+
+def read_snapshot(snapshot_dir, columns=None, years=None, crime_types=None, located=False):
+    """Read snapshot rows into an Arrow table.
+
+    Only the partitions matching years and crime_types are opened, and only
+    the named columns are decoded. located keeps rows with coordinates.
+    Files are memory-mapped, so with the arrow format the table's buffers
+    point straight into the page cache.
+    """
+    import pyarrow.dataset as ds
+    import pyarrow.fs as pafs
+
+    with open(os.path.join(snapshot_dir, MANIFEST)) as f:
+        manifest = json.load(f)
+    dataset = ds.dataset(
+        os.path.abspath(snapshot_dir), format=FORMATS[manifest["format"]],
+        filesystem=pafs.LocalFileSystem(use_mmap=True), partitioning=partitioning()
+    )
+
+    conditions = []
+    if years is not None:
+        conditions.append(ds.field('Year').isin(list(years)))
+    if crime_types is not None:
+        conditions.append(ds.field('Primary Type').isin(list(crime_types)))
+    if located:
+        conditions.append(ds.field('Latitude').is_valid() & ds.field('Longitude').is_valid())
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+
+    return dataset.to_table(columns=columns, filter=expression)
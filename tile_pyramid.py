@@ -0,0 +1,272 @@
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import struct
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from build_state import current_max_id, load_state, save_state
+from crime_loader import load_crime_partitions
+from dashboard import type_slug
+
+# Pre-rendered map tiles, so the page only ever loads the tiles in view and
+# its cost no longer grows with the number of incidents. Every crime type
+# gets a layer per year plus an 'all' layer, and each layer two kinds of
+# tile per zoom level: points (one mark per incident) and density (counts
+# binned into DENSITY_CELLS x DENSITY_CELLS cells, for the heatmap view).
+# Tiles follow the usual Web Mercator z/x/y scheme and are written to
+#
+#   <out_dir>/<type slug>/<year|all>/<points|density>/<z>/<x>/<y>.<bin|png>
+#
+# Only tiles holding at least one incident exist. Layers are rendered in
+# parallel across processes. An incremental build re-renders only the tiles
+# that incidents added since the last build fall in, using the same max-ID
+# watermark as the other incremental builds. PNG density tiles are coloured
+# against the layer's busiest cell, so when new incidents raise it every
+# density tile of that layer and zoom is redrawn.
+#
+# The vector format is little-endian binary: a points tile is uint16 (x, y)
+# pairs in tile coordinates of TILE_EXTENT units per side; a density tile
+# is n uint32 counts followed by the n uint16 cell indexes (row * cells +
+# col) they belong to. The png format draws the same data as 256px images.
+
+ZOOMS = range(10, 19)
+TILE_SIZE = 256
+TILE_EXTENT = 4096
+DENSITY_CELLS = 32
+# Beyond this many points a tile keeps one point per pixel, which draws the same
+POINT_TILE_LIMIT = 4096
+
+# South, west, north, east; incidents outside are left out of the pyramid
+CHICAGO_BOUNDS = (41.60, -87.95, 42.05, -87.50)
+
+FORMATS = {'vector': 'bin', 'png': 'png'}
+STATE_OUTPUT = 'crime_tiles'
+
+POINT_COLOR = (204, 0, 0)
+# The page's heatmap gradient, low to high
+DENSITY_RAMP = np.array([
+    (237, 248, 251), (191, 211, 230), (158, 188, 218), (140, 150, 198), (140, 107, 177),
+    (136, 65, 157), (129, 15, 124), (206, 18, 86), (239, 59, 44), (255, 0, 0),
+], dtype=np.float64)
+
+def state_key(out_dir):
+    """build_state output name of a pyramid, so each directory keeps its own watermark"""
+    return f"{STATE_OUTPUT}:{os.path.abspath(out_dir)}"
+
+def world_px(lat, lng, zoom):
+    """Web Mercator pixel coordinates of points at a zoom level, vectorised"""
+    scale = TILE_SIZE * 2.0 ** zoom
+    sin_lat = np.sin(np.radians(lat))
+    x = (lng + 180) / 360 * scale
+    y = (0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * np.pi)) * scale
+    return x, y
+
+def png_bytes(rgba):
+    """Encode an (h, w, 4) uint8 array as a PNG"""
+    height, width, _ = rgba.shape
+    # Each scanline starts with filter type 0
+    raw = np.hstack([np.zeros((height, 1), dtype=np.uint8), rgba.reshape(height, width * 4)]).tobytes()
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw, 6))
+            + chunk(b'IEND', b''))
+
+def points_tile(x, y, tile_format):
+    """Points tile from tile coordinates in TILE_EXTENT units"""
+    if len(x) > POINT_TILE_LIMIT:
+        # Snap to pixel centres and drop duplicates
+        pixel = np.unique((y // 16).astype(np.int64) * TILE_SIZE + x // 16)
+        x, y = (pixel % TILE_SIZE) * 16 + 8, (pixel // TILE_SIZE) * 16 + 8
+    if tile_format == 'vector':
+        return np.column_stack([x, y]).astype('<u2').tobytes()
+
+    # A 3x3 px mark per point, more opaque where marks overlap
+    px, py = (x // 16).astype(np.int64), (y // 16).astype(np.int64)
+    hits = np.zeros(TILE_SIZE * TILE_SIZE, dtype=np.int64)
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            cx, cy = px + dx, py + dy
+            inside = (cx >= 0) & (cx < TILE_SIZE) & (cy >= 0) & (cy < TILE_SIZE)
+            hits += np.bincount(cy[inside] * TILE_SIZE + cx[inside], minlength=TILE_SIZE * TILE_SIZE)
+    rgba = np.zeros((TILE_SIZE * TILE_SIZE, 4), dtype=np.uint8)
+    rgba[:, :3] = POINT_COLOR
+    rgba[:, 3] = np.where(hits > 0, np.minimum(120 + 20 * hits, 255), 0)
+    return png_bytes(rgba.reshape(TILE_SIZE, TILE_SIZE, 4))
+
+def density_tile(x, y, max_count, tile_format):
+    """Density tile from tile coordinates in TILE_EXTENT units"""
+    cell_size = TILE_EXTENT // DENSITY_CELLS
+    counts = np.bincount((y // cell_size).astype(np.int64) * DENSITY_CELLS + x // cell_size,
+                         minlength=DENSITY_CELLS * DENSITY_CELLS)
+    if tile_format == 'vector':
+        cells = np.flatnonzero(counts)
+        return counts[cells].astype('<u4').tobytes() + cells.astype('<u2').tobytes()
+
+    # Colour by log count relative to the layer's busiest cell at this zoom
+    level = np.log1p(counts) / np.log1p(max(max_count, 1)) * (len(DENSITY_RAMP) - 1)
+    low = np.clip(np.floor(level).astype(np.int64), 0, len(DENSITY_RAMP) - 1)
+    high = np.minimum(low + 1, len(DENSITY_RAMP) - 1)
+    colors = DENSITY_RAMP[low] + (DENSITY_RAMP[high] - DENSITY_RAMP[low]) * (level - low)[:, None]
+    rgba = np.zeros((DENSITY_CELLS * DENSITY_CELLS, 4), dtype=np.uint8)
+    rgba[:, :3] = colors.astype(np.uint8)
+    rgba[:, 3] = np.where(counts > 0, 180, 0)
+    scale = TILE_SIZE // DENSITY_CELLS
+    grid = rgba.reshape(DENSITY_CELLS, DENSITY_CELLS, 4).repeat(scale, axis=0).repeat(scale, axis=1)
+    return png_bytes(np.ascontiguousarray(grid))
+
+def render_layer(job):
+    """Write the tiles of one (type, year) layer.
+
+    job is (layer directory, world x, world y at the deepest zoom, mask of
+    new points or None for all, zooms, tile format, {zoom: busiest density
+    cell count} of the previous build or None). Returns (tiles written,
+    {zoom: busiest density cell count}).
+    """
+    layer_dir, world_x, world_y, new, zooms, tile_format, previous_max = job
+    extension = FORMATS[tile_format]
+    max_zoom = max(zooms)
+    cell_px = TILE_SIZE / DENSITY_CELLS
+    written = 0
+    density_max = {}
+    for zoom in zooms:
+        factor = 2.0 ** (max_zoom - zoom)
+        px, py = world_x / factor, world_y / factor
+        tile_x, tile_y = (px // TILE_SIZE).astype(np.int64), (py // TILE_SIZE).astype(np.int64)
+        local_x = np.clip((px - tile_x * TILE_SIZE) * (TILE_EXTENT / TILE_SIZE), 0, TILE_EXTENT - 1).astype(np.int64)
+        local_y = np.clip((py - tile_y * TILE_SIZE) * (TILE_EXTENT / TILE_SIZE), 0, TILE_EXTENT - 1).astype(np.int64)
+
+        _, cell_counts = np.unique(((px // cell_px).astype(np.int64) << 32) | (py // cell_px).astype(np.int64),
+                                   return_counts=True)
+        density_max[zoom] = int(cell_counts.max()) if len(cell_counts) else 0
+
+        keys = (tile_x << 32) | tile_y
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        ends = np.r_[starts[1:], len(sorted_keys)]
+        # Tiles a new incident falls in; an incremental build leaves the rest alone
+        affected = None if new is None else set(np.unique(keys[new]).tolist())
+        # PNG density colours are relative to density_max, so a new maximum redraws them all
+        rescale = (affected is not None and tile_format == 'png'
+                   and (previous_max or {}).get(str(zoom)) != density_max[zoom])
+
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            key = int(sorted_keys[start])
+            kinds = ('points', 'density') if affected is None or key in affected else ('density',) if rescale else ()
+            rows = order[start:end]
+            x, y = key >> 32, key & 0xFFFFFFFF
+            for kind in kinds:
+                if kind == 'points':
+                    data = points_tile(local_x[rows], local_y[rows], tile_format)
+                else:
+                    data = density_tile(local_x[rows], local_y[rows], density_max[zoom], tile_format)
+                tile_dir = os.path.join(layer_dir, kind, str(zoom), str(x))
+                os.makedirs(tile_dir, exist_ok=True)
+                with open(os.path.join(tile_dir, f"{y}.{extension}"), 'wb') as f:
+                    f.write(data)
+                written += 1
+    return written, density_max
+
+def build_pyramid(db_path='crimes.db', out_dir='crime_map_tiles', tile_format='vector', zooms=ZOOMS,
+                  incremental=False, workers=None):
+    """Render the tile pyramid of every crime type and year into out_dir.
+
+    With incremental, only the tiles holding incidents added since the
+    last build with the same options are rewritten.
+    """
+    start = time.perf_counter()
+    zooms = list(zooms)
+    options = {"format": tile_format, "zooms": zooms}
+    manifest_path = os.path.join(out_dir, 'manifest.json')
+    state_output = state_key(out_dir)
+
+    conn = sqlite3.connect(db_path)
+    max_id = current_max_id(conn)
+    since_id, built_options = load_state(conn, state_output) if incremental else (None, None)
+    # The tiles on disk must be the ones the watermark describes, in the requested format and zooms
+    manifest = None
+    if since_id is not None and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    if since_id is not None and (built_options != options or manifest is None
+                                 or {"format": manifest.get("format"), "zooms": manifest.get("zooms")} != options):
+        print("No matching previous tile build found, rebuilding everything")
+        since_id = None
+    if since_id is not None and since_id >= max_id:
+        conn.close()
+        print("Tiles are already up to date")
+        return
+
+    df = load_crime_partitions(['ID', 'Primary Type', 'Year', 'Latitude', 'Longitude'], located=True,
+                               db_path=db_path)
+    south, west, north, east = CHICAGO_BOUNDS
+    df = df[(df['ID'] <= max_id) & df['Latitude'].between(south, north) & df['Longitude'].between(west, east)]
+    world_x, world_y = world_px(df['Latitude'].to_numpy(dtype=np.float64),
+                                df['Longitude'].to_numpy(dtype=np.float64), max(zooms))
+    is_new = df['ID'].to_numpy() > since_id if since_id is not None else None
+
+    if since_id is None:
+        shutil.rmtree(out_dir, ignore_errors=True)
+        manifest = {**options, "extent": TILE_EXTENT, "density_cells": DENSITY_CELLS, "types": {}}
+
+    types = df['Primary Type'].to_numpy()
+    years = df['Year'].to_numpy()
+    jobs = []
+    layers = []
+    for crime_type in sorted(set(types.tolist())):
+        of_type = types == crime_type
+        type_years = sorted(set(years[of_type].tolist()))
+        manifest["types"].setdefault(crime_type, {"slug": type_slug(crime_type), "years": [], "density_max": {}})
+        for year in ['all'] + type_years:
+            mask = of_type if year == 'all' else of_type & (years == year)
+            if is_new is not None and not is_new[mask].any():
+                continue
+            layer_dir = os.path.join(out_dir, type_slug(crime_type), str(year))
+            previous_max = None if is_new is None else manifest["types"][crime_type]["density_max"].get(str(year))
+            jobs.append((layer_dir, world_x[mask], world_y[mask], None if is_new is None else is_new[mask],
+                         zooms, tile_format, previous_max))
+            layers.append((crime_type, str(year)))
+
+    # Biggest layers first, so no worker is left with a large one at the end
+    by_size = sorted(range(len(jobs)), key=lambda i: -len(jobs[i][1]))
+    written = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for i, (tiles, density_max) in zip(by_size, pool.map(render_layer, [jobs[i] for i in by_size])):
+            crime_type, year = layers[i]
+            type_entry = manifest["types"][crime_type]
+            if year not in type_entry["years"]:
+                type_entry["years"].append(year)
+            type_entry["density_max"][year] = {str(zoom): count for zoom, count in density_max.items()}
+            written += tiles
+
+    os.makedirs(out_dir, exist_ok=True)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    save_state(conn, state_output, max_id, options)
+    conn.close()
+    print(f"Wrote {written:,} tiles for {len(jobs)} layers to '{out_dir}' in {time.perf_counter() - start:.1f}s")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pre-render map tiles of every crime type and year")
+    parser.add_argument('--db', default='crimes.db', help="SQLite database to read")
+    parser.add_argument('--out', default='crime_map_tiles', help="Directory to write the tiles to")
+    parser.add_argument('--format', choices=sorted(FORMATS), default='vector',
+                        help="Compact binary vector tiles or PNG images")
+    parser.add_argument('--min-zoom', type=int, default=ZOOMS[0], help="Shallowest zoom level rendered")
+    parser.add_argument('--max-zoom', type=int, default=ZOOMS[-1], help="Deepest zoom level rendered")
+    parser.add_argument('--workers', type=int, help="Processes rendering layers (default: one per CPU)")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Re-render only the tiles crimes added since the last build fall in")
+    args = parser.parse_args()
+    build_pyramid(args.db, args.out, args.format, range(args.min_zoom, args.max_zoom + 1), args.incremental,
+                  args.workers)